@@ -1,3 +1,4 @@
+from anomalyModelBase import AnomalyModelBase
 from anomalyModelSVG import AnomalyModelSVG
 from anomalyModelMVG import AnomalyModelMVG
 from anomalyModelBalancedDistribution import AnomalyModelBalancedDistribution
@@ -6,7 +6,6 @@ import time
 
 import h5py
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.spatial import distance
 from tqdm import tqdm
 
@@ -69,10 +68,18 @@ class AnomalyModelBalancedDistribution(AnomalyModelBase):
         
         return distance.mahalanobis(feature, self._mean, self._covI)
 
+    def __mahalanobis_distances__(self, features):
+        """Calculate the Mahalanobis distances between many inputs (N x D) and the model"""
+        assert not self._covI is None and not self._mean is None, \
+            "You need to load a model before computing a Mahalanobis distance"
+
+        delta = features - self._mean
+        return np.sqrt(np.sum(np.dot(delta, self._covI) * delta, axis=-1))
+
     def __generate_model__(self, patches, silent=False):
-        if not silent: logger.info("Generating a Balanced Distribution from %i feature vectors of length %i" % (len(patches.ravel()), patches.features.shape[-1]))
+        if not silent: logger.info("Generating a Balanced Distribution from %i feature vectors of length %i" % (len(patches.ravel_roi()), patches.features.shape[-1]))
 
-        patches_flat = patches.ravel()
+        patches_flat = patches.ravel_roi()
 
         if patches_flat.shape[0] < self.initial_normal_features:
             self.initial_normal_features = patches_flat.shape[0]
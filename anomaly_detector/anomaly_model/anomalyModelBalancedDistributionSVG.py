@@ -6,7 +6,6 @@ import time
 
 import h5py
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.spatial import distance
 from tqdm import tqdm
 
@@ -47,6 +46,18 @@ class AnomalyModelBalancedDistributionSVG(AnomalyModelBalancedDistribution):
 
         return np.sqrt(np.sum(np.divide((feature - self._mean) **2, self._var, out=np.zeros_like(self._var), where=self._var!=0)))
 
+    def __mahalanobis_distances__(self, features):
+        """Calculate the Mahalanobis distances between many inputs (N x D) and the model"""
+        assert not self._var is None and not self._mean is None, \
+            "You need to load a model before computing a Mahalanobis distance"
+
+        # TODO: This is a hack for collapsed SVGs. Should normally not happen
+        if not self._var.any(): # var contains only zeros
+            return np.where(np.all(features == self._mean, axis=-1), 0.0, np.nan)
+
+        varI = np.divide(1.0, self._var, out=np.zeros_like(self._var), where=self._var!=0)
+        return np.sqrt(np.sum((features - self._mean) ** 2 * varI, axis=-1))
+
 # Only for tests
 if __name__ == "__main__":
     from common import PatchArray
@@ -3,12 +3,11 @@ import time
 import sys
 
 import h5py
-import matplotlib.pyplot as plt
 import numpy as np
 from tqdm import tqdm
 
 import consts
-from common import PatchArray, Visualize, utils, logger
+from common import PatchArray, Visualize, ArtifactStore, utils, logger
 
 class AnomalyModelBase(object):
     
@@ -26,11 +25,23 @@ class AnomalyModelBase(object):
             h5py.group that will be saved to the features file
         """
         raise NotImplementedError()
+
+    def __partial_fit__(self, patches, silent=False):
+        """Update the model with new patches without the patches it was generated from
+
+        Args:
+            patches (PatchArray): Array of new patches with features as extracted by a FeatureExtractor
+        """
+        raise NotImplementedError()
         
     def __mahalanobis_distance__(self, patch):
         """Calculate the Mahalanobis distance between the input and the model"""
         raise NotImplementedError()
         
+    def __mahalanobis_distances__(self, features):
+        """Calculate the Mahalanobis distances between many inputs (N x D) and the model"""
+        raise NotImplementedError()
+        
     def classify(self, patch):
         """Classify a single feature based on the loaded model
         
@@ -59,11 +70,14 @@ class AnomalyModelBase(object):
     ########################
     
     def load_or_generate(self, patches=consts.FEATURES_FILE,
-                               load_patches=False, silent=False):
+                               load_patches=False, silent=False, force=False, mahalanobis_distances=True):
         """Load a model from file or generate it based on the features
         
         Args:
             patches (str, PatchArray) : HDF5 file containing features (see feature_extractor for details)
+            force (bool) : Generate the model even if it is in the file (eg. because the features changed)
+            mahalanobis_distances (bool) : Calculate the Mahalanobis distances after generating the model
+                                           (see calculate_all_mahalanobis_distances to do it for many models at once)
         """
         
         # Load patches if necessary
@@ -72,7 +86,7 @@ class AnomalyModelBase(object):
                 raise ValueError("Specified file does not exist (%s)" % patches)
             
             # Try loading
-            loaded = self.load_from_file(patches, load_patches=load_patches)
+            loaded = not force and self.load_from_file(patches, load_patches=load_patches)
             if loaded:
                 return True
 
@@ -82,7 +96,7 @@ class AnomalyModelBase(object):
         elif isinstance(patches, PatchArray):
             self.patches = patches
             # Try loading
-            loaded = self.load_from_file(patches.filename, load_patches=load_patches)
+            loaded = not force and self.load_from_file(patches.filename, load_patches=load_patches)
             if loaded:
                 return True
         else:
@@ -105,16 +119,74 @@ class AnomalyModelBase(object):
 
         self.save_to_file(model_input.size, start, end)
 
-        self.calculate_mahalanobis_distances()
+        if mahalanobis_distances:
+            self.calculate_mahalanobis_distances()
+
+        return True
+
+    def partial_fit(self, patches, silent=False, mahalanobis_distances=True):
+        """Update a generated or loaded model with new patches (eg. a new normal round) and save it.
+        This takes time proportional to the new patches, the model keeps the sufficient statistics
+        of the patches it was generated from.
+
+        Args:
+            patches (PatchArray): New patches (only the training patches are used, see filter_training)
+            mahalanobis_distances (bool) : Calculate the Mahalanobis distances of self.patches again
+        """
+        if self.patches is None:
+            raise ValueError("The model needs to be generated or loaded first")
+
+        assert patches.contains_features, "patches must contain features to update an anomaly model."
+
+        model_input = self.filter_training(patches)
+
+        start = time.time()
+
+        if self.__partial_fit__(model_input, silent=silent) == False:
+            logger.info("Could not update model.")
+            return False
+
+        end = time.time()
+
+        with self.open_model_file(self.patches.filename) as hf:
+            g = hf.get(self.NAME)
+            num_features = g.attrs.get("Number of features used", 0) if g is not None else 0
+
+        self.save_to_file(num_features + model_input.size, start, end)
+
+        if mahalanobis_distances:
+            self.calculate_mahalanobis_distances()
 
         return True
 
     def filter_training(self, patches):
         return patches.training
 
+    def open_model_file(self, model_file):
+        """ Open the file containing this model: The artifact store of the features file
+        model_file or, for older files, the features file itself """
+        store = ArtifactStore(model_file)
+        if self.NAME in store:
+            return store.read(self.NAME)
+        return utils.open_feature_file(model_file)
+
+    def move_to_store(self):
+        """ Copy a model that an older version saved into the features file to the artifact store """
+        store = self.patches.store
+        if self.NAME in store:
+            return
+        
+        with utils.open_feature_file(self.patches.filename) as hf:
+            if hf.get(self.NAME) is None:
+                raise ValueError("The model needs to be saved first")
+            
+            logger.info("Copying %s to %s" % (self.NAME, store.filename(self.NAME)))
+            with store.write(self.NAME) as af:
+                hf.copy(self.NAME, af, name=self.NAME)
+
     def is_in_file(self, model_file):
         """ Check if model and mahalanobis distances are already in model_file """
-        with h5py.File(model_file, "r") as hf:
+        with self.open_model_file(model_file) as hf:
             g = hf.get(self.NAME)
             
             if g is None:
@@ -123,13 +195,10 @@ class AnomalyModelBase(object):
                 return (True, "mahalanobis_distances" in g.keys())
 
     def save_to_file(self, num_features=0, start=None, end=None):
-        logger.info("Writing model to: %s" % self.patches.filename)
-        with h5py.File(self.patches.filename, "a") as hf:
-            g = hf.get(self.NAME)
-
-            if g is not None:
-                del hf[self.NAME]
-            
+        """ Save the model to the artifact store of the features file (replaces an older version) """
+        store = ArtifactStore(self.patches.filename)
+        logger.info("Writing model to: %s" % store.filename(self.NAME))
+        with store.write(self.NAME) as hf:
             g = hf.create_group(self.NAME)
 
             # Add metadata to the output file
@@ -146,12 +215,12 @@ class AnomalyModelBase(object):
                 g.attrs["Duration (formatted)"] = utils.format_duration(end - start)
 
             self.__save_model_to_file__(g)
-        logger.info("Successfully written model to: %s" % self.patches.filename)
+        logger.info("Successfully written model to: %s" % store.filename(self.NAME))
 
 
     def load_from_file(self, model_file, load_patches=False):
         """ Load a model from file """
-        with h5py.File(model_file, "r") as hf:
+        with self.open_model_file(model_file) as hf:
             g = hf.get(self.NAME)
             
             if g is None:
@@ -164,29 +233,145 @@ class AnomalyModelBase(object):
 
             return self.__load_model_from_file__(g)
     
-    def calculate_mahalanobis_distances(self):
-        """ Calculate all the Mahalanobis distances and save them to the file """
-        with h5py.File(self.patches.filename, "r+") as hf:
+    def __mahalanobis_distances_block__(self, block, features):
+        """Calculate the Mahalanobis distances of a block of frames (NaN outside the region of interest)
+
+        Args:
+            block (PatchArray): Frames (frames x height x width)
+            features (np.array): Features of the block (block.features, so they are only read once for all models)
+
+        Returns:
+            dict: Dataset name -> Mahalanobis distances (same shape as block)
+        """
+        maha = np.full(block.shape, np.nan, dtype=np.float64)
+        roi = block.roi
+        if roi.any():
+            maha[roi] = self.__mahalanobis_distances__(features[roi])
+        return {"mahalanobis_distances": maha}
+
+    def calculate_mahalanobis_distances(self, incremental=True):
+        """ Calculate the Mahalanobis distances and save them with the model (see calculate_all_mahalanobis_distances) """
+        return AnomalyModelBase.calculate_all_mahalanobis_distances([self], self.patches, incremental=incremental)
+
+    def scored_times(self):
+        """ Times of the frames that already have Mahalanobis distances (None if there are none or their times are unknown) """
+        store = self.patches.store
+        if self.NAME not in store:
+            return None
+
+        with store.read(self.NAME) as hf:
+            g = hf.get(self.NAME)
+            if g is None or "mahalanobis_distances_times" not in g.keys():
+                return None
+            return np.array(g["mahalanobis_distances_times"])
+
+    @staticmethod
+    def calculate_all_mahalanobis_distances(models, patches, block_size=256 * 1024 * 1024, incremental=True):
+        """ Calculate the Mahalanobis distances of many models in a single pass over the features
+        and save them with the models. The features of a block of frames are read (and dequantized)
+        once and then scored by every model.
+
+        The scores are saved with the times of their frames. If frames were appended to the
+        features file since the last run, only the new frames are scored and appended.
+
+        Args:
+            models (list): Anomaly models (need to be generated or loaded)
+            patches (PatchArray): Patches to score
+            block_size (int): Approximate size of the features of a block in bytes
+            incremental (bool): Only score the frames that have no scores yet
+        """
+        frame_size = int(np.prod(patches.shape[1:])) * patches.dtype["features"].shape[-1] * 4
+        frames_per_block = max(1, block_size // frame_size)
+
+        frames = patches.shape[0]
+        times = patches[:, 0, 0].times
+
+        # First frame without scores per model. If the scored frames are not the
+        # first frames of the patches (eg. after removing duplicates), all are scored again
+        firsts = list()
+        for m in models:
+            m.patches = patches
+            scored = m.scored_times() if incremental else None
+            if scored is not None and scored.shape[0] <= frames and np.array_equal(scored, times[:scored.shape[0]]):
+                firsts.append(scored.shape[0])
+            else:
+                firsts.append(0)
+
+        results = [dict() for m in models]
+
+        for start in tqdm(range(min(firsts + [frames]), frames, frames_per_block), desc="Calculating mahalanobis distances", file=sys.stderr):
+            block = patches[start:start + frames_per_block]
+            end = start + block.shape[0]
+            features = block.features
+            for m, first, result in zip(models, firsts, results):
+                if end <= first:
+                    continue
+                offset = max(0, first - start)
+                for name, maha in m.__mahalanobis_distances_block__(block[offset:], features[offset:]).items():
+                    if name not in result:
+                        result[name] = np.full((frames - first,) + patches.shape[1:], np.nan, dtype=np.float64)
+                    result[name][start + offset - first:end - first] = maha
+
+        for m, first, result in zip(models, firsts, results):
+            if first == frames:
+                logger.info("All frames of %s are scored" % m.NAME)
+                continue
+            m.save_mahalanobis_distances(result, first=first)
+        return True
+
+    def save_mahalanobis_distances(self, mahalanobis_distances, first=0):
+        """ Save Mahalanobis distances with the model
+
+        Args:
+            mahalanobis_distances (dict): Dataset name -> Mahalanobis distances of the frames first: of self.patches
+            first (int): Index of the first scored frame. The scores are appended to the
+                         scores of the frames before it, otherwise they are replaced
+        """
+        self.move_to_store()
+
+        times = self.patches[first:, 0, 0].times
+        labels = self.patches.labels[first:]
+
+        with self.patches.store.write(self.NAME, update=True) as hf:
             g = hf.get(self.NAME)
 
             if g is None:
                 raise ValueError("The model needs to be saved first")
-            
-            maha = np.zeros(self.patches.shape, dtype=np.float64)
-            
-            for i in tqdm(np.ndindex(self.patches.shape), desc="Calculating mahalanobis distances", total=self.patches.size, file=sys.stderr):
-                maha[i] = self.__mahalanobis_distance__(self.patches[i])
 
-            no_anomaly = maha[self.patches.labels == 1]
-            anomaly = maha[self.patches.labels == 2]
+            t = g.get("mahalanobis_distances_times")
+            if first == 0:
+                if t is not None: del g["mahalanobis_distances_times"]
+                g.create_dataset("mahalanobis_distances_times", data=times, maxshape=(None,))
+            elif t is None or t.shape[0] != first:
+                raise ValueError("Can only append the scores of frame %i to %s" % (first, self.NAME))
+            else:
+                t.resize((first + times.shape[0],))
+                t[first:] = times
+
+            for name, maha in mahalanobis_distances.items():
+                no_anomaly = maha[labels == 1]
+                anomaly = maha[labels == 2]
+
+                max_no_anomaly = np.nanmax(no_anomaly) if no_anomaly.size > 0 else np.NaN
+                max_anomaly    = np.nanmax(anomaly) if anomaly.size > 0 else np.NaN
 
-            if g.get("mahalanobis_distances") is not None: del g["mahalanobis_distances"]
-            m = g.create_dataset("mahalanobis_distances", data=maha)
-            m.attrs["max_no_anomaly"] = np.nanmax(no_anomaly) if no_anomaly.size > 0 else np.NaN
-            m.attrs["max_anomaly"]    = np.nanmax(anomaly) if anomaly.size > 0 else np.NaN
+                if first == 0:
+                    if g.get(name) is not None: del g[name]
+                    m = g.create_dataset(name, data=maha, maxshape=(None,) + maha.shape[1:], chunks=True)
+                else:
+                    m = g[name]
+                    m.resize(first + maha.shape[0], axis=0)
+                    m[first:] = maha
 
-            logger.info("Saved Mahalanobis distances to file")
-            return True
+                    # The maxima of the frames scored before are kept
+                    max_no_anomaly = np.nanmax([m.attrs["max_no_anomaly"], max_no_anomaly])
+                    max_anomaly    = np.nanmax([m.attrs["max_anomaly"], max_anomaly])
+
+                m.attrs["max_no_anomaly"] = max_no_anomaly
+                m.attrs["max_anomaly"]    = max_anomaly
+
+        logger.info("Saved Mahalanobis distances of %s (from frame %i) to file" % (self.NAME, first))
+        return True
 
     def visualize(self, **kwargs):
         """ Visualize the result of a anomaly model """
@@ -17,6 +17,7 @@ class AnomalyModelMVG(AnomalyModelBase):
         self._var       = None # Covariance matrix Ʃ
         self._varI      = None # Inverse of covariance matrix Ʃ⁻¹
         self._mean      = None # Mean μ
+        self._count     = None # Number of feature vectors (to update the model, see partial_fit)
     
     def classify(self, patch, threshold=None):
         """The anomaly measure is defined as the Mahalanobis distance between a feature sample
@@ -44,8 +45,22 @@ class AnomalyModelMVG(AnomalyModelBase):
             self._varI = np.linalg.inv(self._var)
         return distance.mahalanobis(feature, self._mean, self._varI)
 
+    def __mahalanobis_distances__(self, features):
+        """Calculate the Mahalanobis distances between many inputs (N x D) and the model"""
+        assert not self._var is None and not self._mean is None, \
+            "You need to load a model before computing a Mahalanobis distance"
+
+        # TODO: This is a hack for collapsed MVGs. Should normally not happen
+        if not self._var.any(): # var contains only zeros
+            return np.where(np.all(features == self._mean, axis=-1), 0.0, np.nan)
+
+        if self._varI is None:
+            self._varI = np.linalg.inv(self._var)
+        delta = features - self._mean
+        return np.sqrt(np.sum(np.dot(delta, self._varI) * delta, axis=-1))
+
     def __generate_model__(self, patches, silent=False):
-        if not silent: logger.info("Generating MVG from %i feature vectors of length %i" % (len(patches.ravel()), patches.features.shape[-1]))
+        if not silent: logger.info("Generating MVG from %i feature vectors of length %i" % (len(patches.ravel_roi()), patches.features.shape[-1]))
 
         if not silent and patches.size == 1:
             logger.warning("Trying to generate MVG from a single value.")
@@ -61,6 +76,39 @@ class AnomalyModelMVG(AnomalyModelBase):
         self._mean = patches.mean()
         # --> one mean per feature dimension
 
+        self._count = int(np.count_nonzero(patches.roi))
+
+        return True
+
+    def __partial_fit__(self, patches, silent=False):
+        assert not self._var is None and not self._mean is None, \
+            "You need to load a model before updating it"
+
+        if self._count is None:
+            raise ValueError("%s was saved without the number of feature vectors, it needs to be generated again" % self.NAME)
+
+        features = patches.ravel_roi().features
+        count = features.shape[0]
+
+        if not silent: logger.info("Updating MVG (%i feature vectors) with %i feature vectors" % (self._count, count))
+
+        if count == 0:
+            return True
+
+        mean = np.mean(features, axis=0, dtype=np.float64)
+        delta = features - mean
+        scatter = np.dot(delta.T, delta)
+
+        # Merge the scatter matrices (Chan et al.), Ʃ * (count - 1) is the scatter matrix of the model
+        total = self._count + count
+        delta = mean - self._mean
+        scatter = self._var * (self._count - 1) + scatter + np.outer(delta, delta) * (self._count * count / float(total))
+
+        self._mean  = self._mean + delta * (count / float(total))
+        self._var   = scatter / (total - 1)
+        self._varI  = np.linalg.pinv(self._var)
+        self._count = total
+
         return True
 
     def __load_model_from_file__(self, h5file):
@@ -70,6 +118,7 @@ class AnomalyModelMVG(AnomalyModelBase):
         self._var  = np.array(h5file["var"])
         self._varI = np.array(h5file["varI"])
         self._mean = np.array(h5file["mean"])
+        self._count = int(np.array(h5file["count"])) if "count" in h5file.keys() else None
         return True
     
     def __save_model_to_file__(self, h5file):
@@ -77,6 +126,8 @@ class AnomalyModelMVG(AnomalyModelBase):
         h5file.create_dataset("var",  data=self._var)
         h5file.create_dataset("varI", data=self._varI)
         h5file.create_dataset("mean", data=self._mean)
+        if self._count is not None:
+            h5file.create_dataset("count", data=self._count)
         return True
 
 # Only for tests
@@ -17,6 +17,7 @@ class AnomalyModelSVG(AnomalyModelBase):
         AnomalyModelBase.__init__(self)
         self._var       = None # Variance σ²
         self._mean      = None # Mean μ
+        self._count     = None # Number of feature vectors (to update the model, see partial_fit)
     
     def classify(self, patch, threshold=None):
         """The anomaly measure is defined as the Mahalanobis distance between a feature sample
@@ -49,8 +50,20 @@ class AnomalyModelSVG(AnomalyModelBase):
         #     self._varI = np.linalg.inv(np.diag(self._var))
         # return distance.mahalanobis(feature, self._mean, self._varI)
 
+    def __mahalanobis_distances__(self, features):
+        """Calculate the Mahalanobis distances between many inputs (N x D) and the model"""
+        assert not self._var is None and not self._mean is None, \
+            "You need to load a model before computing a Mahalanobis distance"
+
+        # TODO: This is a hack for collapsed SVGs. Should normally not happen
+        if not self._var.any(): # var contains only zeros
+            return np.where(np.all(features == self._mean, axis=-1), 0.0, np.nan)
+
+        varI = np.divide(1.0, self._var, out=np.zeros_like(self._var), where=self._var!=0)
+        return np.sqrt(np.sum((features - self._mean) ** 2 * varI, axis=-1))
+
     def __generate_model__(self, patches, silent=False):
-        if not silent: logger.info("Generating SVG from %i feature vectors of length %i" % (len(patches.ravel()), patches.features.shape[-1]))
+        if not silent: logger.info("Generating SVG from %i feature vectors of length %i" % (len(patches.ravel_roi()), patches.features.shape[-1]))
 
         if not silent and patches.size == 1:
             logger.warning("Trying to generate SVG from a single value.")
@@ -68,6 +81,37 @@ class AnomalyModelSVG(AnomalyModelBase):
         self._mean = patches.mean()
         # --> one mean per feature dimension
 
+        self._count = int(np.count_nonzero(patches.roi))
+
+        return True
+
+    def __partial_fit__(self, patches, silent=False):
+        assert not self._var is None and not self._mean is None, \
+            "You need to load a model before updating it"
+
+        if self._count is None:
+            raise ValueError("%s was saved without the number of feature vectors, it needs to be generated again" % self.NAME)
+
+        features = patches.ravel_roi().features
+        count = features.shape[0]
+
+        if not silent: logger.info("Updating SVG (%i feature vectors) with %i feature vectors" % (self._count, count))
+
+        if count == 0:
+            return True
+
+        mean = np.mean(features, axis=0, dtype=np.float64)
+        m2 = np.sum((features - mean) ** 2, axis=0)
+
+        # Merge the sums of squared differences (Chan et al.), var * count is the sum of the model
+        total = self._count + count
+        delta = mean - self._mean
+        m2 = self._var * self._count + m2 + delta ** 2 * (self._count * count / float(total))
+
+        self._mean  = self._mean + delta * (count / float(total))
+        self._var   = m2 / total
+        self._count = total
+
         return True
 
     def __load_model_from_file__(self, h5file):
@@ -77,6 +121,7 @@ class AnomalyModelSVG(AnomalyModelBase):
         self._var  = np.array(h5file["var"])
         # self._varI = np.array(h5file["varI"])#np.linalg.pinv(np.diag(self._var))
         self._mean = np.array(h5file["mean"])
+        self._count = int(np.array(h5file["count"])) if "count" in h5file.keys() else None
         assert len(self._var) == len(self._mean), "Dimensions of variance and mean do not match!"
         return True
     
@@ -85,6 +130,8 @@ class AnomalyModelSVG(AnomalyModelBase):
         h5file.create_dataset("var",  data=self._var)
         # h5file.create_dataset("varI", data=self._varI)
         h5file.create_dataset("mean", data=self._mean)
+        if self._count is not None:
+            h5file.create_dataset("count", data=self._count)
         return True
 
 # Only for tests
@@ -9,10 +9,6 @@ import h5py
 import numpy as np
 from tqdm import tqdm
 
-from shapely.strtree import STRtree
-from shapely.geometry import Polygon, box, Point
-from shapely.prepared import prep
-
 from anomalyModelBase import AnomalyModelBase
 from common import utils, logger, PatchArray
 import consts
@@ -37,25 +33,9 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
         # Get extent
         x_min, y_min, x_max, y_max = patches.get_extent(cell_size, fake=fake)
 
-        # Create the bins
-        bins_y = np.arange(y_min, y_max, cell_size)
-        bins_x = np.arange(x_min, x_max, cell_size)
-        
-        shape = (len(bins_y), len(bins_x))
-
-        # Create the grid
-        raster = np.zeros(shape, dtype=object)
-        
-        for v, y in enumerate(bins_y):
-            for u, x in enumerate(bins_x):
-                b = box(x, y, x + cell_size, y + cell_size)#Point(x + cell_size / 2, y + cell_size / 2)# 
-                b.u = u
-                b.v = v
-                b.patches = list()
-                raster[v, u] = b
-            
-        # Create a search tree of spatial boxes
-        self._grid = STRtree(raster.ravel().tolist())
+        # Origin of the grid of the models (moves if the grid grows, see partial_fit)
+        self._origin = (x_min, y_min)
+        self._lookup_patches = None
         
         m = create_anomaly_model_func()
         self.NAME = "SpatialBin/%s/%s" % (m.__class__.__name__.replace("AnomalyModel", ""), self.KEY)
@@ -81,28 +61,128 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
         # Use the mean of Mahalanobis distances to each model
         return np.mean([m.__mahalanobis_distance__(patch) for m in model if m is not None])
 
-    def __mahalanobis_distance_single__(self, patch):
-        """Calculate the Mahalanobis distance between the input and the model in the closest bin"""
-        
-        poly = Polygon([(patch.locations.tl.x, patch.locations.tl.y),
-                        (patch.locations.tr.x, patch.locations.tr.y),
-                        (patch.locations.br.x, patch.locations.br.y),
-                        (patch.locations.bl.x, patch.locations.bl.y)])
-        
-        bin = self._grid.query(poly.centroid)
+    def _single_bins(self, patches):
+        """Indices (into self.models.flat) of the bins that contain the centers of the patches.
+        The grid is regular, so the bin follows from the centroid of the patch location.
+        Centers outside the grid get the closest bin at its edge.
 
-        # # pr = prep(poly)
-        bin = filter(poly.centroid.intersects, bin)
-        
-        if len(bin) == 0:
-            bin = [self._grid.nearest(poly.centroid)]
+        Args:
+            patches (PatchArray, Patch): Patches of any shape or a single patch
 
-        model = self.models[bin[0].v, bin[0].u]
+        Returns:
+            np.array: Bin index for every patch (same shape as patches)
+        """
+        locations = patches["locations"]
+        x = np.stack([locations.tl.x, locations.tr.x, locations.br.x, locations.bl.x], axis=-1).astype(np.float64)
+        y = np.stack([locations.tl.y, locations.tr.y, locations.br.y, locations.bl.y], axis=-1).astype(np.float64)
+
+        # Centroid of the quadrilateral (shoelace formula), the mean of the corners if it has no area
+        x_next = np.roll(x, -1, axis=-1)
+        y_next = np.roll(y, -1, axis=-1)
+        cross = x * y_next - x_next * y
+        area = np.sum(cross, axis=-1) / 2.0
+        degenerate = np.abs(area) < 1e-12
+        area = np.where(degenerate, 1.0, area)
+        center_x = np.where(degenerate, np.mean(x, axis=-1), np.sum((x + x_next) * cross, axis=-1) / (6.0 * area))
+        center_y = np.where(degenerate, np.mean(y, axis=-1), np.sum((y + y_next) * cross, axis=-1) / (6.0 * area))
+
+        # Clipping gives the closest bin of a regular grid
+        v = np.clip(np.floor((center_y - self._origin[1]) / self.CELL_SIZE), 0, self.models.shape[0] - 1).astype(np.int64)
+        u = np.clip(np.floor((center_x - self._origin[0]) / self.CELL_SIZE), 0, self.models.shape[1] - 1).astype(np.int64)
+        return np.ravel_multi_index((v, u), self.models.shape)
+
+    def _offset(self, origin):
+        """Offset (v, u) of a grid with the given origin (x, y) in the grid of the models
+        (the grids of all rasterizations are aligned to the cell size, see PatchArray.get_extent)"""
+        return (int(round((origin[1] - self._origin[1]) / self.CELL_SIZE)),
+                int(round((origin[0] - self._origin[0]) / self.CELL_SIZE)))
+
+    def _bins_lookup(self, patches):
+        """Lookup table from the bins of the rasterization of patches to the bins of the models
+
+        Returns:
+            np.array: Index into self.models.flat (-1 outside the grid of the models) for every
+                      bin of the rasterization or None if both grids are the same
+        """
+        raster_shape = patches.rasterizations[self.KEY].shape
+        dv, du = self._offset(patches.get_extent(self.CELL_SIZE, fake=self.FAKE)[:2])
+        if (dv, du) == (0, 0) and raster_shape == self.models.shape:
+            return None
+
+        v, u = np.indices(raster_shape)
+        v, u = v + dv, u + du
+        inside = np.logical_and(np.logical_and(v >= 0, v < self.models.shape[0]),
+                                np.logical_and(u >= 0, u < self.models.shape[1]))
+        lookup = np.full(raster_shape, -1, dtype=np.int64)
+        lookup[inside] = np.ravel_multi_index((v[inside], u[inside]), self.models.shape)
+        return lookup.ravel()
+
+    def __mahalanobis_distance_single__(self, patch):
+        """Calculate the Mahalanobis distance between the input and the model in the closest bin"""
+        model = self.models.flat[self._single_bins(patch)]
         if model == None:
             # logger.warning("No model available for this bin (%i, %i)" % (patch.bins.v, patch.bins.u))
             return np.nan # TODO: What should we do?
         
         return model.__mahalanobis_distance__(patch)
+
+    def _mahalanobis_distances_bins(self, features, bins):
+        """Mean Mahalanobis distance of every feature to the models of its bins
+
+        Args:
+            features (np.array): Features (N x D)
+            bins (list, np.array): Indices into self.models.flat for every feature
+                                   (or one index per feature as integer array, see _single_bins)
+
+        Returns:
+            np.array: N Mahalanobis distances (NaN if there is no model for any bin)
+        """
+        # Group the features by bin, so every model scores all its features at once
+        if isinstance(bins, np.ndarray) and bins.dtype != object:
+            bin_indices = bins.astype(np.int64)
+            feature_indices = np.arange(len(bin_indices), dtype=np.int64)
+        else:
+            bins = [np.atleast_1d(np.asarray(b, dtype=np.int64)) for b in bins]
+            feature_indices = np.concatenate([np.full(len(b), i, dtype=np.int64) for i, b in enumerate(bins)] + [np.empty(0, dtype=np.int64)])
+            bin_indices = np.concatenate(bins + [np.empty(0, dtype=np.int64)])
+
+        sums = np.zeros(len(bins), dtype=np.float64)
+        counts = np.zeros(len(bins), dtype=np.int64)
+
+        order = np.argsort(bin_indices, kind="mergesort")
+        unique_bins, starts = np.unique(bin_indices[order], return_index=True)
+        for b, indices in zip(unique_bins, np.split(feature_indices[order], starts[1:])):
+            model = self.models.flat[b] if b >= 0 else None
+            if model is None:
+                continue
+            sums[indices] += model.__mahalanobis_distances__(features[indices])
+            counts[indices] += 1
+
+        maha = np.full(len(bins), np.nan, dtype=np.float64)
+        maha[counts > 0] = sums[counts > 0] / counts[counts > 0]
+        return maha
+
+    def __mahalanobis_distances_block__(self, block, features):
+        """Calculate the Mahalanobis distances of a block of frames (NaN outside the region of interest):
+        The mean distance to the models of all bins that intersect the receptive field and the distance
+        to the model of the bin that contains the center of the patch ("Single")"""
+        maha = np.full(block.shape, np.nan, dtype=np.float64)
+        maha_single = np.full(block.shape, np.nan, dtype=np.float64)
+
+        # The models might have been updated with patches of a larger extent (see partial_fit)
+        if self._lookup_patches is not self.patches:
+            self._lookup = self._bins_lookup(self.patches)
+            self._lookup_patches = self.patches
+
+        roi = block.roi
+        if roi.any():
+            bins = block["bins_" + self.KEY][roi]
+            if self._lookup is not None:
+                bins = [self._lookup[b] for b in bins]
+            maha[roi] = self._mahalanobis_distances_bins(features[roi], bins)
+            maha_single[roi] = self._mahalanobis_distances_bins(features[roi], self._single_bins(block)[roi])
+
+        return {"mahalanobis_distances": maha, "Single/mahalanobis_distances": maha_single}
     
     def filter_training(self, patches):
         return patches
@@ -122,6 +202,8 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
 
         # Empty grid that will contain the model for each bin
         self.models = np.empty(shape=raster.shape, dtype=object)
+        self._origin = patches.get_extent(self.CELL_SIZE, fake=self.FAKE)[:2]
+        self._lookup_patches = None
         models_created = 0
 
         with tqdm(desc="Generating models", total=self.models.size, file=sys.stderr) as pbar:
@@ -139,6 +221,56 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
                         pbar.set_postfix({"Models": models_created})
                 pbar.update()
         return True
+
+    def __partial_fit__(self, patches, silent=False):
+        assert patches.contains_features, "Can only update the models if there are patches"
+        assert patches.contains_locations, "Can only update the models if there are locations calculated"
+
+        # Check if cell size rasterization is already calculated
+        if not self.KEY in patches.contains_bins.keys() or not patches.contains_bins[self.KEY]:
+            patches.calculate_rasterization(self.CELL_SIZE, self.FAKE)
+
+        patches_flat = patches.ravel()
+
+        raster = patches.rasterizations[self.KEY]
+
+        # Grow the grid of the models if the new patches are outside
+        dv, du = self._offset(patches.get_extent(self.CELL_SIZE, fake=self.FAKE)[:2])
+        v_min, u_min = min(0, dv), min(0, du)
+        v_max = max(self.models.shape[0], dv + raster.shape[0])
+        u_max = max(self.models.shape[1], du + raster.shape[1])
+
+        if (v_min, u_min, v_max, u_max) != (0, 0) + tuple(self.models.shape):
+            models = np.empty(shape=(v_max - v_min, u_max - u_min), dtype=object)
+            models[-v_min:self.models.shape[0] - v_min, -u_min:self.models.shape[1] - u_min] = self.models
+            self.models = models
+            self._origin = (self._origin[0] + u_min * self.CELL_SIZE, self._origin[1] + v_min * self.CELL_SIZE)
+            dv, du = dv - v_min, du - u_min
+            logger.info("Grew the grid of %s to %i x %i bins" % (self.NAME, self.models.shape[0], self.models.shape[1]))
+
+        self._lookup_patches = None
+
+        models_updated = 0
+
+        with tqdm(desc="Updating models", total=raster.size, file=sys.stderr) as pbar:
+            for v, u in np.ndindex(raster.shape):
+                indices = raster[v, u]
+
+                if len(indices) > 0:
+                    model_input = AnomalyModelBase.filter_training(self, patches_flat[indices])
+                    if model_input.size > 0:
+                        model = self.models[v + dv, u + du]
+                        if model is None:
+                            # Create a new model for a bin without one
+                            model = self.CREATE_ANOMALY_MODEL_FUNC()
+                            model.__generate_model__(model_input, silent=silent)
+                            self.models[v + dv, u + du] = model
+                        elif model.__partial_fit__(model_input, silent=silent) == False:
+                            return False
+                        models_updated += 1
+                        pbar.set_postfix({"Models": models_updated})
+                pbar.update()
+        return True
     
     def __load_model_from_file__(self, h5file):
         """Load a SVG model from file"""
@@ -148,6 +280,11 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
             return False
         
         self.CELL_SIZE = h5file.attrs["Cell size"]
+
+        # Older models use the grid of the rasterization
+        if "Origin" in h5file.attrs.keys():
+            self._origin = tuple(h5file.attrs["Origin"])
+        self._lookup_patches = None
         
         self.models = np.empty(shape=h5file.attrs["Models shape"], dtype=object)
 
@@ -170,6 +307,7 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
     def __save_model_to_file__(self, h5file):
         """Save the model to disk"""
         h5file.attrs["Cell size"] = self.CELL_SIZE
+        h5file.attrs["Origin"] = self._origin
         h5file.attrs["Models shape"] = self.models.shape
         
         models_count = 0
@@ -184,48 +322,6 @@ class AnomalyModelSpatialBinsBase(AnomalyModelBase):
         h5file.attrs["Num models"] = models_count
         return True
     	
-    def calculate_mahalanobis_distances(self):
-        """ Calculate all the Mahalanobis distances and save them to the file """
-        with h5py.File(self.patches.filename, "r+") as hf:
-            ### Calculate Mahalanobis distances based on a single bin
-            g = hf.get(self.NAME)
-
-            if g is None:
-                raise ValueError("The model needs to be saved first")
-            
-            maha = np.zeros(self.patches.shape, dtype=np.float64)
-            
-            for i in tqdm(np.ndindex(self.patches.shape), desc="Calculating mahalanobis distances (mean)", total=self.patches.size, file=sys.stderr):
-                maha[i] = self.__mahalanobis_distance__(self.patches[i])
-
-            no_anomaly = maha[self.patches.labels == 1]
-            anomaly = maha[self.patches.labels == 2]
-
-            if g.get("mahalanobis_distances") is not None: del g["mahalanobis_distances"]
-            m = g.create_dataset("mahalanobis_distances", data=maha)
-            m.attrs["max_no_anomaly"] = np.nanmax(no_anomaly) if no_anomaly.size > 0 else np.NaN
-            m.attrs["max_anomaly"]    = np.nanmax(anomaly) if anomaly.size > 0 else np.NaN
-
-            logger.info("Saved Mahalanobis distances to file")
-            
-            ### Calculate Mahalanobis distances based on a single bin
-            maha = np.zeros(self.patches.shape, dtype=np.float64)
-            
-            for i in tqdm(np.ndindex(self.patches.shape), desc="Calculating mahalanobis distances (single)", total=self.patches.size, file=sys.stderr):
-                maha[i] = self.__mahalanobis_distance_single__(self.patches[i])
-
-            no_anomaly = maha[self.patches.labels == 1]
-            anomaly = maha[self.patches.labels == 2]
-
-            if g.get("Single/mahalanobis_distances") is not None: del g["Single/mahalanobis_distances"]
-            m = g.create_dataset("Single/mahalanobis_distances", data=maha)
-            m.attrs["max_no_anomaly"] = np.nanmax(no_anomaly) if no_anomaly.size > 0 else np.NaN
-            m.attrs["max_anomaly"]    = np.nanmax(anomaly) if anomaly.size > 0 else np.NaN
-
-            logger.info("Saved Mahalanobis distances to file")
-
-            return True
-
         
 # Only for tests
 if __name__ == "__main__":
@@ -1,5 +1,9 @@
 from imageLocationUtility import ImageLocationUtility
+from artifactStore import ArtifactStore
 from patchArray import PatchArray, Patch
+from jobScheduler import JobScheduler
+from pipeline import Pipeline
+from workQueue import WorkQueue
 import utils as utils
 from visualize import Visualize
 import logger as logger
\ No newline at end of file
@@ -0,0 +1,174 @@
+import os
+import json
+import fcntl
+import shutil
+from contextlib import contextmanager
+
+import h5py
+
+from common import utils
+
+class ArtifactStore(object):
+    """Everything that is computed from a features file (models, Mahalanobis distances,
+    patch locations, rasterizations, patch labels) is saved next to it in a directory
+    "{features file}.store" with one small HDF5 file per artifact. The features file itself
+    stays read-only.
+
+    Artifacts are written to a temporary file that is renamed when it is complete, so
+    readers never see half written artifacts, replacing an artifact reclaims its space and
+    many processes can write different artifacts of the same features file at the same time.
+
+    Each artifact file uses the layout the features file would have (eg. the model "SVG" is
+    the group "SVG", the locations are the dataset "locations"), so loading only needs to
+    merge the files (see PatchArray).
+    """
+
+    FINGERPRINTS = "fingerprints.json"
+    FINGERPRINTS_LOCK = "fingerprints.json.lock"
+
+    def __init__(self, features_file):
+        """Store of a features file
+
+        Args:
+            features_file (str): Features file (*.h5)
+        """
+        self.features_file = features_file
+        self.path = os.path.splitext(features_file)[0] + ".store"
+
+    def filename(self, key):
+        """File of an artifact (keys can contain "/", eg. "SpatialBin/SVG/0.20")"""
+        return os.path.join(self.path, key.replace("/", "__") + ".h5")
+
+    def _prepare(self):
+        """Only for internal use (creates the store directory)"""
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError: # Created by another process meanwhile
+                if not os.path.isdir(self.path):
+                    raise
+
+    def keys(self):
+        """All artifacts in the store"""
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(f[:-len(".h5")].replace("__", "/") for f in os.listdir(self.path) if f.endswith(".h5"))
+
+    def __contains__(self, key):
+        return os.path.exists(self.filename(key))
+
+    def read(self, key):
+        """Open an artifact for reading
+
+        Returns:
+            h5py.File
+        """
+        return h5py.File(self.filename(key), "r")
+
+    @contextmanager
+    def write(self, key, update=False):
+        """Write an artifact. The old artifact is replaced once the new one is complete.
+
+        Args:
+            key (str): Artifact name
+            update (bool): Start with a copy of the existing artifact instead of an empty file
+
+        Yields:
+            h5py.File
+        """
+        self._prepare()
+
+        filename = self.filename(key)
+        temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+
+        if update and os.path.exists(filename):
+            shutil.copyfile(filename, temp_filename)
+            hf = h5py.File(temp_filename, "a")
+        else:
+            hf = h5py.File(temp_filename, "w")
+
+        try:
+            yield hf
+        except:
+            hf.close()
+            os.remove(temp_filename)
+            raise
+
+        hf.close()
+        os.rename(temp_filename, filename)
+
+    def delete(self, key):
+        """Remove an artifact"""
+        if key in self:
+            os.remove(self.filename(key))
+
+    ################
+    # Fingerprints #
+    ################
+
+    def _read_fingerprints(self):
+        """Only for internal use"""
+        filename = os.path.join(self.path, self.FINGERPRINTS)
+        if not os.path.exists(filename):
+            return {"artifacts": {}, "files": {}}
+        with open(filename, "r") as f:
+            return json.load(f)
+
+    @contextmanager
+    def _fingerprints_lock(self):
+        """Only for internal use (exclusive lock of the fingerprints file for all processes,
+        also on other machines that share the file system)"""
+        self._prepare()
+        with open(os.path.join(self.path, self.FINGERPRINTS_LOCK), "a") as f:
+            fcntl.lockf(f, fcntl.LOCK_EX) # Released when the file is closed
+            yield
+
+    def _update_fingerprints(self, section, key, value):
+        """Only for internal use (the file is replaced atomically, the lock makes sure that
+        no update of a concurrent writer is lost between reading and replacing it)"""
+        with self._fingerprints_lock():
+            fingerprints = self._read_fingerprints()
+            fingerprints[section][key] = value
+
+            filename = os.path.join(self.path, self.FINGERPRINTS)
+            temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+            with open(temp_filename, "w") as f:
+                json.dump(fingerprints, f, indent=4, sort_keys=True)
+            os.rename(temp_filename, filename)
+
+    def fingerprint(self, key):
+        """Fingerprint of the inputs and parameters an artifact was calculated with (see Pipeline)
+
+        Returns:
+            str or None if the artifact has no fingerprint
+        """
+        return self._read_fingerprints()["artifacts"].get(key, None)
+
+    def fingerprints(self):
+        """Fingerprints of all artifacts
+
+        Returns:
+            dict: Artifact name -> fingerprint
+        """
+        return self._read_fingerprints()["artifacts"]
+
+    def set_fingerprint(self, key, fingerprint):
+        """Save the fingerprint of the inputs and parameters an artifact was calculated with"""
+        self._update_fingerprints("artifacts", key, fingerprint)
+
+    def file_hash(self, filename):
+        """Hash of the content of an input file (eg. the features file). The hash is only
+        calculated again if the size or modification time of the file changed.
+
+        Returns:
+            str
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        cached = self._read_fingerprints()["files"].get(filename, None)
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+            return cached["hash"]
+
+        h = utils.file_hash(filename)
+        self._update_fingerprints("files", filename, {"size": stat.st_size, "mtime": stat.st_mtime, "hash": h})
+        return h
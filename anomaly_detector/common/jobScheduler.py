@@ -0,0 +1,157 @@
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+from tqdm import tqdm
+
+from common import logger
+
+class JobScheduler(object):
+    """Runs jobs that depend on each other in parallel processes.
+
+    Every job runs in a process that is forked from the scheduling process when the job
+    starts. It therefore shares everything the scheduling process has loaded (eg. the
+    PatchArray of a features file) instead of loading its own copy; memory pages are only
+    copied when a job writes to them. Jobs have to save their results themselves (eg. to
+    the ArtifactStore). The on_done callback of a job runs in the scheduling process, so
+    the jobs started afterwards can see its results (see PatchArray.refresh_artifacts).
+
+    The number of parallel jobs is bounded by the number of workers and by the memory the
+    running jobs need in addition to the shared memory.
+    """
+
+    def __init__(self, workers=None, memory=None):
+        """Create a new scheduler
+
+        Args:
+            workers (int): Maximum number of parallel jobs (default: number of CPU cores)
+            memory (int): Memory in bytes the running jobs may use together (default: 80% of the available memory)
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        if memory is None:
+            from psutil import virtual_memory
+            memory = int(virtual_memory().available * 0.8)
+
+        self.workers   = max(1, workers)
+        self.memory    = memory
+        self.jobs      = OrderedDict()
+        self.durations = dict() # Job name -> seconds (set by run)
+
+    def add(self, name, func, args=(), kwargs=None, deps=(), memory=0, on_done=None):
+        """Add a job. Jobs are started in the order they were added once their dependencies succeeded.
+
+        Args:
+            name (str): Unique name of the job
+            func (callable): Function that is called in the job process
+            args (tuple): Arguments for func
+            kwargs (dict): Keyword arguments for func
+            deps (list): Names of the jobs that have to succeed before this job can start
+            memory (int): Memory in bytes the job needs in addition to the shared memory
+            on_done (callable): Called without arguments in the scheduling process when the job succeeded
+
+        Returns:
+            The name of the job (to be used in deps)
+        """
+        if name in self.jobs:
+            raise ValueError("There already is a job %s" % name)
+
+        for d in deps:
+            if d not in self.jobs:
+                raise ValueError("%s depends on the unknown job %s" % (name, d))
+
+        self.jobs[name] = {
+            "func": func,
+            "args": tuple(args),
+            "kwargs": kwargs if kwargs is not None else dict(),
+            "deps": list(deps),
+            "memory": memory,
+            "on_done": on_done
+        }
+        return name
+
+    def _run_job(self, name):
+        """Only for internal use (runs in the forked job process)"""
+        job = self.jobs[name]
+        try:
+            job["func"](*job["args"], **job["kwargs"])
+        except (KeyboardInterrupt, SystemExit):
+            sys.exit(1)
+        except:
+            logger.error("%s: %s" % (name, traceback.format_exc()))
+            sys.exit(1)
+
+    def run(self):
+        """Run all jobs. A job whose dependencies failed is skipped.
+
+        Returns:
+            dict: Job name -> True (succeeded), False (failed) or None (skipped)
+        """
+        pending = list(self.jobs.keys())
+        running = OrderedDict()
+        started = dict()
+        result  = dict()
+
+        with tqdm(total=len(pending), desc="Jobs", file=sys.stderr) as pbar:
+            try:
+                while len(pending) > 0 or len(running) > 0:
+                    changed = False
+
+                    # Collect finished jobs
+                    for name, process in list(running.items()):
+                        if process.is_alive():
+                            continue
+                        process.join()
+                        del running[name]
+                        changed = True
+
+                        self.durations[name] = time.time() - started[name]
+
+                        result[name] = process.exitcode == 0
+                        if result[name]:
+                            if self.jobs[name]["on_done"] is not None:
+                                self.jobs[name]["on_done"]()
+                        else:
+                            logger.error("Job %s failed" % name)
+                        pbar.update()
+
+                    # Skip jobs whose dependencies failed (or were skipped)
+                    for name in list(pending):
+                        if any(d in result and not result[d] for d in self.jobs[name]["deps"]):
+                            logger.warning("Skipping %s" % name)
+                            pending.remove(name)
+                            result[name] = None
+                            changed = True
+                            pbar.update()
+
+                    # Start jobs whose dependencies succeeded while there are workers and memory
+                    for name in list(pending):
+                        if len(running) >= self.workers:
+                            break
+                        job = self.jobs[name]
+                        if not all(result.get(d, False) for d in job["deps"]):
+                            continue
+                        memory_used = sum(self.jobs[n]["memory"] for n in running.keys())
+                        if len(running) > 0 and memory_used + job["memory"] > self.memory:
+                            continue
+
+                        pbar.set_description(name)
+                        process = multiprocessing.Process(target=self._run_job, args=(name,), name=name)
+                        started[name] = time.time()
+                        process.start()
+                        running[name] = process
+                        pending.remove(name)
+                        changed = True
+
+                    if not changed:
+                        time.sleep(0.05)
+            except:
+                for process in running.values():
+                    process.terminate()
+                raise
+
+        return result
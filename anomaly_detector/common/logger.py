@@ -8,8 +8,8 @@ import os
 import logging
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # or any {'0', '1', '2'}
 
-import tensorflow as tf
-tf_logger = tf.get_logger()
+# Configure the TensorFlow logger without importing TensorFlow (slow)
+tf_logger = logging.getLogger("tensorflow")
 tf_logger.setLevel(logging.ERROR)
 for i in range(len(tf_logger.handlers)):
     tf_logger.removeHandler(tf_logger.handlers[i])
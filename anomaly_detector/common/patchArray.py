@@ -8,47 +8,59 @@ from glob import glob
 from cachetools import cached, Cache, LRUCache
 from datetime import datetime
 
-import matplotlib as mpl
-mpl.rcParams['savefig.dpi'] = 300
-mpl.rcParams['font.family'] = 'sans-serif'
-mpl.rcParams['font.sans-serif'] = ['Arial']
-
 import numpy as np
 import numpy.lib.recfunctions
 import h5py
 from tqdm import tqdm
-from tqdm.contrib.concurrent import process_map
-import matplotlib.pyplot as plt
 import cv2
-from skimage.transform import resize
-
-from shapely.strtree import STRtree
-from shapely.geometry import Polygon, box, Point
-from shapely.prepared import prep
 
-from scipy.ndimage.morphology import generate_binary_structure, grey_erosion, grey_dilation
-from sklearn import metrics
-from sklearn.manifold import TSNE
-import seaborn as sns
-import pandas as pd
-from joblib import Parallel, delayed
+# matplotlib, seaborn, pandas, sklearn, shapely, skimage and joblib are slow to
+# import and are only imported in the methods that need them
 
-from common import utils, logger, ImageLocationUtility
+from common import utils, logger, ImageLocationUtility, ArtifactStore
 import consts
 
+def _import_pyplot():
+    """Import matplotlib with the settings used for all plots"""
+    import matplotlib as mpl
+    mpl.rcParams['savefig.dpi'] = 300
+    mpl.rcParams['font.family'] = 'sans-serif'
+    mpl.rcParams['font.sans-serif'] = ['Arial']
+    import matplotlib.pyplot as plt
+    return plt
+
 class Patch(np.record):
     """A single feature vector (patch) with metadata."""
 
+    # Quantization of the stored features (set by PatchArray, None if not quantized)
+    feature_scale  = None
+    feature_offset = None
+
     # image_cache = LRUCache(maxsize=20*60*2)  # Least recently used cache for images
 
     # @cached(image_cache, key=lambda self, *args: self.times) # The cache should only be based on the timestamp
     def get_image(self, images_path=None):
-        return cv2.imread(self.get_image_path(images_path))
+        if images_path is None: images_path = consts.IMAGES_PATH
+        image_path = self.get_image_path(images_path)
+        if not os.path.exists(image_path):
+            # Images that were only written to TFRecord files (see 01_rosbag_to_images.py --format tfrecord)
+            return utils.find_tfrecord_image(images_path, int(self.times))
+        return cv2.imread(image_path)
 
     def get_image_path(self, images_path=None):
         if images_path is None: images_path = consts.IMAGES_PATH
         return os.path.join(images_path, "%i.jpg" % self.times)
 
+    @property
+    def features(self):
+        """Feature vector upcast to float32 (features might be stored as float16 or int8)"""
+        return utils.dequantize_features(np.record.__getitem__(self, "features"), self.feature_scale, self.feature_offset)
+
+    def __getitem__(self, indx):
+        if indx == "features":
+            return self.features
+        return np.record.__getitem__(self, indx)
+
     def __setattr__(self, attr, val):
         if attr in self.dtype.names:
             old_val = self.__getattribute__(attr)
@@ -103,12 +115,19 @@ class PatchArray(np.recarray):
         if len(metadata) == 0:
             raise ValueError("There should be at least a bit of metadata!")
 
+        # Skip frames that are marked as duplicates (see 01b_remove_duplicates.py)
+        if "duplicates" in metadata.keys():
+            not_duplicate = metadata["duplicates"] == 0
+            for n, m in metadata.items():
+                metadata[n] = m[not_duplicate]
+
         # Add missing datasets
         metadata["changed"] = np.zeros_like(metadata["labels"], dtype=np.bool)
 
         contains_features     = False
         contains_locations    = False
         contains_patch_labels = False
+        contains_roi          = False
         contains_bins         = {"fake_0.20": False, "fake_0.50": False, "fake_2.00": False, "0.20": False, "0.50": False, "2.00": False}
         rasterizations        = {"fake_0.20": None, "fake_0.50": None, "fake_2.00": None, "0.20": None, "0.50": None, "2.00": None}
         
@@ -116,20 +135,27 @@ class PatchArray(np.recarray):
 
         receptive_field = None
         image_size = None
+        feature_scale = None
+        feature_offset = None
 
         # Check if file is h5 file
         if isinstance(filename, str) and filename.endswith(".h5"):
             s = time.time()
-            with h5py.File(filename, "r") as hf:
+            with utils.open_feature_file(filename) as hf:
                 logger.info("Opening %s: %f" % (filename, time.time() - s))
 
                 receptive_field = hf.attrs.get("Receptive field", None)
                 image_size = hf.attrs.get("Image size", None)
 
+                # The file might still be written (or the extraction was interrupted)
+                rows = utils.feature_rows_written(hf)
+                if rows < hf["times"].shape[0]:
+                    logger.info("Only %i of %i frames in %s are completed" % (rows, hf["times"].shape[0], filename))
+
                 # Metadata and Features are assumed to be sorted by time
                 # But the features might only be a subset (think temporal patches, C3D)
                 # So we first get the times and match them against each other
-                feature_times = np.array(hf["times"])
+                feature_times = np.array(hf["times"][:rows])
                 common_times, metadata_indices, feature_indices = np.intersect1d(metadata["times"], feature_times, assume_unique=True, return_indices=True)
                 # Now we filter the metadata (there could be more metadata than features, eg. C3D)
                 if common_times.shape != metadata["times"].shape or np.any(metadata_indices != np.arange(len(metadata_indices))):
@@ -138,30 +164,69 @@ class PatchArray(np.recarray):
 
                 # Test if everything worked out
                 assert np.all(feature_times[feature_indices] == metadata["times"]), "Something went wrong"
-                assert np.all(feature_indices == np.arange(len(feature_indices))), "Oops?"
+
+                # There could also be features without metadata, eg. frames that were marked as
+                # duplicates after the extraction (see 01b_remove_duplicates.py). Only the rows
+                # of the features file that have metadata are loaded
+                frames = len(feature_indices)
+                selected = None if frames == rows else feature_indices
+                if selected is not None:
+                    logger.info("Skipping %i frames of %s without metadata" % (rows - frames, filename))
+
+                def _rows(y):
+                    """Rows of a dataset that have metadata (artifacts calculated from a loaded PatchArray only contain them)"""
+                    if selected is None or y.shape[0] == frames:
+                        return y if y.shape[0] == frames else y[:frames]
+                    return y[selected]
 
                 patches_dict = dict()
                 mahalanobis_dict = dict()
+                rasterization_dict = dict()
 
                 add = ["features", "locations", "fake_locations", "patch_labels"]
 
-                def _add(x, y):
+                def _add(x, y, load=False):
                     if not isinstance(y, h5py.Dataset):
                         return
                     if x in add or x.startswith("bins"):
-                        patches_dict[x] = y
+                        patches_dict[x] = _rows(y)
+                        if load:
+                            patches_dict[x] = numpy.array(patches_dict[x])
+                    elif x.startswith("rasterization_") and not x.endswith("_count"):
+                        rasterization_dict[x.replace("rasterization_", "", 1)] = numpy.array(y)
                     elif x.endswith("/mahalanobis_distances"):
                         n = x.replace("/mahalanobis_distances", "")
                         if "balanced_distribution" in y.parent.keys():
                             bd = y.parent["balanced_distribution"]
                             n = "%s/%i" % (n, bd.shape[0])
-                        mahalanobis_dict[n] = numpy.array(y)
+                        # Newer scores are saved with the times of their frames (see AnomalyModelBase.save_mahalanobis_distances)
+                        t = y.parent.get("mahalanobis_distances_times", None)
+                        if t is None and y.parent.name != "/":
+                            t = y.parent.parent.get("mahalanobis_distances_times", None)
+                        if t is None:
+                            mahalanobis_dict[n] = numpy.array(_rows(y))
+                        else:
+                            mahalanobis_dict[n] = np.full((frames,) + y.shape[1:], np.nan, dtype=y.dtype)
+                            _, frame_indices, score_indices = np.intersect1d(metadata["times"], np.array(t), assume_unique=True, return_indices=True)
+                            mahalanobis_dict[n][frame_indices] = numpy.array(y)[score_indices]
                         mahalanobis_dict[n][np.isnan(mahalanobis_dict[n])] = -1
 
                 hf.visititems(_add)
 
+                # Everything computed later is in the artifact store (older files contain it themselves)
+                store = ArtifactStore(filename)
+                for key in store.keys():
+                    with store.read(key) as af:
+                        af.visititems(lambda x, y: _add(x, y, load=True))
+
                 if "features" in patches_dict.keys():
                     contains_features = True
+
+                    # Features are kept in their storage dtype and only upcast when accessed
+                    if "scale" in hf["features"].attrs.keys():
+                        feature_scale = np.array(hf["features"].attrs["scale"])
+                        feature_offset = np.array(hf["features"].attrs["offset"])
+
                     if patches_dict["features"].ndim == 2:
                         patches_dict["features"] = np.expand_dims(np.expand_dims(patches_dict["features"], axis=1), axis=2)
                 else:
@@ -191,6 +256,13 @@ class PatchArray(np.recarray):
                     patches_dict["patch_labels"] = np.zeros(locations_shape, dtype=np.uint8)
                     patches_dict["patch_labels_values"] = np.zeros(locations_shape)
 
+                # Patches outside the region of interest are skipped by the anomaly models
+                if "roi" in hf.keys() and hf["roi"].shape == locations_shape[1:]:
+                    contains_roi = True
+                    patches_dict["roi"] = np.broadcast_to(np.array(hf["roi"], dtype=np.bool), locations_shape)
+                else:
+                    patches_dict["roi"] = np.ones(locations_shape, dtype=np.bool)
+
                 if len(mahalanobis_dict) > 0:
                     contains_mahalanobis_distances = True
                     t = [(x, mahalanobis_dict[x].dtype) for x in mahalanobis_dict]
@@ -198,9 +270,9 @@ class PatchArray(np.recarray):
                     patches_dict["mahalanobis_distances_filtered"] = np.zeros(locations_shape, dtype=np.float64)
                 
                 for k in contains_bins.keys():
-                    if ("bins_" + k) in patches_dict.keys():
+                    if ("bins_" + k) in patches_dict.keys() and k in rasterization_dict.keys():
                         contains_bins[k] = True
-                        rasterizations[k] = np.array(hf["rasterization_" + k])
+                        rasterizations[k] = rasterization_dict[k]
                     else:
                         contains_bins[k] = False
                         patches_dict["bins_" + k] = np.zeros(locations_shape, dtype=object)
@@ -236,13 +308,19 @@ class PatchArray(np.recarray):
         obj.images_path     = images_path
         obj.receptive_field = receptive_field
         obj.image_size      = image_size
+        obj.feature_scale   = feature_scale
+        obj.feature_offset  = feature_offset
         obj.contains_features     = contains_features
         obj.contains_locations    = contains_locations
         obj.contains_bins         = contains_bins
         obj.contains_patch_labels = contains_patch_labels
+        obj.contains_roi          = contains_roi
         obj.rasterizations        = rasterizations
         obj.contains_mahalanobis_distances = contains_mahalanobis_distances
 
+        Patch.feature_scale  = feature_scale
+        Patch.feature_offset = feature_offset
+
         cls.root = obj
 
         return obj
@@ -255,10 +333,13 @@ class PatchArray(np.recarray):
         self.images_path           = getattr(obj, "images_path", consts.IMAGES_PATH)
         self.receptive_field       = getattr(obj, "receptive_field", None)
         self.image_size            = getattr(obj, "image_size", 224)
+        self.feature_scale         = getattr(obj, "feature_scale", None)
+        self.feature_offset        = getattr(obj, "feature_offset", None)
         self.contains_features     = getattr(obj, "contains_features", False)
         self.contains_locations    = getattr(obj, "contains_locations", False)
         self.contains_bins         = getattr(obj, "contains_bins", {"0.20": False, "0.50": False, "2.00": False})
         self.contains_patch_labels = getattr(obj, "contains_patch_labels", False)
+        self.contains_roi          = getattr(obj, "contains_roi", False)
         self.rasterizations        = getattr(obj, "rasterizations", {"0.20": None, "0.50": None, "2.00": None})
         self.contains_mahalanobis_distances = getattr(obj, "contains_mahalanobis_distances", False)
     
@@ -280,8 +361,16 @@ class PatchArray(np.recarray):
         else:
             object.__setattr__(self, attr, val)
 
+    @property
+    def features(self):
+        """Feature vectors upcast to float32 (features might be stored as float16 or int8)"""
+        return utils.dequantize_features(np.recarray.__getitem__(self, "features"), self.feature_scale, self.feature_offset)
+
     def __getitem__(self, indx):
         """Cast patches to the correct class"""
+        if isinstance(indx, str) and indx == "features":
+            return self.features
+
         obj = np.recarray.__getitem__(self, indx)
 
         if isinstance(obj, np.record):
@@ -443,6 +532,8 @@ class PatchArray(np.recarray):
             grid (STRtree): Search tree with all (rectangle) cells
             shape (int, int): Grid shape
         """
+        from shapely.strtree import STRtree
+        from shapely.geometry import box
         key = "%.2f" % cell_size
         if fake: key = "fake_" + key
 
@@ -486,12 +577,19 @@ class PatchArray(np.recarray):
         Returns:
             None
         """
+        from shapely.geometry import Polygon
         locations_key = "locations"
         if fake: locations_key = "fake_" + locations_key
 
+        bins = None
         for y, x in np.ndindex(self.shape[1:]):
+            # Patches outside the region of interest are not binned
+            if self.contains_roi and not self[i, y, x].roi:
+                self[i, y, x]["bins_" + key] = np.array([], dtype=np.uint32)
+                continue
+
             # Calculate a new intersection
-            if fake or rf_factor < 2 or (y, x) == (0, 0):
+            if fake or rf_factor < 2 or bins is None:
                 f = self[i, y, x]
                 poly = Polygon([(f[locations_key].tl.x, f[locations_key].tl.y),
                                 (f[locations_key].tr.x, f[locations_key].tr.y),
@@ -516,7 +614,7 @@ class PatchArray(np.recarray):
             self[i, y, x]["bins_" + key] = np.array(list(_loop()), dtype=np.uint32)
 
     def _save_rasterization(self, key, grid, shape, start=None, end=None):
-        """Save the spatial binning result to the currently opened features file
+        """Save the spatial binning result to the artifact store of the currently opened features file
 
         Args:
             key (str): Metadata key where the bin information is stored
@@ -528,27 +626,12 @@ class PatchArray(np.recarray):
         Returns:
             None
         """
-        logger.info("Opening %s" % self.filename)
-        # Save to file
-        with h5py.File(self.filename, "r+") as hf:
-            # Remove the old dataset
-            if "bins_" + key in hf.keys():
-                logger.info("Deleting old bins_%s from file" % key)
-                del hf["bins_" + key]
-            
-            logger.info("Writing bins_%s to file" % key)
+        # Save to the store (replaces the old rasterization)
+        with self.store.write("rasterization_" + key) as hf:
+            logger.info("Writing bins_%s to %s" % (key, self.store.path))
             hf.create_dataset("bins_" + key, data=self["bins_" + key], dtype=h5py.vlen_dtype(np.uint32))
             
-            # Remove the old dataset
-            if "rasterization_" + key in hf.keys():
-                logger.info("Deleting old rasterization_%s from file" % key)
-                del hf["rasterization_" + key]
-
-            if "rasterization_" + key + "_count" in hf.keys():
-                logger.info("Deleting old rasterization_%s_count from file" % key)
-                del hf["rasterization_" + key + "_count"]
-            
-            logger.info("Writing rasterization_%s and rasterization_%s_count to file" % (key, key))
+            logger.info("Writing rasterization_%s and rasterization_%s_count to %s" % (key, key, self.store.path))
             rasterization       = hf.create_dataset("rasterization_" + key,            shape=shape, dtype=h5py.vlen_dtype(np.uint32))
             rasterization_count = hf.create_dataset("rasterization_" + key + "_count", shape=shape, dtype=np.uint16)
 
@@ -562,21 +645,23 @@ class PatchArray(np.recarray):
                 hf["rasterization_" + key].attrs["Duration"] = end - start
                 hf["rasterization_" + key].attrs["Duration (formatted)"] = utils.format_duration(end - start)
 
-    def calculate_rasterization(self, cell_size, fake=False):
+    def calculate_rasterization(self, cell_size, fake=False, force=False):
         """Calculate the corresponding spatial bins for each patch.
 
         Args:
             cell_size (float): Spatial bin size
             fake (bool): Use simple non-overlapping receptive field
+            force (bool): Calculate again even if the rasterization is already calculated (eg. because the locations changed)
 
         Returns:
             None
         """
+        from joblib import Parallel, delayed
         key = "%.2f" % cell_size
         if fake: key = "fake_" + key
 
         # Check if cell size is already calculated
-        if key in self.contains_bins.keys() and self.contains_bins[key]:
+        if not force and key in self.contains_bins.keys() and self.contains_bins[key]:
             return self["bins_" + key]
         
         grid, shape = self._calculate_grid(cell_size, fake=fake)
@@ -730,7 +815,7 @@ class PatchArray(np.recarray):
         return np.rec.fromarrays(res.transpose(), dtype=self.locations.dtype) # No transpose here smh
 
     def _save_patch_locations(self, key, start=None, end=None):
-        """Save the patch locations to the currently opened features file
+        """Save the patch locations to the artifact store of the currently opened features file
 
         Args:
             key (str): Metadata key where the location information is stored
@@ -740,11 +825,7 @@ class PatchArray(np.recarray):
         Returns:
             None
         """
-        with h5py.File(self.filename, "r+") as hf:
-            # Remove the old locations dataset
-            if key in hf.keys():
-                del hf[key]
-            
+        with self.store.write(key) as hf:
             hf.create_dataset(key, data=self[key])
             
             if start is not None and end is not None:
@@ -814,17 +895,27 @@ class PatchArray(np.recarray):
     # Calculations  #
     #################
     
+    def ravel_roi(self):
+        """Flattened patches inside the region of interest (all patches if there is no ROI)"""
+        flat = self.ravel()
+        if not self.contains_roi:
+            return flat
+        flat_roi = flat[flat.roi]
+        if flat.size > 0 and flat_roi.size == 0:
+            raise ValueError("None of the %i patches is inside the region of interest" % flat.size)
+        return flat_roi
+
     def var(self):
         """Calculate the variance"""
-        return np.var(self.ravel().features, axis=0, dtype=np.float64)
+        return np.var(self.ravel_roi().features, axis=0, dtype=np.float64)
 
     def cov(self):
         """Calculate the covariance matrix"""
-        return np.cov(self.ravel().features, rowvar=False)
+        return np.cov(self.ravel_roi().features, rowvar=False)
 
     def mean(self):
         """Calculate the mean"""
-        return np.mean(self.ravel().features, axis=0, dtype=np.float64)
+        return np.mean(self.ravel_roi().features, axis=0, dtype=np.float64)
 
     #################
     #      Misc     #
@@ -852,6 +943,40 @@ class PatchArray(np.recarray):
 
     isview = property(lambda self: np.shares_memory(self, self.root))
 
+    # Models, scores, locations, ... computed from the features file
+    store = property(lambda self: ArtifactStore(self.filename))
+
+    def refresh_artifacts(self):
+        """Load the patch locations, rasterizations and patch labels that were saved to the
+        artifact store since the features file was opened (eg. by another process, see JobScheduler).
+        Mahalanobis distances are not refreshed, open the features file again to get new ones.
+
+        Returns:
+            None
+        """
+        store = self.store
+        rows = self.shape[0]
+
+        for key in store.keys():
+            with store.read(key) as af:
+                for name, y in af.items():
+                    if not isinstance(y, h5py.Dataset) or name not in ["locations", "fake_locations", "patch_labels"] and not name.startswith("bins_"):
+                        continue
+                    if name not in self.dtype.names:
+                        continue
+
+                    n = min(rows, y.shape[0])
+                    self[name][:n] = y[:n]
+
+                    if name.endswith("locations"):
+                        self.contains_locations = True
+                    elif name == "patch_labels":
+                        self.contains_patch_labels = True
+                    elif "rasterization_" + name[len("bins_"):] in af.keys():
+                        k = name[len("bins_"):]
+                        self.contains_bins[k] = True
+                        self.rasterizations[k] = numpy.array(af["rasterization_" + k])
+
     def get_batch(self, frame, temporal_batch_size):
         """Gets a temporal batch for a given frame by 
 
@@ -952,20 +1077,22 @@ class PatchArray(np.recarray):
             return patches[patches[self.label_name][:,0,0] != 0]
 
         def get_labels(self, patches):
-            """Get all labels"""
+            """Get all labels (per patch only inside the region of interest)"""
             if self.per_patch:
-                return patches[self.label_name].ravel()
+                return patches[self.label_name][patches.roi]
             else:
                 return patches[self.label_name][:,0,0]
         
-        def get_values(self, mahalanobis_distances):
-            """Get all anomaly scores"""
+        def get_values(self, mahalanobis_distances, roi=None):
+            """Get all anomaly scores (only of patches inside the region of interest roi)"""
+            if roi is None:
+                roi = np.ones(mahalanobis_distances.shape, dtype=np.bool)
             if self.per_patch:
-                return mahalanobis_distances.ravel()
+                return mahalanobis_distances[roi]
             elif self.mean:
-                return np.mean(mahalanobis_distances, axis=(1,2))
+                return np.sum(np.where(roi, mahalanobis_distances, 0), axis=(1,2)) / np.sum(roi, axis=(1,2))
             else:
-                return np.max(mahalanobis_distances, axis=(1,2))
+                return np.max(np.where(roi, mahalanobis_distances, -np.inf), axis=(1,2))
     
     METRICS = [
         Metric("patch",        "patch_labels", per_patch=True),
@@ -977,6 +1104,10 @@ class PatchArray(np.recarray):
 
     def calculate_tsne(self):
         """Calculate and visualize a t-SNE (DEPRECATED)"""
+        import pandas as pd
+        import seaborn as sns
+        from sklearn.manifold import TSNE
+        plt = _import_pyplot()
         assert self.contains_mahalanobis_distances, "Can't calculate t-SNE without mahalanobis distances calculated"
 
         # TODO: Maybe only validation?
@@ -1028,6 +1159,7 @@ class PatchArray(np.recarray):
 
     def calculate_metrics(self):
         """Calculate the metrics for all considered variants using the features in this PatchArray"""
+        from scipy.ndimage.morphology import generate_binary_structure, grey_erosion, grey_dilation
         assert self.contains_mahalanobis_distances, "Can't calculate ROC without mahalanobis distances calculated"
         # (Name, ROC_AUC, AUC_PR, f1)
         results = list()
@@ -1078,7 +1210,7 @@ class PatchArray(np.recarray):
                                 maha = grey_erosion(maha, structure=struct)
                                 maha = grey_dilation(maha, structure=struct)
 
-                        scores[name] = metric.get_values(maha)
+                        scores[name] = metric.get_values(maha, relevant.roi)
                         
                     filename = os.path.join(consts.METRICS_PATH, "%s_%s_%s_%s.jpg" % (extractor, metric.name, gauss_filter, other_filter))
                     result = self.__calculate_roc__(title, labels, scores, filename)
@@ -1090,6 +1222,8 @@ class PatchArray(np.recarray):
 
     def __calculate_roc__(self, title, labels, scores, filename=None):
         """ Calculate the metrics and create ROC and PR diagrams """
+        from sklearn import metrics
+        plt = _import_pyplot()
         # (Name, ROC_AUC, AUC_PR, f1)
         results = list()
 
@@ -1226,6 +1360,7 @@ class PatchArray(np.recarray):
         """Calculate per-pixel labels from annotation images (red=anomaly).
         Annotated images need to be in a folder called "Labels" at the same level as the "Images" folder.
         """
+        from skimage.transform import resize
         if not self.contains_features or self.filename is None:
             logger.error("Can only do this on feature files")
             return
@@ -1263,11 +1398,7 @@ class PatchArray(np.recarray):
             else:
                 self.patch_labels[i, ...] = frame.labels
 
-        with h5py.File(self.filename, "r+") as hf:
-            # Remove the old locations dataset
-            if "patch_labels" in hf.keys():
-                del hf["patch_labels"]
-            
+        with self.store.write("patch_labels") as hf:
             hf.create_dataset("patch_labels", data=self.patch_labels)
 
 if __name__ == "__main__":
@@ -0,0 +1,105 @@
+import os
+import hashlib
+
+import numpy as np
+
+from common import utils, logger, JobScheduler
+
+class Pipeline(object):
+    """Runs the stages of the calculations for a features file (locations, rasterizations,
+    models, patch labels, metrics, ...), but only the stages whose inputs or parameters changed.
+
+    Every stage gets a fingerprint of its parameters, its inputs (the features file, the
+    metadata, the label images or only the training frames of the features file) and the fingerprints of the stages it depends on. The
+    fingerprint is saved in the artifact store when the stage succeeded. A stage is only
+    run again if its fingerprint changed, eg. because the frames were relabeled or the
+    features were extracted again; all stages that depend on it are then run again as well.
+
+    Stages are run as jobs of a JobScheduler, so they can run in parallel.
+    """
+
+    def __init__(self, patches, force=False, workers=None, memory=None):
+        """Create a new pipeline for a features file
+
+        Args:
+            patches (PatchArray): Patches of the features file
+            force (bool): Run all stages, even if their fingerprint did not change
+            workers (int): Maximum number of parallel stages (see JobScheduler)
+            memory (int): Memory in bytes the running stages may use together (see JobScheduler)
+        """
+        self.patches      = patches
+        self.store        = patches.store
+        self.force        = force
+        self.scheduler    = JobScheduler(workers=workers, memory=memory)
+        self.fingerprints = dict()
+        self.up_to_date   = list()
+
+        # Hashing the features file takes a while, so the inputs are only hashed when needed
+        self._inputs = {
+            "features": lambda: self.store.file_hash(patches.filename),
+            "metadata": lambda: self.store.file_hash(os.path.join(patches.images_path, "metadata_cache.h5")),
+            "labels":   lambda: utils.directory_fingerprint(patches.images_path.replace("Images", "Labels")), # See PatchArray.calculate_patch_labels
+            "training": self._training_fingerprint
+        }
+
+    def _training_fingerprint(self):
+        """Only for internal use (fingerprint of the times and features of the training frames,
+        so models are not fitted again when other frames are appended to the features file)"""
+        training = self.patches.training
+        h = hashlib.sha1(np.ascontiguousarray(training[:, 0, 0].times))
+        for i in range(training.shape[0]):
+            h.update(np.ascontiguousarray(np.recarray.__getitem__(training[i], "features")))
+        return h.hexdigest()
+
+    def input(self, name):
+        """Fingerprint of an input ("features", "metadata", "labels" or "training")"""
+        if callable(self._inputs[name]):
+            self._inputs[name] = self._inputs[name]()
+        return self._inputs[name]
+
+    def add(self, name, func, args=(), kwargs=None, params=(), inputs=(), deps=(), memory=0, on_done=None):
+        """Add a stage. It is only run if its fingerprint changed.
+
+        Args:
+            name (str): Unique name of the stage (the fingerprint is saved under this name)
+            func (callable): Function that calculates and saves the result (see JobScheduler.add)
+            args (tuple): Arguments for func
+            kwargs (dict): Keyword arguments for func
+            params (tuple): Parameters of the stage that change the result (with a stable repr)
+            inputs (list): Inputs the stage reads ("features", "metadata", "labels" and/or "training")
+            deps (list): Names of the stages this stage depends on
+            memory (int): Memory in bytes the stage needs in addition to the shared memory
+            on_done (callable): Called in the scheduling process when the stage succeeded
+
+        Returns:
+            The name of the stage (to be used in deps)
+        """
+        fingerprint = utils.fingerprint(name, tuple(params),
+                                        tuple(self.input(i) for i in inputs),
+                                        tuple(self.fingerprints[d] for d in deps))
+        self.fingerprints[name] = fingerprint
+
+        if not self.force and self.store.fingerprint(name) == fingerprint:
+            logger.info("%s is up to date" % name)
+            self.up_to_date.append(name)
+            return name
+
+        def _done():
+            self.store.set_fingerprint(name, fingerprint)
+            if on_done is not None:
+                on_done()
+
+        # Stages that are up to date don't need to be waited for
+        deps = [d for d in deps if d not in self.up_to_date]
+        return self.scheduler.add(name, func, args=args, kwargs=kwargs, deps=deps, memory=memory, on_done=_done)
+
+    def run(self):
+        """Run all stages whose fingerprint changed
+
+        Returns:
+            dict: Stage name -> True (succeeded or up to date), False (failed) or None (skipped)
+        """
+        result = self.scheduler.run()
+        for name in self.up_to_date:
+            result[name] = True
+        return result
@@ -5,19 +5,21 @@ from common import logger
 import sys
 import time
 import signal
+import struct
 import yaml
 
-import tensorflow as tf
 import numpy as np
 import h5py
 import cv2
 from tqdm import tqdm
 from glob import glob
 
-from scipy.ndimage.filters import correlate1d, _gaussian_kernel1d, _ni_support
+# TensorFlow (and other slow imports) are only imported by the functions that need them,
+# so tools that don't use TensorFlow start fast
 
 def gaussian_filter(input, sigma, order=0, output=None,
                     mode="reflect", cval=0.0, truncate=4.0):
+    from scipy.ndimage.filters import correlate1d, _gaussian_kernel1d, _ni_support
     input = np.asarray(input)
     output = _ni_support._get_output(output, input)
     orders = _ni_support._normalize_sequence(order, input.ndim)
@@ -51,7 +53,18 @@ def gaussian_filter(input, sigma, order=0, output=None,
 #  Images IO  #
 ###############
 
-def load_dataset(files):
+def load_dataset(files, num_parallel_reads=None, skip_duplicates=True):
+    """Loads a set of TFRecord or JPEG files
+    Args:
+        files (str / str[]): TFRecord or JPEG file(s). Supports "path/to/*.tfrecord"
+        num_parallel_reads (int): Number of TFRecord files read in parallel. The records are still
+                                  returned in time order (see load_tfrecords)
+        skip_duplicates (bool): Skip the frames that are marked as duplicates in the
+                                metadata file next to the files (see 01b_remove_duplicates.py)
+
+    Returns:
+        Tuple (dataset (tf.data.Dataset), total (int))
+    """
     if isinstance(files, basestring):
         files = [files]
         
@@ -59,39 +72,94 @@ def load_dataset(files):
     if not files or len(files) < 1 or files[0] == "":
         raise ValueError("Please specify at least one filename (%s)" % files)
 
+    # Expand wildcards
+    files_expanded = []
+    for s in files:
+        files_expanded += glob(s)
+    files_expanded = sorted(list(set(files_expanded))) # Remove duplicates
+
+    skip_times = duplicate_times(files_expanded) if skip_duplicates else np.empty(0, dtype=np.int64)
+    if len(skip_times) > 0:
+        logger.info("Skipping %i frames that are marked as duplicates" % len(skip_times))
+
     # Load dataset
     if files[0].endswith(".tfrecord"):
-        dataset = load_tfrecords(files)
+        # Read the files in time order (the file names, eg. of shards, don't need to sort by time)
+        indices = dict((f, read_tfrecord_index(f)) for f in files_expanded)
+        files_expanded = sorted(files_expanded, key=lambda f: (indices[f]["Start time"], f))
+
+        # Every file is returned as one block, so reading in parallel keeps the order
+        block_length = max(indices[f]["Count"] for f in files_expanded)
+        dataset = load_tfrecords(files_expanded, num_parallel_reads=num_parallel_reads,
+                                 block_length=max(block_length, 1), skip_times=skip_times)
 
-        # Get number of examples in dataset
-        total = sum(1 for record in tqdm(dataset, desc="Loading dataset", file=sys.stderr))
+        # Get number of examples in dataset from the index files
+        total = sum(np.count_nonzero(~np.isin(indices[f]["times"].astype(np.int64), skip_times)) for f in files_expanded)
 
     elif files[0].endswith(".jpg"):
-        dataset = load_jpgs(files)
+        # The time is the file name
+        skip = set(skip_times.tolist())
+        files_expanded = [f for f in files_expanded if int(os.path.splitext(os.path.basename(f))[0]) not in skip]
+        if len(files_expanded) == 0:
+            raise ValueError("All images are marked as duplicates (%s)" % files)
 
-        # Expand wildcards
-        files_expanded = []
-        for s in files:
-            files_expanded += glob(s)
-        total = len(list(set(files_expanded))) # Remove duplicates
+        dataset = load_jpgs(files_expanded)
+        total = len(files_expanded)
     else:
         raise ValueError("Supported file types are *.tfrecord and *.jpg")
 
     return dataset, total
 
-def load_tfrecords(filenames, batch_size=64):
+def duplicate_times(files):
+    """Times of the frames that are marked as duplicates (see 01b_remove_duplicates.py)
+    in the metadata files (metadata_cache.h5) next to the given image or TFRecord files
+    (or in the directory above, see the TFRecord output of 01_rosbag_to_images.py)
+    Args:
+        files (str[]): Image or TFRecord files
+
+    Returns:
+        np.array of times (int64)
+    """
+    times = [np.empty(0, dtype=np.int64)]
+    for path in sorted(set(os.path.dirname(os.path.abspath(f)) for f in files)):
+        filename = os.path.join(path, "metadata_cache.h5")
+        if not os.path.exists(filename):
+            filename = os.path.join(os.path.dirname(path), "metadata_cache.h5")
+        if not os.path.exists(filename):
+            continue
+        with h5py.File(filename, "r") as hf:
+            if "duplicates" in hf.keys():
+                times.append(np.array(hf["times"], dtype=np.int64)[np.array(hf["duplicates"]) != 0])
+    return np.unique(np.concatenate(times))
+
+def load_tfrecords(filenames, batch_size=64, num_parallel_reads=None, block_length=None, skip_times=None):
     """Loads a set of TFRecord files
     Args:
         filenames (str / str[]): TFRecord file(s) extracted
                                  by rosbag_to_tfrecord
+        num_parallel_reads (int): Number of files read in parallel (Default: None)
+        block_length (int): Number of records returned from one file before the next file is
+                            read. With at least as many as the largest file has (see read_tfrecord_index)
+                            the files are read in parallel, but their records are returned one file after
+                            another in the order of filenames. Otherwise the records are interleaved
+                            (Default: None, interleaved)
+        skip_times (np.array): Times of records that are skipped before decoding (Default: None)
 
     Returns:
         tf.data.MapDataset
     """
+    import tensorflow as tf
     if not filenames or len(filenames) < 1 or filenames[0] == "":
         raise ValueError("Please specify at least one filename (%s)" % filenames)
     
-    raw_dataset = tf.data.TFRecordDataset(filenames)
+    if num_parallel_reads is not None and num_parallel_reads > 1 and block_length is not None:
+        # A deterministic interleave with blocks of whole files prefetches the next files in parallel
+        raw_dataset = tf.data.Dataset.from_tensor_slices(filenames).interleave(tf.data.TFRecordDataset,
+                                                                               cycle_length=num_parallel_reads,
+                                                                               block_length=block_length,
+                                                                               num_parallel_calls=num_parallel_reads)
+    else:
+        raw_dataset = tf.data.TFRecordDataset(filenames, num_parallel_reads=num_parallel_reads)
 
     # Create a dictionary describing the features.
     feature_description = {
@@ -113,11 +181,18 @@ def load_tfrecords(filenames, batch_size=64):
         time = example["metadata/time"]
         return image, time
 
-    return raw_dataset.batch(batch_size) \
-                      .map(_parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
-                      .unbatch() \
-                      .map(_decode_function, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
-                      .prefetch(tf.data.experimental.AUTOTUNE)
+    dataset = raw_dataset.batch(batch_size) \
+                         .map(_parse_function, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+                         .unbatch()
+
+    if skip_times is not None and len(skip_times) > 0:
+        skip = tf.lookup.StaticHashTable(
+            tf.lookup.KeyValueTensorInitializer(tf.constant(np.asarray(skip_times, dtype=np.int64)),
+                                                tf.ones(len(skip_times), dtype=tf.int64)), default_value=0)
+        dataset = dataset.filter(lambda example: tf.equal(skip.lookup(example["metadata/time"]), 0))
+
+    return dataset.map(_decode_function, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+                  .prefetch(tf.data.experimental.AUTOTUNE)
 
 def load_jpgs(filenames):
     """Loads a set of TFRecord files
@@ -128,6 +203,7 @@ def load_jpgs(filenames):
     Returns:
         tf.data.MapDataset
     """
+    import tensorflow as tf
     if not filenames or len(filenames) < 1 or filenames[0] == "":
         raise ValueError("Please specify at least one filename (%s)" % filenames)
     
@@ -147,6 +223,596 @@ def load_jpgs(filenames):
     return raw_dataset.map(_decode_function, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
                       .prefetch(tf.data.experimental.AUTOTUNE)
 
+#################
+# TFRecord out  #
+#################
+
+def _int64_feature(value):
+    """Wrapper for inserting int64 features into Example proto."""
+    import tensorflow as tf
+    if not isinstance(value, list):
+        value = [value]
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
+
+def _bytes_feature(value):
+    """Wrapper for inserting bytes features into Example proto."""
+    import tensorflow as tf
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+def get_jpeg_size(encoded):
+    """Get the size of an encoded image by only reading its header
+    Args:
+        encoded (bytes): Encoded image
+
+    Returns:
+        Tuple (height, width)
+    """
+    from io import BytesIO
+    from PIL import Image
+    width, height = Image.open(BytesIO(encoded)).size
+    return height, width
+
+# A TFRecord is stored as: length (uint64), crc of length (uint32), data, crc of data (uint32)
+TFRECORD_HEADER_SIZE = 12
+TFRECORD_FRAMING_SIZE = 16
+
+def tfrecord_index_filename(filename):
+    """Filename of the index that accompanies a TFRecord file"""
+    return filename + ".index"
+
+def write_tfrecord_index(filename, times, offsets):
+    """Write the index of a TFRecord file (number of records, their times and byte offsets)
+    Args:
+        filename (str): TFRecord file
+        times (list): Timestamps of all records in the file
+        offsets (list): Byte offset of every record in the file
+
+    Returns:
+        None
+    """
+    times = np.array(times, dtype=np.uint64)
+    temp_filename = tfrecord_index_filename(filename) + ".tmp"
+    with h5py.File(temp_filename, "w") as hf:
+        hf.attrs["Count"] = len(times)
+        hf.attrs["Start time"] = times.min() if len(times) > 0 else 0
+        hf.attrs["End time"] = times.max() if len(times) > 0 else 0
+        hf.create_dataset("times", data=times)
+        hf.create_dataset("offsets", data=np.array(offsets, dtype=np.uint64))
+    os.rename(temp_filename, tfrecord_index_filename(filename))
+
+def build_tfrecord_index(filename):
+    """Build the index of a TFRecord file. Every record is read and parsed
+    to get its time (the images are not decoded), so this takes a while for large files.
+    Args:
+        filename (str): TFRecord file
+
+    Returns:
+        Tuple (times (list), offsets (list))
+    """
+    import tensorflow as tf
+    times = list()
+    offsets = list()
+    with open(filename, "rb") as f:
+        while True:
+            offset = f.tell()
+            header = f.read(TFRECORD_HEADER_SIZE)
+            if len(header) < TFRECORD_HEADER_SIZE:
+                break
+            length = struct.unpack("<Q", header[:8])[0]
+            example = tf.train.Example.FromString(f.read(length))
+            f.seek(4, os.SEEK_CUR) # Skip crc of data
+            times.append(example.features.feature["metadata/time"].int64_list.value[0])
+            offsets.append(offset)
+    return times, offsets
+
+def read_tfrecord_index(filename):
+    """Read the index of a TFRecord file. If there is no (up to date) index
+    it is built once and cached next to the TFRecord file.
+    Args:
+        filename (str): TFRecord file
+
+    Returns:
+        dict with "Count", "Start time", "End time", "times" and "offsets"
+    """
+    index_filename = tfrecord_index_filename(filename)
+
+    up_to_date = os.path.exists(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename)
+    if up_to_date:
+        with h5py.File(index_filename, "r") as hf:
+            up_to_date = "offsets" in hf.keys() # Built without offsets by an older version
+
+    if not up_to_date:
+        logger.info("Building index for %s" % filename)
+        times, offsets = build_tfrecord_index(filename)
+        try:
+            write_tfrecord_index(filename, times, offsets)
+        except (IOError, OSError):
+            # Read only location, just use the index without caching it
+            times = np.array(times, dtype=np.uint64)
+            return {
+                "Count": len(times),
+                "Start time": times.min() if len(times) > 0 else 0,
+                "End time": times.max() if len(times) > 0 else 0,
+                "times": times,
+                "offsets": np.array(offsets, dtype=np.uint64)
+            }
+
+    with h5py.File(index_filename, "r") as hf:
+        index = dict(hf.attrs.items())
+        index["times"] = np.array(hf["times"])
+        index["offsets"] = np.array(hf["offsets"])
+    return index
+
+def read_tfrecord_image(filename, i, index=None):
+    """Random access to a single image of a TFRecord file using the offsets of its index
+    Args:
+        filename (str): TFRecord file
+        i (int): Index of the record in the file
+        index (dict): Index of the file (see read_tfrecord_index), read if None
+
+    Returns:
+        Tuple (image (BGR np.array, like cv2.imread), time (int))
+    """
+    import tensorflow as tf
+    if index is None:
+        index = read_tfrecord_index(filename)
+
+    with open(filename, "rb") as f:
+        f.seek(int(index["offsets"][i]))
+        length = struct.unpack("<Q", f.read(TFRECORD_HEADER_SIZE)[:8])[0]
+        example = tf.train.Example.FromString(f.read(length))
+
+    feature = example.features.feature
+    encoded = np.frombuffer(feature["image/encoded"].bytes_list.value[0], dtype=np.uint8)
+    return cv2.imdecode(encoded, cv2.IMREAD_COLOR), feature["metadata/time"].int64_list.value[0]
+
+# Indices of the TFRecord files of an images directory (see find_tfrecord_image)
+_tfrecord_indices = dict()
+
+def find_tfrecord_image(images_path, time):
+    """Get an image by its time from the TFRecord files of an images directory
+    ({images_path}/*.tfrecord or {images_path}/TFRecord/*.tfrecord, see 01_rosbag_to_images.py)
+    Args:
+        images_path (str): Images directory
+        time (int): Time of the image
+
+    Returns:
+        Image (BGR np.array, like cv2.imread) or None if there is no record with this time
+    """
+    if images_path not in _tfrecord_indices:
+        files = glob(os.path.join(images_path, "*.tfrecord")) + glob(os.path.join(images_path, "TFRecord", "*.tfrecord"))
+        _tfrecord_indices[images_path] = [(f, read_tfrecord_index(f)) for f in sorted(files)]
+
+    for filename, index in _tfrecord_indices[images_path]:
+        if index["Count"] == 0 or not index["Start time"] <= time <= index["End time"]:
+            continue
+        found = np.flatnonzero(index["times"] == time)
+        if len(found) > 0:
+            return read_tfrecord_image(filename, found[0], index)[0]
+    return None
+
+def write_tfrecord_shard(job):
+    """Write a single (uncompressed) TFRecord shard and its index. Used as process pool worker.
+    Args:
+        job (tuple): (output_file (str), records (list), from_files (bool)) with
+                     records being a list of (time, encoded image) or, if from_files
+                     is True, a list of (time, JPEG filename). The encoded
+                     images are written as they are (no decoding / encoding).
+
+    Returns:
+        Tuple (output_file, number of records)
+    """
+    import tensorflow as tf
+    output_file, records, from_files = job
+
+    times = list()
+    offsets = list()
+    offset = 0
+    with tf.io.TFRecordWriter(output_file) as writer:
+        for time, encoded in records:
+            if from_files:
+                with open(encoded, "rb") as f:
+                    encoded = f.read()
+
+            height, width = get_jpeg_size(encoded)
+
+            feature_dict = {
+                "metadata/time"     : _int64_feature(int(time)),
+                "image/height"      : _int64_feature(height),
+                "image/width"       : _int64_feature(width),
+                "image/channels"    : _int64_feature(3),
+                "image/colorspace"  : _bytes_feature(b"RGB"),
+                "image/format"      : _bytes_feature(b"jpeg"),
+                "image/encoded"     : _bytes_feature(encoded)
+            }
+
+            example = tf.train.Example(features=tf.train.Features(feature=feature_dict))
+            serialized = example.SerializeToString()
+            writer.write(serialized)
+            times.append(time)
+            offsets.append(offset)
+            offset += len(serialized) + TFRECORD_FRAMING_SIZE
+
+    write_tfrecord_index(output_file, times, offsets)
+    return output_file, len(times)
+
+#################
+#  Metadata IO  #
+#################
+
+def read_metadata(filename):
+    """Read all datasets and attributes of a metadata file
+    Args:
+        filename (str): Metadata file (metadata_cache.h5)
+
+    Returns:
+        Tuple (metadata (dict), attrs (dict)), both empty if the file does not exist
+    """
+    metadata = dict()
+    attrs = dict()
+
+    if not os.path.exists(filename):
+        return metadata, attrs
+
+    with h5py.File(filename, "r") as hf:
+        for key, value in hf.attrs.items():
+            attrs[key] = value
+        for key, value in hf.items():
+            if isinstance(value, h5py.Dataset):
+                metadata[key] = np.array(value)
+
+    return metadata, attrs
+
+def write_metadata(filename, metadata, attrs=None):
+    """Write a metadata file sorted by time. The file is written to a temporary
+    file first and then renamed, so readers never see a half written file.
+    Args:
+        filename (str): Metadata file (metadata_cache.h5)
+        metadata (dict): Metadata arrays (all of the same length, must contain "times")
+        attrs (dict): Attributes of the metadata file
+
+    Returns:
+        None
+    """
+    wrong_length = sorted(key for key, value in metadata.items() if len(value) != len(metadata["times"]))
+    if len(wrong_length) > 0:
+        raise ValueError("The metadata %s do not have one entry per time (%i)" % (", ".join(wrong_length), len(metadata["times"])))
+
+    order = np.argsort(metadata["times"], kind="mergesort")
+
+    temp_filename = filename + ".tmp"
+    with h5py.File(temp_filename, "w") as hf:
+        if attrs is not None:
+            for key, value in attrs.items():
+                hf.attrs[key] = value
+        for key, value in metadata.items():
+            value = np.asarray(value)[order]
+            if value.dtype == object or value.dtype.kind in ("S", "U"):
+                hf.create_dataset(key, data=value.astype(object), dtype=h5py.string_dtype(encoding="ascii"))
+            else:
+                hf.create_dataset(key, data=value)
+    os.rename(temp_filename, filename)
+
+def _metadata_fill(dtype, count):
+    """Only for internal use (values of rows that don't have a metadata field:
+    -1 like unknown directions and round numbers, NaN, empty strings or zeros)"""
+    if dtype == object or dtype.kind in ("S", "U"):
+        return np.full(count, "", dtype=object)
+    if dtype.kind == "i":
+        return np.full(count, -1, dtype=dtype)
+    if dtype.kind == "f":
+        return np.full(count, np.nan, dtype=dtype)
+    return np.zeros(count, dtype=dtype)
+
+def append_metadata(existing, new):
+    """Append metadata rows to existing metadata. Fields that only one of them has
+    (eg. "duplicates" added by 01b_remove_duplicates.py) are filled for the other rows
+    (see _metadata_fill: 0 for unsigned fields like "duplicates", -1 for signed fields).
+    Args:
+        existing (dict): Existing metadata arrays (see read_metadata)
+        new (dict): New metadata arrays (all of the same length)
+
+    Returns:
+        dict with the concatenated arrays (not sorted, see write_metadata)
+    """
+    if len(existing) == 0:
+        return dict(new)
+
+    existing_count = len(existing["times"])
+    new_count = len(new["times"])
+
+    metadata = dict()
+    for name in set(existing.keys()) | set(new.keys()):
+        if name in existing and name in new:
+            dtype = existing[name].dtype
+            if dtype == object or dtype.kind in ("S", "U"):
+                metadata[name] = np.concatenate((existing[name].astype(object), np.asarray(new[name]).astype(object)))
+            else:
+                metadata[name] = np.concatenate((existing[name], np.asarray(new[name]).astype(dtype)))
+        elif name in existing:
+            metadata[name] = np.concatenate((existing[name], _metadata_fill(existing[name].dtype, new_count)))
+        else:
+            value = np.asarray(new[name])
+            filled = _metadata_fill(value.dtype, existing_count)
+            metadata[name] = np.concatenate((filled, value.astype(filled.dtype)))
+    return metadata
+
+#################
+# Feature store #
+#################
+
+FEATURE_STORAGE_DTYPES = ("float32", "float16", "int8")
+
+def calibrate_quantization(features, margin=0.25):
+    """Get the per-channel scale and offset for int8 feature storage
+    Args:
+        features (np.array): Calibration features (last axis are the channels)
+        margin (float): Extend the range seen in the calibration features by this fraction
+
+    Returns:
+        Tuple (scale (np.array), offset (np.array))
+    """
+    features = np.asarray(features, dtype=np.float32)
+    features = features.reshape(-1, features.shape[-1])
+    low, high = features.min(axis=0), features.max(axis=0)
+    offset = (high + low) / 2.0
+    scale = np.maximum((high - low) * (1.0 + margin) / 254.0, np.finfo(np.float32).eps)
+    return scale.astype(np.float32), offset.astype(np.float32)
+
+def quantize_features(features, scale, offset):
+    """Quantize features to int8 using a per-channel scale and offset
+    Args:
+        features (np.array): Features (last axis are the channels)
+        scale (np.array): Per-channel scale
+        offset (np.array): Per-channel offset
+
+    Returns:
+        Tuple (quantized features (np.array), number of clipped values (int))
+    """
+    quantized = np.round((features - offset) / scale)
+    clipped = np.count_nonzero(np.abs(quantized) > 127)
+    return np.clip(quantized, -127, 127).astype(np.int8), clipped
+
+def dequantize_features(features, scale=None, offset=None):
+    """Upcast stored features (float16 or int8 with scale and offset) to float32
+    Args:
+        features (np.array): Stored features
+        scale (np.array): Per-channel scale (None if not quantized)
+        offset (np.array): Per-channel offset (None if not quantized)
+
+    Returns:
+        np.array
+    """
+    if scale is None:
+        return features if features.dtype == np.float32 else features.astype(np.float32)
+    return features.astype(np.float32) * scale + offset
+
+def parse_roi(roi):
+    """Parse a region of interest
+    Args:
+        roi (str / tuple / np.array): Crop box "x0,y0,x1,y1" or (x0, y0, x1, y1) in image coordinates,
+                                      a mask image file or a mask array (nonzero = inside)
+
+    Returns:
+        Tuple (x0, y0, x1, y1) or a boolean mask (np.array)
+    """
+    if isinstance(roi, basestring):
+        if os.path.exists(roi):
+            mask = cv2.imread(roi, cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                raise ValueError("Could not read the ROI mask %s" % roi)
+            return mask > 0
+        roi = roi.replace(",", " ").split()
+
+    if isinstance(roi, np.ndarray) and roi.ndim == 2:
+        return roi > 0
+
+    if len(roi) != 4:
+        raise ValueError("The ROI has to be a mask image or a crop box x0,y0,x1,y1 (%s)" % (roi,))
+    return tuple(int(v) for v in roi)
+
+def roi_patch_mask(roi, image_shape, grid_shape):
+    """Get the patches whose center lies in the region of interest
+    Args:
+        roi (str / tuple / np.array): Region of interest (see parse_roi)
+        image_shape (tuple): (height, width) of the input images (crop box coordinates)
+        grid_shape (tuple): (height, width) of the feature grid
+
+    Returns:
+        np.array (bool) with shape grid_shape
+    """
+    roi = parse_roi(roi)
+    h, w = grid_shape
+    # Relative patch centers
+    centers_y = (np.arange(h) + 0.5) / float(h)
+    centers_x = (np.arange(w) + 0.5) / float(w)
+
+    if isinstance(roi, tuple):
+        x0, y0, x1, y1 = roi
+        centers_y = centers_y * image_shape[0]
+        centers_x = centers_x * image_shape[1]
+        mask = np.outer((centers_y >= y0) & (centers_y < y1),
+                        (centers_x >= x0) & (centers_x < x1))
+    else:
+        # The mask might have a different size than the images
+        v = (centers_y * roi.shape[0]).astype(int)
+        u = (centers_x * roi.shape[1]).astype(int)
+        mask = roi[np.ix_(v, u)]
+
+    # The models can't be fitted without patches
+    if not mask.any():
+        raise ValueError("The ROI does not contain the center of any patch (%i x %i patches on %i x %i images)" %
+                         (h, w, image_shape[0], image_shape[1]))
+    return mask
+
+def open_feature_file(filename):
+    """Open a features file for reading. Files that are still being written in
+    SWMR mode (see FeatureExtractorBase.extract_dataset) are opened as SWMR reader.
+    Args:
+        filename (str): Features file (*.h5)
+
+    Returns:
+        h5py.File
+    """
+    try:
+        return h5py.File(filename, "r")
+    except (IOError, OSError):
+        return h5py.File(filename, "r", swmr=True)
+
+def feature_rows_written(hf):
+    """Number of completed rows in a (possibly still growing) features file
+    Args:
+        hf (h5py.File): Opened features file
+
+    Returns:
+        int
+    """
+    if "rows_written" not in hf.keys():
+        return hf["times"].shape[0]
+    rows = hf["rows_written"]
+    if hf.swmr_mode:
+        rows.refresh()
+    return int(rows[0])
+
+def shard_dataset(dataset, total, index, count, mode="strided"):
+    """Get a single shard of a dataset
+    Args:
+        dataset (tf.data.Dataset): Dataset
+        total (int): Number of items in Dataset
+        index (int): Index of the shard
+        count (int): Number of shards
+        mode (str): strided:    Every n-th item, starting at item k
+                    contiguous: The k-th of n contiguous blocks
+
+    Returns:
+        Tuple (dataset (tf.data.Dataset), total (int))
+    """
+    if mode == "strided":
+        return dataset.shard(count, index), len(range(index, total, count))
+    elif mode == "contiguous":
+        start, end = total * index // count, total * (index + 1) // count
+        return dataset.skip(start).take(end - start), end - start
+    else:
+        raise ValueError("Shard mode has to be strided or contiguous (%s)" % mode)
+
+def merge_feature_shards(files, output_file, virtual=True):
+    """Merge feature files extracted in shards (see FeatureExtractorBase.extract_dataset)
+    into one feature file, that can be opened like a normal one
+    Args:
+        files (str / str[]): Shard files. Supports "path/to/*.h5"
+        output_file (str): Merged feature file
+        virtual (bool): Create HDF5 virtual datasets that refer to the shards (the shards have
+                        to be kept). Otherwise the features are copied (Default: True)
+
+    Returns:
+        None
+    """
+    if isinstance(files, basestring):
+        files = [files]
+
+    # Expand wildcards
+    files_expanded = []
+    for s in files:
+        files_expanded += glob(s)
+    files = sorted(list(set(files_expanded))) # Remove duplicates
+
+    if len(files) == 0:
+        raise ValueError("Please specify at least one shard")
+
+    # Check that the shards belong together and are complete
+    shards = dict()
+    for f in files:
+        with h5py.File(f, "r") as hf:
+            if "Shard index" not in hf.attrs.keys():
+                raise ValueError("%s is not a shard" % f)
+            if hf.attrs["Number of frames extracted"] != hf.attrs["Number of total frames"]:
+                raise ValueError("Extraction of %s is not complete" % f)
+            shards[int(hf.attrs["Shard index"])] = {
+                "filename": f,
+                "count": int(hf.attrs["Shard count"]),
+                "mode": hf.attrs["Shard mode"],
+                "extractor": hf.attrs["Extractor"],
+                "shape": hf["features"].shape,
+                "dtype": hf["features"].dtype,
+                "quantization": (np.array(hf["features"].attrs.get("scale", [])), np.array(hf["features"].attrs.get("offset", []))),
+                "projection": np.array(hf["projection/components"]) if "projection" in hf.keys() else None
+            }
+
+    first = shards[min(shards.keys())]
+    count, mode = first["count"], first["mode"]
+
+    if sorted(shards.keys()) != list(range(count)):
+        raise ValueError("Shards missing (found %s of %i)" % (sorted(shards.keys()), count))
+
+    for shard in shards.values():
+        if shard["count"] != count or shard["mode"] != mode or shard["extractor"] != first["extractor"] or \
+           shard["shape"][1:] != first["shape"][1:] or shard["dtype"] != first["dtype"]:
+            raise ValueError("%s does not match %s" % (shard["filename"], first["filename"]))
+        if any(not np.array_equal(a, b) for a, b in zip(shard["quantization"], first["quantization"])):
+            raise ValueError("Quantization of %s does not match %s (extract all shards with the same calibration file)" % (shard["filename"], first["filename"]))
+        if (shard["projection"] is None) != (first["projection"] is None) or \
+           (shard["projection"] is not None and not np.array_equal(shard["projection"], first["projection"])):
+            raise ValueError("Projection of %s does not match %s (extract all shards with the same calibration file)" % (shard["filename"], first["filename"]))
+
+    total = sum(shard["shape"][0] for shard in shards.values())
+
+    # Where each shard goes in the merged file
+    def _selection(k, shard_total):
+        if mode == "strided":
+            return slice(k, total, count)
+        start = sum(shards[i]["shape"][0] for i in range(k))
+        return slice(start, start + shard_total)
+
+    temp_filename = output_file + ".tmp"
+    with h5py.File(temp_filename, "w") as out:
+        with h5py.File(first["filename"], "r") as hf:
+            for key, value in hf.attrs.items():
+                out.attrs[key] = value
+            for key in ("Shard index", "Shard count", "Shard mode"):
+                del out.attrs[key]
+            for name in ("projection", "roi"):
+                if name in hf.keys():
+                    hf.copy(name, out)
+        
+        # Timing of the complete extraction
+        starts, ends = list(), list()
+        for shard in shards.values():
+            with h5py.File(shard["filename"], "r") as hf:
+                starts.append(hf.attrs["Start"])
+                ends.append(hf.attrs["End"])
+        out.attrs["Start"] = min(starts)
+        out.attrs["End"] = max(ends)
+        out.attrs["Duration"] = max(ends) - min(starts)
+        out.attrs["Duration (formatted)"] = format_duration(max(ends) - min(starts))
+        out.attrs["Number of frames extracted"] = total
+        out.attrs["Number of total frames"] = total
+        out.attrs["Merged shards"] = count
+        out.attrs["Shard mode"] = mode
+
+        for name in ("features", "times"):
+            with h5py.File(first["filename"], "r") as hf:
+                shape, dtype = (total,) + hf[name].shape[1:], hf[name].dtype
+                attrs = dict(hf[name].attrs.items())
+            
+            if virtual:
+                layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+                for k, shard in shards.items():
+                    shard_shape = (shard["shape"][0],) + shape[1:]
+                    # Relative paths, so the shards can be moved together with the merged file
+                    source_file = os.path.relpath(shard["filename"], os.path.dirname(os.path.abspath(output_file)))
+                    layout[_selection(k, shard["shape"][0])] = h5py.VirtualSource(source_file, name, shape=shard_shape)
+                dataset = out.create_virtual_dataset(name, layout)
+            else:
+                dataset = out.create_dataset(name, shape=shape, dtype=dtype,
+                                             chunks=(1,) + shape[1:] if len(shape) > 1 else True)
+                for k, shard in shards.items():
+                    with h5py.File(shard["filename"], "r") as hf:
+                        dataset[_selection(k, shard["shape"][0])] = hf[name][:]
+            
+            for key, value in attrs.items():
+                dataset.attrs[key] = value
+    os.rename(temp_filename, output_file)
+
 #################
 # Output helper #
 #################
@@ -176,18 +842,28 @@ def format_duration(t):
 # Computer Info #
 #################
 
-import cpuinfo
-import GPUtil
-from psutil import virtual_memory
+_computer_info = None
 
 def getComputerInfo():
+    """Get information about the machine (written to the output files).
+    TensorFlow is only queried if it is already imported. The result is cached.
+
+    Returns:
+        dict
+    """
+    global _computer_info
+    if _computer_info is not None and ("tensorflow" not in sys.modules or "TensorFlow version" in _computer_info):
+        return dict(_computer_info)
+
+    import GPUtil
+    from psutil import virtual_memory
 
     # Get CPU info
+    # import cpuinfo
     # cpu = cpuinfo.get_cpu_info()
 
     result_dict = {
         # "Python version": cpu["python_version"],
-        "TensorFlow version": tf.version.VERSION,
         # "CPU Description": cpu["brand"],
         # "CPU Clock speed (advertised)": cpu["hz_advertised"],
         # "CPU Clock speed (actual)": cpu["hz_actual"],
@@ -195,9 +871,10 @@ def getComputerInfo():
     }
 
     # Get GPU info
-    gpus_tf = tf.config.experimental.list_physical_devices("GPU")
-    
-    result_dict["Number of GPUs (tf)"] = len(gpus_tf)
+    if "tensorflow" in sys.modules:
+        import tensorflow as tf
+        result_dict["TensorFlow version"] = tf.version.VERSION
+        result_dict["Number of GPUs (tf)"] = len(tf.config.experimental.list_physical_devices("GPU"))
 
     gpus = GPUtil.getGPUs()
     gpus_available = GPUtil.getAvailability(gpus)
@@ -214,12 +891,130 @@ def getComputerInfo():
     result_dict["RAM (total)"] = mem.total
     result_dict["RAM (available)"] = mem.available
 
-    return result_dict
+    _computer_info = result_dict
+    return dict(result_dict)
+
+###############
+# Import time #
+###############
+
+# Modules that should only be imported by the code that needs them
+HEAVY_MODULES = ["tensorflow", "tensorflow_hub", "efficientnet", "matplotlib", "seaborn", "pandas", "sklearn", "skimage", "shapely"]
+
+def measure_import_time(module="common", repeat=3):
+    """Measure the time it takes to import a module in a fresh interpreter
+    Args:
+        module (str): Name of the module (relative to the anomaly_detector package directory)
+        repeat (int): Number of fresh interpreters, the fastest run is reported
+
+    Returns:
+        Tuple (float, list): Import time in seconds, heavy modules that got imported
+    """
+    import subprocess
+    import json
+
+    code = ("import sys, time, json\n"
+            "start = time.time()\n"
+            "import %s\n"
+            "duration = time.time() - start\n"
+            "print(json.dumps([duration, [m for m in %r if m in sys.modules]]))") % (module, HEAVY_MODULES)
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=cwd)
+        duration, heavy = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        if best is None or duration < best[0]:
+            best = (duration, heavy)
+    return best
+
+def check_import_time(budget, module="common"):
+    """Log a warning if importing a module takes longer than budget seconds
+    Args:
+        budget (float): Import time budget in seconds
+        module (str): Name of the module
+
+    Returns:
+        float: Import time in seconds
+    """
+    duration, heavy = measure_import_time(module)
+    if duration > budget:
+        logger.warning("Importing %s took %.2fs (budget: %.2fs)" % (module, duration, budget))
+    else:
+        logger.info("Importing %s took %.2fs (budget: %.2fs)" % (module, duration, budget))
+    if len(heavy) > 0:
+        logger.warning("Importing %s also imported %s" % (module, ", ".join(heavy)))
+    return duration
+
+################
+# Fingerprints #
+################
+
+def file_hash(filename, chunk_size=16 * 1024 * 1024):
+    """SHA1 hash of the content of a file
+
+    Args:
+        filename (str): File to hash
+        chunk_size (int): Number of bytes that are read at once
+
+    Returns:
+        str
+    """
+    import hashlib
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def directory_fingerprint(path, pattern="*"):
+    """Fingerprint of the files in a directory based on their names, sizes and modification times
+
+    Args:
+        path (str): Directory
+        pattern (str): Only consider these files
+
+    Returns:
+        str (the same for missing and empty directories)
+    """
+    files = list()
+    for f in sorted(glob(os.path.join(path, pattern))):
+        stat = os.stat(f)
+        files.append((os.path.basename(f), stat.st_size, stat.st_mtime))
+    return fingerprint(*files)
+
+def fingerprint(*parts):
+    """Fingerprint of the inputs and parameters of a calculation
+
+    Args:
+        *parts: Parameters and fingerprints of the inputs (with a stable repr, so no dicts or sets)
+
+    Returns:
+        str
+    """
+    import hashlib
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
 
 #################
 #     Misc      #
 #################
 
+def get_cache_path(*parts):
+    """Get a path in the cache directory (consts.CACHE_PATH, default: ~/.cache/anomaly_detector).
+    The directory is created if it does not exist.
+    Args:
+        *parts (str): Path components below the cache directory
+
+    Returns:
+        str
+    """
+    import consts
+    cache_dir = getattr(consts, "CACHE_PATH", os.path.join(os.path.expanduser("~"), ".cache", "anomaly_detector"))
+    path = os.path.join(cache_dir, *parts)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    return path
+
 # https://gist.github.com/nonZero/2907502
 class GracefulInterruptHandler(object):
 
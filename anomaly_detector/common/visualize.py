@@ -3,11 +3,6 @@ import cv2
 import numpy as np
 from datetime import datetime
 
-import matplotlib.pyplot as plt
-
-import scipy.stats as stats
-from scipy.ndimage.morphology import generate_binary_structure, grey_erosion, grey_dilation
-
 import consts
 
 from common import utils, logger, ImageLocationUtility, PatchArray
@@ -138,6 +133,8 @@ class Visualize(object):
             show_map (bool): Update the position on the map every frame (Default: False)
             show_values (bool): Show values on each patch (Default: False)
         """
+        import matplotlib.pyplot as plt # Slow import, only needed for visualization
+        
         self.orig_patches = patches
         self.patches      = patches
         self.images_path = kwargs.get("images_path", consts.IMAGES_PATH)
@@ -219,6 +216,7 @@ class Visualize(object):
 
     def show(self):
         """ Main function """
+        import matplotlib.pyplot as plt
         self.mode = 0 # 0: don't edit, 1: single, 2: continuous
         self._label = -1
         self._direction = -1
@@ -373,6 +371,7 @@ class Visualize(object):
         return cv2.getTrackbarPos(name, self.WINDOWS_CONTROLS)
     
     def __maha__(self, x=None, only_refresh_image=False):
+        from scipy.ndimage.morphology import generate_binary_structure, grey_erosion, grey_dilation
         image = np.zeros((350, 480, 3), dtype=np.uint8)
         if self.model_index > 0 and self.patches.contains_mahalanobis_distances:
             font                   = cv2.FONT_HERSHEY_SIMPLEX
@@ -437,7 +436,7 @@ class Visualize(object):
             
             for i, metric in enumerate(PatchArray.METRICS):
                 labels = metric.get_labels(self.patches)
-                scores = metric.get_values(self.patches.mahalanobis_distances_filtered)
+                scores = metric.get_values(self.patches.mahalanobis_distances_filtered, self.patches.roi)
                 
                 if metric.current_threshold == -1:
                     m = np.max(scores)
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import socket
+import threading
+
+from common import logger
+
+class WorkQueue(object):
+    """Distributes units of work (a task for a features file, eg. calculating the models)
+    between workers on any number of machines that share a file system.
+
+    A worker claims a unit by creating its lock file "{queue}/{features file}.{task}.lock"
+    (creating a file exclusively is atomic, so only one worker gets it). While it works on
+    the unit it touches the lock file regularly. A lock file that was not touched for
+    stale_after seconds belongs to a dead worker and is taken over by the next worker.
+    A finished unit gets a file "{queue}/{features file}.{task}.done" with the worker and
+    the timings, so every unit is only done once per queue (use a new directory for a new run).
+    A unit that failed (the worker sets "Failed" or "Error" in its record) is released instead
+    and its record is added to "{queue}/{features file}.{task}.failed", so another worker tries
+    it again, up to max_attempts times.
+    Units of different tasks of the same features file can run at the same time, they share
+    its ArtifactStore (which locks its fingerprints file).
+    """
+
+    def __init__(self, path, stale_after=600, poll_interval=30, max_attempts=3):
+        """Open (or create) a queue
+
+        Args:
+            path (str): Directory on the shared file system
+            stale_after (float): Seconds after which a lock file that was not touched is taken over
+            poll_interval (float): Seconds between checks when all remaining units are claimed by other workers
+            max_attempts (int): Number of times a failing unit is tried before it is given up
+        """
+        self.path          = path
+        self.stale_after   = stale_after
+        self.poll_interval = poll_interval
+        self.max_attempts  = max_attempts
+        self.worker        = "%s:%i" % (socket.gethostname(), os.getpid())
+
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError: # Created by another worker meanwhile
+                if not os.path.isdir(self.path):
+                    raise
+
+    def _filename(self, features_file, task, extension):
+        """Only for internal use (the paths might differ between machines, so only the file name is used)"""
+        return os.path.join(self.path, "%s.%s.%s" % (os.path.basename(features_file), task, extension))
+
+    def is_done(self, features_file, task):
+        return os.path.exists(self._filename(features_file, task, "done"))
+
+    def failures(self, features_file, task):
+        """Records of the failed attempts of a unit
+
+        Returns:
+            list of records (dict)
+        """
+        failed = self._filename(features_file, task, "failed")
+        if not os.path.exists(failed):
+            return []
+        with open(failed, "r") as f:
+            return json.load(f)
+
+    def _add_failure(self, features_file, task, record):
+        """Only for internal use (only the worker holding the lock writes the file)"""
+        failures = self.failures(features_file, task) + [record]
+        failed = self._filename(features_file, task, "failed")
+        with open(failed + ".tmp", "w") as f:
+            json.dump(failures, f, indent=4, sort_keys=True)
+        os.rename(failed + ".tmp", failed)
+        return len(failures)
+
+    def _owns(self, lock):
+        """Only for internal use (False if the lock was taken over by another worker)"""
+        try:
+            with open(lock, "r") as f:
+                return json.load(f).get("Worker", None) == self.worker
+        except (IOError, OSError, ValueError):
+            return False
+
+    def _release(self, lock):
+        """Only for internal use (removes the lock file unless another worker took it over)"""
+        if self._owns(lock):
+            os.remove(lock)
+        else:
+            logger.warning("%s was taken over by another worker" % os.path.basename(lock))
+
+    def _claim(self, features_file, task):
+        """Only for internal use
+
+        Returns:
+            True if the unit was claimed, False if another worker has it, None if it is done (or given up)
+        """
+        if self.is_done(features_file, task) or len(self.failures(features_file, task)) >= self.max_attempts:
+            return None
+
+        lock = self._filename(features_file, task, "lock")
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            # Take over the claim of a dead worker
+            try:
+                age = time.time() - os.path.getmtime(lock)
+            except OSError: # Released meanwhile
+                return False
+            if age < self.stale_after:
+                return False
+            try:
+                # Only one worker can rename the stale lock file away
+                stale = "%s.stale.%s" % (lock, self.worker.replace(":", "."))
+                os.rename(lock, stale)
+                os.remove(stale)
+            except OSError:
+                return False
+            logger.warning("Taking over %s (not touched for %is)" % (os.path.basename(lock), age))
+            return self._claim(features_file, task)
+
+        with os.fdopen(fd, "w") as f:
+            json.dump({"Worker": self.worker, "Start": time.time()}, f)
+
+        # The unit might have been finished after the check above
+        if self.is_done(features_file, task) or len(self.failures(features_file, task)) >= self.max_attempts:
+            os.remove(lock)
+            return None
+        return True
+
+    def _heartbeat(self, lock, stop):
+        """Only for internal use (touches the lock file until stop is set)"""
+        while not stop.wait(self.stale_after / 5.0):
+            if not self._owns(lock):
+                logger.warning("Lost %s" % os.path.basename(lock))
+                return
+            try:
+                os.utime(lock, None)
+            except OSError:
+                logger.warning("Lost %s" % os.path.basename(lock))
+                return
+
+    def units(self, files, task):
+        """Claim and yield the features files whose task is not done yet, until all are done.
+
+        Args:
+            files (list): Features files
+            task (str): Name of the task (eg. "models")
+
+        Yields:
+            (features file, record): Information can be added to the record (dict), it is
+            saved in the done file together with the timings when the next unit is requested.
+            Set record["Failed"] (eg. the failed stages) or record["Error"] if the unit failed,
+            it is then released for another attempt instead of being marked as done
+        """
+        while True:
+            waiting = 0
+            retry = 0
+            for features_file in files:
+                claimed = self._claim(features_file, task)
+                if claimed is None:
+                    continue
+                if not claimed:
+                    waiting += 1
+                    continue
+
+                lock = self._filename(features_file, task, "lock")
+                stop = threading.Event()
+                heartbeat = threading.Thread(target=self._heartbeat, args=(lock, stop))
+                heartbeat.daemon = True
+                heartbeat.start()
+
+                record = {"Worker": self.worker, "Start": time.time()}
+                try:
+                    yield features_file, record
+                finally:
+                    stop.set()
+                    heartbeat.join()
+
+                record["End"] = time.time()
+                record["Duration"] = record["End"] - record["Start"]
+
+                if not self._owns(lock):
+                    # Taken over after this worker was considered dead, the new owner finishes it
+                    logger.warning("%s was taken over by another worker, discarding the result" % os.path.basename(lock))
+                    continue
+
+                if record.get("Failed") or record.get("Error"):
+                    attempts = self._add_failure(features_file, task, record)
+                    if attempts < self.max_attempts:
+                        logger.warning("%s failed (attempt %i of %i), releasing it" % (os.path.basename(lock), attempts, self.max_attempts))
+                        retry += 1
+                    else:
+                        logger.error("%s failed %i times, giving up" % (os.path.basename(lock), attempts))
+                    self._release(lock)
+                    continue
+
+                done = self._filename(features_file, task, "done")
+                with open(done + ".tmp", "w") as f:
+                    json.dump(record, f, indent=4, sort_keys=True)
+                os.rename(done + ".tmp", done)
+                self._release(lock)
+
+            if waiting == 0 and retry == 0:
+                return
+
+            # Other workers might die, so wait for their units to be done or become stale
+            logger.info("%i units are claimed by other workers and %i failed units are tried again, waiting" % (waiting, retry))
+            time.sleep(self.poll_interval)
+
+    def report(self, task):
+        """Log the time spent on the task per features file and the slowest stages
+
+        Args:
+            task (str): Name of the task
+        """
+        suffix = ".%s.done" % task
+        failed_suffix = ".%s.failed" % task
+        records = dict()
+        failures = dict()
+        for f in sorted(os.listdir(self.path)):
+            if f.endswith(suffix):
+                with open(os.path.join(self.path, f), "r") as fp:
+                    records[f[:-len(suffix)]] = json.load(fp)
+            elif f.endswith(failed_suffix):
+                with open(os.path.join(self.path, f), "r") as fp:
+                    failures[f[:-len(failed_suffix)]] = json.load(fp)
+
+        if len(records) > 0:
+            logger.info("Time spent on %s:" % task)
+        for name, record in sorted(records.items(), key=lambda r: -r[1]["Duration"]):
+            stages = sorted(record.get("Stages", {}).items(), key=lambda s: -s[1])[:3]
+            logger.info("  %-40s %10.1fs (%s)%s" % (name, record["Duration"], record["Worker"],
+                        "" if len(stages) == 0 else ", slowest: " + ", ".join("%s %.1fs" % s for s in stages)))
+
+        for name, attempts in sorted(failures.items()):
+            if name not in records:
+                logger.error("  %-40s failed %i times (last: %s)" % (name, len(attempts),
+                             attempts[-1].get("Failed") or attempts[-1].get("Error", "").strip().split("\n")[-1]))
@@ -3,10 +3,13 @@ import os
 from common import utils, logger
 import sys
 import time
+import fcntl
+import socket
+import multiprocessing
 import traceback
+import yaml
 
 import tensorflow as tf
-import tensorflow_hub as hub
 import numpy as np
 import h5py
 from tqdm import tqdm
@@ -23,9 +26,17 @@ class FeatureExtractorBase(object):
     LAYER_NAME          = "---"
     OUTPUT_SHAPE        = (None)
     RECEPTIVE_FIELD     = {'stride': (None, None), 'size': (None, None)}
+    LIBRARY_VERSION     = ""       # Version of the library providing the model (part of the model cache key)
+
+    def __init__(self):
+        self.model = self.load_cached_model()
+
+    def __build_model__(self): # Should be implemented by child class
+        """Build the (truncated) Keras model of the extractor"""
+        raise NotImplementedError()
 
     def extract_batch(self, batch): # Should be implemented by child class
-        """Extract the features of batch of images"""
+        """Extract the features of batch of images (use self.__run_model__(batch))"""
         pass  
     
     def format_image(self, image):  # Can be overridden by child class
@@ -42,11 +53,88 @@ class FeatureExtractorBase(object):
     # Common functionality #
     ########################
 
+    # Compiled model functions for a batch of one and a full batch (see compile)
+    __compiled__ = None
+
+    def __input_shape__(self):
+        """Shape of a single input of the model (without batch dimension)"""
+        shape = (self.IMG_SIZE, self.IMG_SIZE, 3)
+        if self.TEMPORAL_BATCH_SIZE > 1:
+            shape = (self.TEMPORAL_BATCH_SIZE,) + shape
+        return shape
+
+    def compile(self, batch_size=None, xla=False):
+        """Use a compiled model with a fixed input shape instead of running it eagerly.
+        Smaller batches (eg. the last one) are padded to the fixed shape,
+        so the graph is only traced once. Single images use their own graph.
+        Args:
+            batch_size (int): Fixed batch size (Default: Autotuned batch size, see get_batch_size)
+            xla (bool): Use XLA JIT compilation
+
+        Returns:
+            batch_size (int)
+        """
+        if batch_size is None:
+            if self.__compiled__ is not None:
+                batch_size = self.__compiled__["batch_size"]
+            else:
+                batch_size = self.get_batch_size()
+        
+        if batch_size < 1:
+            raise ValueError("Compiled extraction needs a batch size of at least 1 (%s)" % batch_size)
+        
+        def _function(size):
+            signature = [tf.TensorSpec(shape=(size,) + self.__input_shape__(), dtype=tf.float32)]
+            return tf.function(lambda batch: self.model(batch, training=False),
+                               input_signature=signature,
+                               experimental_compile=xla)
+
+        self.__compiled__ = {
+            "batch_size": batch_size,
+            "xla": xla,
+            1: _function(1),
+            batch_size: _function(batch_size)
+        }
+        return batch_size
+
+    def __run_model__(self, batch):
+        """Run self.model on a batch, using the TFLite interpreter if use_tflite was called,
+        overlapping tiles if use_tiles was called or the compiled functions if compile was called"""
+        if self.__tiled__ is not None:
+            return self.__run_tiled__(batch)
+
+        if self.__tflite__ is not None:
+            return self.__run_tflite__(batch)
+
+        if self.__compiled__ is None:
+            return self.model(batch)
+        
+        batch = tf.cast(batch, tf.float32)
+        count = int(batch.shape[0])
+
+        if count == 1:
+            return self.__compiled__[1](batch)
+
+        batch_size = self.__compiled__["batch_size"]
+        outputs = list()
+        for start in range(0, count, batch_size):
+            part = batch[start:start + batch_size]
+            current_batch_size = int(part.shape[0])
+            
+            # Pad the batch to the fixed size and discard the padding afterwards
+            if current_batch_size < batch_size:
+                padding = tf.zeros((batch_size - current_batch_size,) + tuple(part.shape[1:]), dtype=part.dtype)
+                part = tf.concat([part, padding], axis=0)
+            
+            outputs.append(self.__compiled__[batch_size](part)[:current_batch_size])
+        
+        return outputs[0] if len(outputs) == 1 else tf.concat(outputs, axis=0)
+
     def extract(self, image):
-        """Extract the features of a single image"""
+        """Extract the features of a single image (reduced, if a projection is loaded)"""
         # A single image is of shape (w, h, 3), but the network wants (None, w, h, 3) as input
         batch = tf.expand_dims(image, 0) # Expand dimension so single image is a "batch" of one image
-        return tf.squeeze(self.extract_batch(batch)) # Remove unnecessary output dimension
+        return self.__project__(tf.squeeze(self.extract_batch(batch))) # Remove unnecessary output dimension
     
     def extract_frame_array(self, patches, **kwargs):
         """Loads a set of files, extracts the features and saves them to file
@@ -63,66 +151,193 @@ class FeatureExtractorBase(object):
 
         return self.extract_dataset(dataset, total, **kwargs)
 
-    def extract_files(self, files=consts.EXTRACT_FILES, **kwargs):
+    def extract_files(self, files=consts.EXTRACT_FILES, num_parallel_reads=None, **kwargs):
         """Loads a set of files, extracts the features and saves them to file
         Args:
             files (str / str[]): TFRecord file(s) extracted by rosbag_to_tfrecord
+            num_parallel_reads (int): Number of TFRecord files read in parallel (see utils.load_dataset)
             For **kwargs see extract_dataset
 
         Returns:
             success (bool)
         """
-        dataset, total = utils.load_dataset(files)
+        dataset, total = utils.load_dataset(files, num_parallel_reads=num_parallel_reads)
         return self.extract_dataset(dataset, total, **kwargs)
     
-    def extract_dataset(self, dataset, total, output_file="", batch_size=None, compression=None, compression_opts=None, **kwargs):
+    def extract_dataset(self, dataset, total, output_file="", batch_size=None, compression=None, compression_opts=None, storage_dtype="float32",
+                        quantization_samples=100, reduction=None, reduction_dims=64, reduction_samples=1000, reduction_seed=42,
+                        shard=None, shard_mode="strided", calibration_file=None, roi=None, dedup_tolerance=None, swmr=False, **kwargs):
         """Loads a set of files, extracts the features and saves them to file
         Args:
             dataset (tf.data.Dataset): Dataset containing the input data
             total (int): Number of items in Dataset
             output_file (str): Filename and path of the output file
-            batch_size (str): Size of image batches fed to the extractor. Set to 0 for no batching. (Default: self.BATCH_SIZE)
+            batch_size (int): Size of image batches fed to the extractor. Set to 0 for no batching.
+                              (Default: Autotuned batch size of this machine, see get_batch_size)
             compression (str): Output file compression, set to None for no compression (Default: None), lzf is feasable, gzip can be extremely slow combined with HDF5
             compression_opts (str): Compression level, set to None for no compression (Default: None)
+            storage_dtype (str): Data type of the stored features (Default: float32)
+                                 float16: Half the size, values above 65504 become inf
+                                 int8:    A quarter of the size, quantized with a per-channel scale and offset
+                                          calibrated before extracting (saved as attributes of the features)
+            quantization_samples (int): Number of frames (spread over the whole dataset) the int8 quantization
+                                        is calibrated on (Default: 100)
+            reduction (str): Reduce the number of feature channels (Default: None)
+                             pca:    Incremental PCA fitted on the patches inside the ROI of reduction_samples
+                                     frames spread over the whole dataset (not only the shard)
+                             random: Seeded Gaussian random projection
+                             The projection is saved to the output file (see load_projection)
+            reduction_dims (int): Number of channels after the reduction (Default: 64)
+            reduction_samples (int): Number of frames used to fit the PCA (Default: 1000)
+            reduction_seed (int): Seed of the random projection (Default: 42)
+            shard (tuple): (k, n) Only extract shard k of n, to be merged by utils.merge_feature_shards (Default: None)
+            shard_mode (str): strided:    Shard k contains every n-th frame, starting at frame k (Default)
+                              contiguous: Shard k contains the k-th of n contiguous blocks of frames
+            calibration_file (str): The projection and the int8 quantization are calibrated once by the first
+                                    shard and saved to this file, all shards load them from there, so they can be merged
+                                    (Default: "{NAME}.calibration.h5" next to the output file)
+            roi (str / tuple): Region of interest, a crop box "x0,y0,x1,y1" in image coordinates or a mask image
+                               (see utils.parse_roi). Features of patches whose center lies outside are stored
+                               as zeros and flagged in the "roi" dataset, so the anomaly models skip them (Default: None)
+            dedup_tolerance (float): Reuse the features of the last extracted frame for frames whose thumbnail differs
+                                     by at most this mean absolute difference (in gray levels, eg. 2.0), instead of
+                                     running the network on them (eg. while the robot is standing). Set to None to
+                                     extract every frame (Default: None)
+            swmr (bool): Write the output file in single-writer/multiple-reader mode, so PatchArray can read
+                         the completed rows (see the "rows_written" dataset) while the extraction is running.
+                         The attributes set at the end are written after the extraction (Default: False)
             **kwargs: Additional arguments will be saved to the output file as h5 attributes
 
         Returns:
             success (bool)
         """
 
+        if reduction not in (None, "pca", "random"):
+            raise ValueError("Reduction has to be one of None, pca or random (%s)" % reduction)
+
+        if storage_dtype not in utils.FEATURE_STORAGE_DTYPES:
+            raise ValueError("Storage dtype has to be one of %s (%s)" % (utils.FEATURE_STORAGE_DTYPES, storage_dtype))
+
+        if shard is not None:
+            shard_index, shard_count = shard
+            if shard_count < 1 or not 0 <= shard_index < shard_count:
+                raise ValueError("Invalid shard %i of %i" % (shard_index, shard_count))
+
         if output_file == "":
             output_dir = consts.FEATURES_PATH
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
-            output_file = os.path.join(output_dir, self.NAME + ".h5")
+            if shard is None:
+                output_file = os.path.join(output_dir, self.NAME + ".h5")
+            else:
+                output_file = os.path.join(output_dir, "%s.shard%.3d-of-%.3d.h5" % (self.NAME, shard_index, shard_count))
             logger.info("Output file set to %s" % output_file)
         
         if batch_size is None:
-            batch_size = self.BATCH_SIZE
+            batch_size = self.get_batch_size()
+
+        # The crop box is given in coordinates of the original images
+        image_shape = None
+        if roi is not None:
+            utils.parse_roi(roi) # Fail early
+            image_shape = tuple(next(iter(dataset))[0].shape[-3:-1])
+
+        if dedup_tolerance is not None and (batch_size < 1 or self.TEMPORAL_BATCH_SIZE > 1):
+            logger.warning("%s: Frame deduplication needs batches of single images, extracting every frame" % self.NAME)
+            dedup_tolerance = None
 
         # Preprocess images
-        dataset = dataset.map(lambda image, time: (self.format_image(image), time),
-                              num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        if dedup_tolerance is None:
+            dataset = dataset.map(lambda image, time: (self.format_image(image), time),
+                                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        else:
+            dataset = dataset.map(lambda image, time: (self.format_image(image), time, self.__thumbnail__(image)),
+                                  num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
         # Call internal transformations (eg. temporal windowing for 3D networks)
         # dataset, total = self.__transform_dataset__(dataset, total)
 
+        # Fit the projection and calibrate the quantization before extracting
+        # (needs separate passes over samples of the whole dataset)
+        self.projection = None
+        scale, offset = None, None
+
+        def _calibrate():
+            calibration = dict()
+            if reduction is not None:
+                self.projection = calibration["projection"] = self.fit_projection(dataset, total, reduction, reduction_dims,
+                                                                                   reduction_samples, reduction_seed, batch_size,
+                                                                                   roi=roi, image_shape=image_shape)
+            if storage_dtype == "int8":
+                # Calibrated on the projected features
+                calibration["quantization"] = self.calibrate_quantization(dataset, total, quantization_samples, batch_size,
+                                                                          roi=roi, image_shape=image_shape)
+            return calibration
+
+        if reduction is not None or storage_dtype == "int8":
+            if shard is None:
+                calibration = _calibrate()
+            else:
+                # All shards need the same projection and quantization to be merged
+                if calibration_file is None:
+                    calibration_file = os.path.join(os.path.dirname(os.path.abspath(output_file)), "%s.calibration.h5" % self.NAME)
+                self.__shared_calibration__(calibration_file, _calibrate,
+                                            {"Extractor": self.NAME, "Total": total, "ROI": roi,
+                                             "Reduction": reduction, "Reduction dims": reduction_dims,
+                                             "Reduction samples": reduction_samples, "Reduction seed": reduction_seed,
+                                             "Storage dtype": storage_dtype, "Quantization samples": quantization_samples})
+                self.load_projection(calibration_file)
+                calibration = dict()
+                with h5py.File(calibration_file, "r") as hf:
+                    if "quantization" in hf.keys():
+                        calibration["quantization"] = (np.array(hf["quantization/scale"]), np.array(hf["quantization/offset"]))
+            
+            if storage_dtype == "int8":
+                scale, offset = calibration["quantization"]
+
+        if shard is not None:
+            dataset, total = utils.shard_dataset(dataset, total, shard_index, shard_count, shard_mode)
+
         # Get batches (seems to be better performance wise than extracting individual images)
         if batch_size > 0:
             dataset = dataset.batch(batch_size)
 
         # IO stuff
-        hf = h5py.File(output_file, "x")
+        if swmr:
+            hf = h5py.File(output_file, "x", libver="latest")
+        else:
+            hf = h5py.File(output_file, "x")
     
+        exception = None
         try:
             # Add metadata to the output file
             hf.attrs["Extractor"]           = self.NAME
             hf.attrs["Batch size"]          = batch_size
+            hf.attrs["Compiled"]            = self.__compiled__ is not None
+            hf.attrs["XLA"]                 = self.__compiled__ is not None and self.__compiled__["xla"]
+            hf.attrs["TFLite"]              = self.__tflite__["filename"] if self.__tflite__ is not None else "None"
+            hf.attrs["Tiles"]               = self.__tiled__["tiles"] ** 2 if self.__tiled__ is not None else 1
             hf.attrs["Compression"]         = str(compression)
             hf.attrs["Compression options"] = str(compression_opts)
             hf.attrs["Temporal batch size"] = self.TEMPORAL_BATCH_SIZE
             hf.attrs["Receptive field"]     = self.RECEPTIVE_FIELD["size"]
             hf.attrs["Image size"]          = self.IMG_SIZE
+            hf.attrs["Storage dtype"]       = storage_dtype
+            hf.attrs["Reduction"]           = str(reduction)
+            hf.attrs["ROI"]                 = str(roi)
+            hf.attrs["Dedup tolerance"]     = str(dedup_tolerance)
+
+            if shard is not None:
+                hf.attrs["Shard index"] = shard_index
+                hf.attrs["Shard count"] = shard_count
+                hf.attrs["Shard mode"]  = shard_mode
+
+            if self.projection is not None:
+                g = hf.create_group("projection")
+                g.attrs["Method"] = reduction
+                g.attrs["Seed"]   = reduction_seed
+                g.create_dataset("components", data=self.projection[0])
+                g.create_dataset("mean",       data=self.projection[1])
 
             for key, value in kwargs.items():
                 if value is not None:
@@ -134,42 +349,89 @@ class FeatureExtractorBase(object):
             
             start = time.time()
             counter = 0
+            clipped = 0
+            reused  = 0
+            dedup_state = dict()
 
             hf.attrs["Start"] = start
             
             # Create arrays to store output
             feature_dataset = None # We don't know the feature shape yet
+            roi_mask        = None
             time_dataset    = hf.create_dataset("times",
                                                 shape=(total,),
                                                 dtype=np.uint64,
                                                 compression=compression,
                                                 compression_opts=compression_opts)
+            # Number of completed rows (readers might open the file while it is still growing)
+            rows_dataset    = hf.create_dataset("rows_written", data=np.zeros((1,), dtype=np.uint64))
             
             # Loop over the dataset
             with tqdm(desc="Extracting features (batch size: %i)" % batch_size, total=total, file=sys.stderr) as pbar:
                 for batch in dataset:
                     # Extract features
-                    feature_batch = self.extract_batch(batch[0]) # This is where the magic happens
+                    if dedup_tolerance is None:
+                        feature_batch = self.extract_batch(batch[0]) # This is where the magic happens
+                        feature_batch = self.__project__(feature_batch).numpy()
+                    else:
+                        feature_batch, r = self.__extract_deduplicated__(batch[0], batch[2].numpy(), dedup_state, dedup_tolerance)
+                        reused += r
+                        pbar.set_postfix({"Reused": reused})
 
                     current_batch_size = len(feature_batch)
 
+                    if feature_dataset is None and roi is not None:
+                        if feature_batch.ndim == 4:
+                            roi_mask = utils.roi_patch_mask(roi, image_shape, feature_batch.shape[1:3])
+                            hf.create_dataset("roi", data=roi_mask)
+                            hf.attrs["Patches in ROI"] = np.count_nonzero(roi_mask)
+                        else:
+                            logger.warning("%s has no spatial output, ignoring the ROI" % self.NAME)
+
                     if feature_dataset is None:
                         # Create the array to store the features now
                         feature_dataset = hf.create_dataset("features",
                                                             shape=(total,) + tuple(feature_batch[0].shape),
                                                             chunks=(1,) + tuple(feature_batch[0].shape),
-                                                            dtype=np.float32,
+                                                            dtype=np.dtype(storage_dtype),
                                                             compression=compression,
                                                             compression_opts=compression_opts)
+                        
+                        if storage_dtype == "int8":
+                            feature_dataset.attrs["scale"] = scale
+                            feature_dataset.attrs["offset"] = offset
+
+                        if swmr:
+                            # No datasets or attributes can be added from here on
+                            hf.swmr_mode = True
+
+                    # Patches outside the ROI are stored as zeros (compress to almost nothing)
+                    if roi_mask is not None:
+                        feature_batch[:, ~roi_mask] = offset if storage_dtype == "int8" else 0
+
+                    if storage_dtype == "int8":
+                        feature_batch, c = utils.quantize_features(feature_batch, scale, offset)
+                        clipped += c
+                    elif storage_dtype == "float16":
+                        feature_batch = feature_batch.astype(np.float16)
+                        clipped += np.count_nonzero(np.isinf(feature_batch))
 
                     # Save the features and their metadata to the arrays
-                    feature_dataset[counter : counter + current_batch_size] = feature_batch.numpy()
+                    feature_dataset[counter : counter + current_batch_size] = feature_batch
                     time_dataset[counter : counter + current_batch_size]    = batch[1].numpy()
 
                     # Count and update progress bar
                     counter += current_batch_size
                     pbar.update(n=current_batch_size)
 
+                    # The counter is only updated once the rows are on disk
+                    if swmr:
+                        feature_dataset.flush()
+                        time_dataset.flush()
+                    rows_dataset[0] = counter
+                    if swmr:
+                        rows_dataset.flush()
+
             ## Variant where we first store everything in RAM
             # feature_dataset = None # We don't know the feature shape yet
             # time_dataset    = np.empty((total,),   dtype=np.uint64)
@@ -207,21 +469,591 @@ class FeatureExtractorBase(object):
             #                   compression=compression,
             #                   compression_opts=compression_opts)
         except:
-            exc = traceback.format_exc()
-            logger.error(exc)
-            hf.attrs["Exception"] = exc
+            exception = traceback.format_exc()
+            logger.error(exception)
             return False
         finally:
             end = time.time()
+            if hf.swmr_mode:
+                # Attributes can't be written in SWMR mode
+                hf.close()
+                hf = h5py.File(output_file, "a")
+            if exception is not None:
+                hf.attrs["Exception"] = exception
             hf.attrs["End"] = end
             hf.attrs["Duration"] = end - start
             hf.attrs["Duration (formatted)"] = utils.format_duration(end - start)
             hf.attrs["Number of frames extracted"] = counter
             hf.attrs["Number of total frames"] = total
+            hf.attrs["Clipped values"] = clipped
+            hf.attrs["Reused frames"] = reused
+            hf.attrs["Reuse rate"] = reused / float(counter) if counter > 0 else 0.0
             hf.close()
 
         return True
 
+    ########################
+    #  Frame deduplication #
+    ########################
+
+    def __thumbnail__(self, image):
+        """Cheap signature of an (unformatted) image: 16x16 grayscale thumbnail in gray levels"""
+        image = tf.image.rgb_to_grayscale(tf.cast(image, tf.float32))
+        return tf.image.resize(image, (16, 16), method="area")
+
+    def __extract_deduplicated__(self, batch, thumbnails, state, tolerance):
+        """Extract the features of a batch, but only run the network on frames that differ from
+        the last extracted frame. The others get a copy of its features.
+        Args:
+            batch (tf.Tensor): Formatted images
+            thumbnails (np.array): Thumbnails of the images (see __thumbnail__)
+            state (dict): Thumbnail and features of the last extracted frame (carried over between batches)
+            tolerance (float): Maximum mean absolute difference of the thumbnails
+
+        Returns:
+            Tuple (features (np.array), number of reused frames (int))
+        """
+        # Compare against the last extracted frame (not the previous frame), so slow changes add up
+        compute = list()
+        source = np.empty(len(thumbnails), dtype=np.int64) # Index in the computed features, -1 for the previous batch
+        for i, thumbnail in enumerate(thumbnails):
+            if "thumbnail" not in state or np.mean(np.abs(thumbnail - state["thumbnail"])) > tolerance:
+                compute.append(i)
+                state["thumbnail"] = thumbnail
+            source[i] = len(compute) - 1
+
+        if len(compute) > 0:
+            features = self.extract_batch(tf.gather(batch, compute))
+            features = self.__project__(features).numpy()
+        else:
+            features = state["features"][np.newaxis]
+
+        result = features[np.maximum(source, 0)]
+        if len(compute) > 0 and compute[0] > 0:
+            result[:compute[0]] = state["features"]
+
+        state["features"] = features[-1]
+        return result, len(thumbnails) - len(compute)
+
+    ########################
+    #     Model cache      #
+    ########################
+
+    def model_cache_filename(self):
+        """Location of the cached truncated model, keyed by extractor name and library versions"""
+        version = "tf-%s" % tf.version.VERSION
+        if self.LIBRARY_VERSION:
+            version += "_%s" % self.LIBRARY_VERSION
+        return utils.get_cache_path("models", "%s_%s.h5" % (self.NAME, version))
+
+    def load_cached_model(self):
+        """Load the truncated model from the cache or build it (see __build_model__)
+        and save it to the cache, so the full backbone is only built once
+
+        Returns:
+            tf.keras.Model
+        """
+        filename = self.model_cache_filename()
+        
+        if os.path.exists(filename):
+            try:
+                model = tf.keras.models.load_model(filename, compile=False)
+                model.trainable = False
+                return model
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logger.warning("Could not load cached model %s, building it again: %s" % (filename, traceback.format_exc()))
+
+        model = self.__build_model__()
+        
+        try:
+            # Save to a temporary file first, so parallel workers never load a half written file
+            temp_filename = "%s.%i.tmp.h5" % (os.path.splitext(filename)[0], os.getpid())
+            model.save(temp_filename, include_optimizer=False)
+            os.rename(temp_filename, filename)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            logger.warning("Could not cache model %s: %s" % (filename, traceback.format_exc()))
+
+        return model
+
+    ########################
+    #        TFLite        #
+    ########################
+
+    # TFLite interpreter used instead of self.model (see use_tflite)
+    __tflite__ = None
+
+    def tflite_filename(self, quantize=False):
+        """Default location of the exported TFLite model in the cache directory"""
+        return utils.get_cache_path("tflite", "%s%s.tflite" % (self.NAME, "_int8" if quantize else ""))
+
+    def export_tflite(self, filename=None, quantize=False, dataset=None, samples=100, total=None):
+        """Export the (truncated) model to a TFLite flatbuffer
+        Args:
+            filename (str): Output file (Default: see tflite_filename)
+            quantize (bool): Post-training int8 quantization of weights and activations
+            dataset (tf.data.Dataset): Images (image, time) used to calibrate the quantization
+            samples (int): Number of images used for calibration. They are spread evenly over
+                           the dataset, so the calibration covers the whole recording
+            total (int): Number of images in the dataset (Default: cardinality of the dataset)
+
+        Returns:
+            filename (str)
+        """
+        if filename is None:
+            filename = self.tflite_filename(quantize)
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        
+        if quantize:
+            if dataset is None:
+                raise ValueError("A dataset is needed to calibrate the quantization")
+            
+            if samples < 1:
+                raise ValueError("At least one image is needed to calibrate the quantization")
+
+            if total is None:
+                total = int(tf.data.experimental.cardinality(dataset))
+            
+            if total > 0:
+                step = max(total // samples, 1)
+                calibration = dataset.enumerate().filter(lambda i, data: i % step == 0)
+                calibration = calibration.map(lambda i, data: self.format_image(data[0])).take(samples)
+            else:
+                logger.warning("Size of the dataset is unknown, calibrating on the first %i images" % samples)
+                calibration = dataset.map(lambda image, *args: self.format_image(image)).take(samples)
+
+            def _representative_dataset():
+                for image in calibration:
+                    yield [tf.expand_dims(tf.cast(image, tf.float32), 0)]
+
+            # Input and output stay float32, so the interpreter is a drop-in replacement
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = _representative_dataset
+
+        logger.info("Converting %s to TFLite%s" % (self.NAME, " (int8)" if quantize else ""))
+        with open(filename, "wb") as f:
+            f.write(converter.convert())
+        
+        return filename
+
+    def use_tflite(self, filename=None, quantize=False, num_threads=None):
+        """Run the extraction through the TFLite interpreter instead of TensorFlow
+        Args:
+            filename (str): TFLite model (Default: see tflite_filename, has to be exported first)
+            quantize (bool): Use the int8 model at the default location
+            num_threads (int): Number of CPU threads used by the interpreter (Default: Number of CPUs)
+
+        Returns:
+            None
+        """
+        if filename is None:
+            filename = self.tflite_filename(quantize)
+        
+        if not os.path.exists(filename):
+            raise ValueError("TFLite model does not exist, export it first (%s)" % filename)
+        
+        if num_threads is None:
+            num_threads = multiprocessing.cpu_count()
+
+        try:
+            interpreter = tf.lite.Interpreter(model_path=filename, num_threads=num_threads)
+        except TypeError: # Older TensorFlow versions
+            interpreter = tf.lite.Interpreter(model_path=filename)
+
+        self.__tflite__ = {
+            "interpreter": interpreter,
+            "input": interpreter.get_input_details()[0]["index"],
+            "output": interpreter.get_output_details()[0]["index"],
+            "shape": None,
+            "filename": filename
+        }
+
+    def __run_tflite__(self, batch):
+        """Run the TFLite interpreter on a batch"""
+        interpreter = self.__tflite__["interpreter"]
+        batch = np.asarray(batch, dtype=np.float32)
+        
+        # Only reallocate if the batch size changed
+        if self.__tflite__["shape"] != batch.shape:
+            interpreter.resize_tensor_input(self.__tflite__["input"], batch.shape)
+            interpreter.allocate_tensors()
+            self.__tflite__["shape"] = batch.shape
+
+        interpreter.set_tensor(self.__tflite__["input"], batch)
+        interpreter.invoke()
+        return tf.convert_to_tensor(interpreter.get_tensor(self.__tflite__["output"]))
+
+    ########################
+    #    Tiled inference   #
+    ########################
+
+    # Tile model and geometry used instead of self.model (see use_tiles)
+    __tiled__ = None
+
+    def use_tiles(self, tiles=2, margin=None, tile_batch_size=None):
+        """Run the model on overlapping tiles instead of the full image to bound the memory
+        needed per image. Each tile covers a block of output cells and is padded by a margin
+        of input context. The outputs are stitched back to the shape of the full feature map.
+
+        The margin trades accuracy for memory: With a margin of half the receptive field
+        the tiled features equal the features of the full image, but the tiles of the large
+        image extractors would then be larger than the image itself (eg. ~768 px tiles for
+        the 449 px input of ResNet50V2_LargeImage), which needs more memory and compute
+        instead of less. The margin is therefore capped so the tiles stay smaller than the
+        image. Cells closer to a tile border than half the receptive field then see less
+        context than in the full image, so their features differ slightly.
+        Args:
+            tiles (int): Number of tiles per side (tiles * tiles tiles per image)
+            margin (int): Input context around each tile in pixels, rounded up to the stride
+                          (Default: Half the receptive field size, but at most the largest
+                          margin for which the tiles are smaller than the image)
+            tile_batch_size (int): Maximum number of tiles run at once (Default: All tiles of a batch)
+
+        Returns:
+            Tuple (tile input shape, number of tiles per image)
+        """
+        if self.TEMPORAL_BATCH_SIZE > 1 or self.OUTPUT_SHAPE is None or len(self.OUTPUT_SHAPE) != 3:
+            raise ValueError("Tiled inference needs a 2D network with a spatial output (%s)" % self.NAME)
+
+        stride_h, stride_w = [int(s) for s in self.RECEPTIVE_FIELD["stride"]]
+        out_h, out_w = self.OUTPUT_SHAPE[:2]
+
+        # Output cells per tile
+        cells_h, cells_w = -(-out_h // tiles), -(-out_w // tiles)
+
+        # Largest margin in output cells for which the tiles are smaller than the image
+        max_margin_h = ((self.IMG_SIZE - 1) // stride_h - cells_h) // 2
+        max_margin_w = ((self.IMG_SIZE - 1) // stride_w - cells_w) // 2
+        if max_margin_h < 0 or max_margin_w < 0:
+            raise ValueError("%s: %i x %i tiles are not smaller than the image (%i), use more tiles" % (self.NAME, tiles, tiles, self.IMG_SIZE))
+
+        # Margin in output cells
+        if margin is None:
+            margin = self.RECEPTIVE_FIELD["size"][0] / 2.0
+            margin_h = min(int(np.ceil(margin / float(stride_h))), max_margin_h)
+            margin_w = min(int(np.ceil(margin / float(stride_w))), max_margin_w)
+            if margin_h * stride_h < margin or margin_w * stride_w < margin:
+                logger.warning("%s: The tile margin is capped to %ix%i px (half the receptive field is %i px), "
+                               "the features of cells close to the tile borders differ slightly from the full image" %
+                               (self.NAME, margin_h * stride_h, margin_w * stride_w, margin))
+        else:
+            margin_h, margin_w = int(np.ceil(margin / float(stride_h))), int(np.ceil(margin / float(stride_w)))
+            if margin_h > max_margin_h or margin_w > max_margin_w:
+                raise ValueError("%s: With a margin of %i px the tiles are not smaller than the image (%i), "
+                                 "use at most %i px or more tiles" % (self.NAME, margin, self.IMG_SIZE, min(max_margin_h * stride_h, max_margin_w * stride_w)))
+
+        tile_shape = ((cells_h + 2 * margin_h) * stride_h, (cells_w + 2 * margin_w) * stride_w, 3)
+
+        # Same weights, different input shape (the networks are fully convolutional)
+        model = tf.keras.models.clone_model(self.model, input_tensors=tf.keras.Input(shape=tile_shape))
+        model.set_weights(self.model.get_weights())
+        model.trainable = False
+
+        # The exact output size depends on the padding of the network
+        tile_out_h, tile_out_w = model.output_shape[1:3]
+        if tile_out_h < cells_h + margin_h or tile_out_w < cells_w + margin_w:
+            raise ValueError("%s: Tiles of %ix%i only produce %ix%i output cells" % (self.NAME, tile_shape[0], tile_shape[1], tile_out_h, tile_out_w))
+
+        self.__tiled__ = {
+            "tiles": tiles,
+            "tile_shape": tile_shape,
+            "cells": (cells_h, cells_w),
+            "crop": (margin_h, margin_w),
+            "margin": (margin_h * stride_h, margin_w * stride_w),
+            "stride": (stride_h, stride_w),
+            "tile_batch_size": tile_batch_size,
+            "function": tf.function(lambda batch: model(batch, training=False),
+                                    input_signature=[tf.TensorSpec(shape=(None,) + tile_shape, dtype=tf.float32)])
+        }
+        return tile_shape, tiles * tiles
+
+    def __run_tiled__(self, batch):
+        """Run the tile model on a batch and stitch the outputs to full feature maps"""
+        t = self.__tiled__
+        tiles = t["tiles"]
+        tile_h, tile_w = t["tile_shape"][:2]
+        cells_h, cells_w = t["cells"]
+        crop_h, crop_w = t["crop"]
+        margin_h, margin_w = t["margin"]
+        stride_h, stride_w = t["stride"]
+        out_h, out_w = self.OUTPUT_SHAPE[:2]
+
+        batch = tf.cast(batch, tf.float32)
+        count = int(batch.shape[0])
+
+        # Pad the images with the margin (and up to a multiple of the tile step)
+        pad_bottom = max(0, (tiles - 1) * cells_h * stride_h + tile_h - margin_h - int(batch.shape[1]))
+        pad_right  = max(0, (tiles - 1) * cells_w * stride_w + tile_w - margin_w - int(batch.shape[2]))
+        padded = tf.pad(batch, [[0, 0], [margin_h, pad_bottom], [margin_w, pad_right], [0, 0]])
+
+        # (count * tiles * tiles, tile_h, tile_w, 3), ordered by image, tile row, tile column
+        crops = list()
+        for v in range(tiles):
+            for u in range(tiles):
+                y, x = v * cells_h * stride_h, u * cells_w * stride_w
+                crops.append(padded[:, y:y + tile_h, x:x + tile_w])
+        tile_batch = tf.reshape(tf.stack(crops, axis=1), (-1, tile_h, tile_w, int(batch.shape[3])))
+
+        tile_batch_size = t["tile_batch_size"] or int(tile_batch.shape[0])
+        outputs = list()
+        for start in range(0, int(tile_batch.shape[0]), tile_batch_size):
+            output = t["function"](tile_batch[start:start + tile_batch_size])
+            outputs.append(output[:, crop_h:crop_h + cells_h, crop_w:crop_w + cells_w])
+        output = outputs[0] if len(outputs) == 1 else tf.concat(outputs, axis=0)
+
+        # Stitch: (count, tiles, tiles, cells_h, cells_w, c) -> (count, tiles * cells_h, tiles * cells_w, c)
+        channels = int(output.shape[-1])
+        output = tf.reshape(output, (count, tiles, tiles, cells_h, cells_w, channels))
+        output = tf.transpose(output, (0, 1, 3, 2, 4, 5))
+        output = tf.reshape(output, (count, tiles * cells_h, tiles * cells_w, channels))
+        return output[:, :out_h, :out_w]
+
+    ########################
+    #      Reduction       #
+    ########################
+
+    # Projection (components, mean) applied to all extracted features, None for no reduction
+    projection = None
+
+    def __project__(self, features):
+        """Apply the projection (if any) to the last axis of features"""
+        if self.projection is None:
+            return features
+        components, mean = self.projection
+        return tf.tensordot(tf.cast(features, tf.float32) - mean, components, axes=1)
+
+    def fit_projection(self, dataset, total, method="pca", dims=64, samples=1000, seed=42, batch_size=1, roi=None, image_shape=None):
+        """Fit a projection to reduce the number of feature channels
+        Args:
+            dataset (tf.data.Dataset): Dataset containing the (formatted) input data
+            total (int): Number of items in Dataset
+            method (str): "pca" (incremental PCA) or "random" (Gaussian random projection)
+            dims (int): Number of channels after the projection
+            samples (int): Number of frames used to fit the PCA (evenly spread over the dataset)
+            seed (int): Seed of the random projection
+            batch_size (int): Batch size used for extraction
+            roi (str / tuple): Only fit the PCA on the patches inside the region of interest (see utils.roi_patch_mask)
+            image_shape (tuple): (height, width) of the input images (needed for a crop box ROI)
+
+        Returns:
+            Tuple (components (D x dims), mean (D))
+        """
+        # Frames spread over the whole dataset
+        sample = dataset.shard(max(1, total // samples), 0).take(samples)
+        if batch_size > 0:
+            sample = sample.batch(batch_size)
+
+        if method == "random":
+            # Only the number of channels is needed
+            channels = self.extract_batch(next(iter(sample))[0]).shape[-1]
+            rng = np.random.RandomState(seed)
+            components = rng.normal(0.0, 1.0 / np.sqrt(dims), size=(channels, dims)).astype(np.float32)
+            return components, np.zeros((channels,), dtype=np.float32)
+
+        from sklearn.decomposition import IncrementalPCA
+        pca = IncrementalPCA(n_components=dims)
+        
+        # partial_fit needs at least dims feature vectors per call
+        buffer = list()
+        buffered = 0
+        for batch in tqdm(sample, desc="Fitting PCA (%i dimensions)" % dims, file=sys.stderr):
+            features = self.__roi_features__(self.extract_batch(batch[0]).numpy(), roi, image_shape)
+            buffer.append(features)
+            buffered += features.shape[0]
+            if buffered >= max(dims, 1000):
+                pca.partial_fit(np.concatenate(buffer))
+                buffer, buffered = list(), 0
+        
+        if buffered > 0 and (buffered >= dims or not hasattr(pca, "components_")):
+            pca.partial_fit(np.concatenate(buffer))
+
+        logger.info("PCA explains %.1f%% of the variance" % (np.sum(pca.explained_variance_ratio_) * 100))
+        return pca.components_.T.astype(np.float32), pca.mean_.astype(np.float32)
+
+    def calibrate_quantization(self, dataset, total, samples=100, batch_size=1, roi=None, image_shape=None):
+        """Calibrate the int8 quantization of the (projected) features (see utils.calibrate_quantization)
+        Args:
+            dataset (tf.data.Dataset): Dataset containing the (formatted) input data
+            total (int): Number of items in Dataset
+            samples (int): Number of frames used for the calibration (evenly spread over the dataset)
+            batch_size (int): Batch size used for extraction
+            roi (str / tuple): Only calibrate on the patches inside the region of interest (see utils.roi_patch_mask)
+            image_shape (tuple): (height, width) of the input images (needed for a crop box ROI)
+
+        Returns:
+            Tuple (scale (np.array), offset (np.array))
+        """
+        # Frames spread over the whole dataset
+        sample = dataset.shard(max(1, total // samples), 0).take(samples)
+        if batch_size > 0:
+            sample = sample.batch(batch_size)
+
+        # Only the range of every channel is needed
+        low, high = None, None
+        for batch in tqdm(sample, desc="Calibrating the quantization", file=sys.stderr):
+            features = self.__roi_features__(self.__project__(self.extract_batch(batch[0])).numpy(), roi, image_shape)
+            low  = features.min(axis=0) if low is None else np.minimum(low, features.min(axis=0))
+            high = features.max(axis=0) if high is None else np.maximum(high, features.max(axis=0))
+        return utils.calibrate_quantization(np.stack([low, high]))
+
+    def __roi_features__(self, features, roi=None, image_shape=None):
+        """Only for internal use (feature vectors of the patches inside the region of interest)"""
+        if roi is not None and features.ndim == 4:
+            features = features[:, utils.roi_patch_mask(roi, image_shape, features.shape[1:3])]
+        return features.reshape(-1, features.shape[-1])
+
+    def __shared_calibration__(self, filename, calibrate, settings):
+        """Only for internal use. Calculate the calibration (projection, quantization) that all shards of an
+        extraction share once and save it to a file. The file is locked while it is calculated,
+        so the other shards (also on other machines sharing the file system) wait for it.
+        Args:
+            filename (str): Calibration file (*.h5), uses the layout of a features file
+            calibrate (callable): Returns a dict with "projection" (components, mean) and/or "quantization" (scale, offset)
+            settings (dict): Parameters of the calibration, have to match an existing file
+
+        Returns:
+            None
+        """
+        with open(filename + ".lock", "a") as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX) # Released when the file is closed
+
+            if os.path.exists(filename):
+                with h5py.File(filename, "r") as hf:
+                    saved = dict((key, hf.attrs[key]) for key in settings.keys() if key in hf.attrs.keys())
+                if any(saved.get(key, None) != str(value) for key, value in settings.items()):
+                    raise ValueError("%s was calibrated with other settings (%s), delete it to calibrate again" % (filename, saved))
+                logger.info("Using the calibration in %s" % filename)
+                return
+
+            calibration = calibrate()
+
+            temp_filename = "%s.%i.tmp" % (filename, os.getpid())
+            with h5py.File(temp_filename, "w") as hf:
+                for key, value in settings.items():
+                    hf.attrs[key] = str(value)
+                if "projection" in calibration:
+                    g = hf.create_group("projection")
+                    g.create_dataset("components", data=calibration["projection"][0])
+                    g.create_dataset("mean",       data=calibration["projection"][1])
+                if "quantization" in calibration:
+                    g = hf.create_group("quantization")
+                    g.create_dataset("scale",  data=calibration["quantization"][0])
+                    g.create_dataset("offset", data=calibration["quantization"][1])
+            os.rename(temp_filename, filename)
+            logger.info("Saved the calibration to %s" % filename)
+
+    def load_projection(self, filename):
+        """Load the projection saved in a features file, so extract
+        returns features that match the ones in the file
+        Args:
+            filename (str): Features file (*.h5)
+
+        Returns:
+            True if the file contains a projection
+        """
+        with h5py.File(filename, "r") as hf:
+            if "projection" not in hf.keys():
+                self.projection = None
+                return False
+            self.projection = (np.array(hf["projection/components"]), np.array(hf["projection/mean"]))
+        return True
+
+    ########################
+    #  Batch size autotune #
+    ########################
+
+    def __probe_batch__(self, batch_size):
+        """Random input batch of the shape the extractor expects (used for probing)"""
+        return np.random.rand(*((batch_size,) + self.__input_shape__())).astype(np.float32)
+
+    def autotune_batch_size(self, max_batch_size=512, repeat=3):
+        """Find the batch size with the highest throughput that fits in memory by
+        doubling the batch size until the throughput drops or memory runs out.
+        Args:
+            max_batch_size (int): Largest batch size to probe
+            repeat (int): Number of timed extractions per batch size
+
+        Returns:
+            Tuple (best batch size (int), throughput in images per second (float))
+        """
+        best_batch_size, best_throughput = 1, 0.0
+        batch_size = 1
+        while batch_size <= max_batch_size:
+            try:
+                batch = self.__probe_batch__(batch_size)
+                self.extract_batch(batch) # Warm up (graph tracing, memory allocation)
+                start = time.time()
+                for _ in range(repeat):
+                    self.extract_batch(batch)
+                throughput = batch_size * repeat / (time.time() - start)
+            except (tf.errors.ResourceExhaustedError, MemoryError):
+                logger.info("%s: Batch size %i does not fit in memory" % (self.NAME, batch_size))
+                break
+            
+            logger.info("%s: Batch size %i: %.2f images/s" % (self.NAME, batch_size, throughput))
+
+            if throughput < best_throughput:
+                break
+            
+            best_batch_size, best_throughput = batch_size, throughput
+            batch_size *= 2
+
+        return best_batch_size, best_throughput
+
+    def get_batch_size(self):
+        """Get the autotuned batch size for this extractor and machine. The probe
+        only runs once per extractor and host, the result is cached in
+        {consts.CACHE_PATH}/batch_sizes.yml
+
+        Returns:
+            batch_size (int)
+        """
+        if self.BATCH_SIZE == 0: # Extractor does not support batching
+            return 0
+        
+        cache_file = utils.get_cache_path("batch_sizes.yml")
+        host = socket.gethostname()
+
+        # Tiled inference needs less memory per image
+        key = self.NAME
+        if self.__tiled__ is not None:
+            key = "%s_tiles%i" % (self.NAME, self.__tiled__["tiles"])
+
+        cache = dict()
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                cache = yaml.safe_load(f) or dict()
+        
+        if key in cache.get(host, dict()):
+            return cache[host][key]
+
+        logger.info("Autotuning batch size of %s" % self.NAME)
+        try:
+            batch_size, _ = self.autotune_batch_size()
+        except:
+            logger.error("Autotuning batch size failed, using %i: %s" % (self.BATCH_SIZE, traceback.format_exc()))
+            return self.BATCH_SIZE
+
+        # Reload the cache under a lock, other extractors might have been tuned meanwhile
+        # (eg. by other extraction workers on this host)
+        with open(cache_file + ".lock", "a") as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX) # Released when the file is closed
+            if os.path.exists(cache_file):
+                with open(cache_file, "r") as f:
+                    cache = yaml.safe_load(f) or dict()
+            cache.setdefault(host, dict())[key] = batch_size
+            
+            temp_filename = "%s.%i.tmp" % (cache_file, os.getpid())
+            with open(temp_filename, "w") as f:
+                yaml.safe_dump(cache, f, default_flow_style=False)
+            os.rename(temp_filename, cache_file)
+
+        return batch_size
+
     ########################
     #      Utilities       #
     ########################
@@ -232,6 +1064,7 @@ class FeatureExtractorBase(object):
         Args:
             handle: a callable object (subject to the conventions above), or a Python string for which hub.load() returns such a callable. A string is required to save the Keras config of this Layer.
         """
+        import tensorflow_hub as hub
         inputs = tf.keras.Input(shape=(self.IMG_SIZE, self.IMG_SIZE, 3))
         layer = hub.KerasLayer(handle,
                                trainable=False,
@@ -242,6 +1075,7 @@ class FeatureExtractorBase(object):
 
     def print_outputs(self, handle, signature="image_feature_vector"):
         """ Print possible outputs and their shapes """
+        import tensorflow_hub as hub
         image = tf.cast(np.random.rand(1, self.IMG_SIZE, self.IMG_SIZE, 3), tf.float32)
         model = hub.load(handle).signatures[signature]
         out = model(image)
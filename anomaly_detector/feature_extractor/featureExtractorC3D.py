@@ -15,8 +15,9 @@ class FeatureExtractorC3D_Block5(FeatureExtractorBase):
     OUTPUT_SHAPE        = (7, 7, 512)
     TEMPORAL_BATCH_SIZE = 16   # Fixed for C3D
     RECEPTIVE_FIELD     = {'stride': (16.0, 16.0), 'size': (119, 119)}
+    LIBRARY_VERSION     = "sports1M"
 
-    def __init__(self):
+    def __build_model__(self):
         # Create the base model from the pre-trained C3D
         model_full = C3D(weights='sports1M')
         model_full.trainable = False
@@ -25,8 +26,9 @@ class FeatureExtractorC3D_Block5(FeatureExtractorBase):
         pool_size = (output.shape[1], 1, 1)
         output = tf.keras.layers.MaxPooling3D(pool_size=pool_size, strides=pool_size, padding='valid', name='reduce_frames')(output)
 
-        self.model = tf.keras.Model(model_full.inputs, output)
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, output)
+        model.trainable = False
+        return model
     
     def format_image(self, image):
         # image = tf.cast(image, tf.float32)
@@ -45,7 +47,7 @@ class FeatureExtractorC3D_Block5(FeatureExtractorBase):
     def extract_batch(self, batch):
         if batch.ndim == 4:
             batch = np.expand_dims(batch, axis=0)
-        return tf.squeeze(self.model(batch))
+        return tf.squeeze(self.__run_model__(batch))
 
 class FeatureExtractorC3D_Block4(FeatureExtractorC3D_Block5):
     """Feature extractor based on C3D (trained on sports1M).
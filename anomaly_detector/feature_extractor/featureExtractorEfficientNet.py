@@ -5,19 +5,25 @@ Different levels align with the levels stated in the paper.
 """
 
 import tensorflow as tf
-import efficientnet.tfkeras as efn
-from efficientnet.tfkeras import preprocess_input
 
 from featureExtractorBase import FeatureExtractorBase
 
 class __FeatureExtractorEfficientNetBase__(FeatureExtractorBase):
     """ Base class for feature extractors based on EfficientNet """
+    LIBRARY_VERSION = property(lambda self: "efficientnet-%s" % getattr(__import__("efficientnet"), "__version__", "unknown"))
+
+    def __init__(self):
+        # efficientnet is only imported when needed (slow), but before a cached model
+        # is loaded as it registers the custom layers of EfficientNet
+        import efficientnet.tfkeras
+        FeatureExtractorBase.__init__(self)
 
     def format_image(self, image):
         """Resize the images to a fixed input size, and
         rescale the input channels to a range of [-1, 1].
         (According to https://www.tensorflow.org/tutorials/images/transfer_learning)
         """
+        from efficientnet.tfkeras import preprocess_input
         image = tf.cast(image, tf.float32)
         #       \/ does the same #  image = (image / 127.5) - 1
         image = preprocess_input(image) # https://github.com/keras-team/keras-applications/blob/master/keras_applications/imagenet_utils.py#L152
@@ -25,7 +31,7 @@ class __FeatureExtractorEfficientNetBase__(FeatureExtractorBase):
         return image
 
     def extract_batch(self, batch):
-        return self.model(batch)
+        return self.__run_model__(batch)
 
 ######
 # B0 #
@@ -39,15 +45,17 @@ class FeatureExtractorEfficientNetB0_Level9(__FeatureExtractorEfficientNetBase__
     OUTPUT_SHAPE    = (7, 7, 1280)
     RECEPTIVE_FIELD = {'stride': (32.0, 32.0), 'size': (851, 851)}
 
-    def __init__(self):
+    def __build_model__(self):
+        import efficientnet.tfkeras as efn
         # Create the base model from the pre-trained EfficientNet
         model_full = efn.EfficientNetB0(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                         include_top=False,
                                         weights="noisy-student")
         model_full.trainable = False
 
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
     
 # class FeatureExtractorEfficientNetB0_Level4(FeatureExtractorEfficientNetB0_Level9):
 #     """Feature extractor based on EfficientNetB0 (trained on noisy-student)."""
@@ -91,15 +99,17 @@ class FeatureExtractorEfficientNetB3_Level9(__FeatureExtractorEfficientNetBase__
     OUTPUT_SHAPE    = (10, 10, 1536)
     RECEPTIVE_FIELD = {'stride': (32.0, 32.0), 'size': (1200, 1200)}
     
-    def __init__(self):
+    def __build_model__(self):
+        import efficientnet.tfkeras as efn
         # Create the base model from the pre-trained EfficientNet
         model_full = efn.EfficientNetB3(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                         include_top=False,
                                         weights="noisy-student")
         model_full.trainable = False
 
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
 
 # class FeatureExtractorEfficientNetB3_Level4(FeatureExtractorEfficientNetB3_Level9):
 #     """Feature extractor based on EfficientNetB3 (trained on noisy-student)."""
@@ -143,15 +153,17 @@ class FeatureExtractorEfficientNetB6_Level9(__FeatureExtractorEfficientNetBase__
     OUTPUT_SHAPE    = (17, 17, 2304)
     RECEPTIVE_FIELD = {'stride': (32.0, 32.0), 'size': (1056, 1056)}
     
-    def __init__(self):
+    def __build_model__(self):
+        import efficientnet.tfkeras as efn
         # Create the base model from the pre-trained EfficientNet
         model_full = efn.EfficientNetB6(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                         include_top=False,
                                         weights="noisy-student")
         model_full.trainable = False
 
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
 
 # class FeatureExtractorEfficientNetB6_Level4(FeatureExtractorEfficientNetB6_Level9):
 #     """Feature extractor based on EfficientNetB6 (trained on noisy-student)."""
@@ -5,8 +5,6 @@ Different levels align with the levels stated in the paper.
 """
 
 import tensorflow as tf
-import efficientnet.tfkeras as efn
-from efficientnet.tfkeras import preprocess_input
 
 from featureExtractorBase import FeatureExtractorBase
 from featureExtractorEfficientNet import __FeatureExtractorEfficientNetBase__
@@ -23,15 +21,17 @@ class FeatureExtractorEfficientNetINB0_Level9(__FeatureExtractorEfficientNetBase
     OUTPUT_SHAPE    = (7, 7, 1280)
     RECEPTIVE_FIELD = {'stride': (32.0, 32.0), 'size': (851, 851)}
 
-    def __init__(self):
+    def __build_model__(self):
+        import efficientnet.tfkeras as efn
         # Create the base model from the pre-trained EfficientNet
         model_full = efn.EfficientNetB0(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                         include_top=False,
                                         weights="imagenet")
         model_full.trainable = False
 
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
     
 # class FeatureExtractorEfficientNetINB0_Level4(FeatureExtractorEfficientNetINB0_Level9):
 #     """Feature extractor based on EfficientNetB0 (trained on imagenet)."""
@@ -75,15 +75,17 @@ class FeatureExtractorEfficientNetINB3_Level9(__FeatureExtractorEfficientNetBase
     OUTPUT_SHAPE    = (10, 10, 1536)
     RECEPTIVE_FIELD = {'stride': (32.0, 32.0), 'size': (1200, 1200)}
     
-    def __init__(self):
+    def __build_model__(self):
+        import efficientnet.tfkeras as efn
         # Create the base model from the pre-trained EfficientNet
         model_full = efn.EfficientNetB3(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                         include_top=False,
                                         weights="imagenet")
         model_full.trainable = False
 
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
 
 # class FeatureExtractorEfficientNetINB3_Level4(FeatureExtractorEfficientNetINB3_Level9):
 #     """Feature extractor based on EfficientNetB3 (trained on imagenet)."""
@@ -127,15 +129,17 @@ class FeatureExtractorEfficientNetINB6_Level9(__FeatureExtractorEfficientNetBase
     OUTPUT_SHAPE    = (17, 17, 2304)
     RECEPTIVE_FIELD = {'stride': (32.0, 32.0), 'size': (1056, 1056)}
     
-    def __init__(self):
+    def __build_model__(self):
+        import efficientnet.tfkeras as efn
         # Create the base model from the pre-trained EfficientNet
         model_full = efn.EfficientNetB6(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                         include_top=False,
                                         weights="imagenet")
         model_full.trainable = False
 
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
 
 # class FeatureExtractorEfficientNetINB6_Level4(FeatureExtractorEfficientNetINB6_Level9):
 #     """Feature extractor based on EfficientNetB6 (trained on imagenet)."""
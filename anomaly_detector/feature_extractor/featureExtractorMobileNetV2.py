@@ -11,14 +11,15 @@ class FeatureExtractorMobileNetV2_Last(FeatureExtractorBase):
     OUTPUT_SHAPE    = (7, 7, 1280)
     RECEPTIVE_FIELD = {'stride': (32.0, 32.0), 'size': (491, 491)}
 
-    def __init__(self):
+    def __build_model__(self):
         # Create the base model from the pre-trained model MobileNetV2
         model_full = tf.keras.applications.MobileNetV2(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                                        include_top=False,
                                                        weights="imagenet")
         model_full.trainable = False
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
     
     def format_image(self, image):
         """Resize the images to a fixed input size, and
@@ -32,7 +33,7 @@ class FeatureExtractorMobileNetV2_Last(FeatureExtractorBase):
         return image
 
     def extract_batch(self, batch):
-        return self.model(batch)
+        return self.__run_model__(batch)
 
 class FeatureExtractorMobileNetV2_Block16(FeatureExtractorMobileNetV2_Last):
     """Feature extractor based on MobileNetV2 (trained on ImageNet)."""
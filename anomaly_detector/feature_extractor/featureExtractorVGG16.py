@@ -11,15 +11,16 @@ class FeatureExtractorVGG16_Block5(FeatureExtractorBase):
     OUTPUT_SHAPE    = (14, 14, 512)
     RECEPTIVE_FIELD = {'stride': (16.0, 16.0), 'size': (181, 181)}
 
-    def __init__(self):
+    def __build_model__(self):
         # Create the base model from the pre-trained model MobileNet V2
         model_full = tf.keras.applications.VGG16(input_shape=(self.IMG_SIZE, self.IMG_SIZE, 3),
                                                  include_top=False,
                                                  weights="imagenet")
         model_full.trainable = False
 
-        self.model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
-        self.model.trainable = False
+        model = tf.keras.Model(model_full.inputs, model_full.get_layer(self.LAYER_NAME).output)   
+        model.trainable = False
+        return model
     
     def format_image(self, image):
         """Resize the images to a fixed input size, and
@@ -33,7 +34,7 @@ class FeatureExtractorVGG16_Block5(FeatureExtractorBase):
         return image
 
     def extract_batch(self, batch):
-        return self.model(batch)
+        return self.__run_model__(batch)
 
 class FeatureExtractorVGG16_Block4(FeatureExtractorVGG16_Block5):
     """Feature extractor based on VGG16 at block 4 without the last max pooling layer (trained on ImageNet)."""
@@ -23,6 +23,20 @@ parser.add_argument("--image_scale", metavar="SCALE", type=float,
                     default=1.0,
                     help="Scale images by this factor (default: 1.0)")
 
+parser.add_argument("--start", metavar="S", dest="start", type=float,
+                    help="Only extract images after S seconds from the start of each bag (default: Start of bag)")
+
+parser.add_argument("--end", metavar="E", dest="end", type=float,
+                    help="Only extract images until E seconds from the start of each bag (default: End of bag)")
+
+parser.add_argument("--stride", metavar="N", dest="stride", type=int,
+                    default=1,
+                    help="Only extract every N-th image (default: 1)")
+
+parser.add_argument("--min_pose_delta", metavar="D", dest="min_pose_delta", type=float,
+                    default=0.0,
+                    help="Skip images until the camera moved at least D meters (default: 0.0)")
+
 parser.add_argument("--tf_map", metavar="TF_M", dest="tf_map", type=str,
                     default="map",
                     help="TF reference frame (default: map)")
@@ -32,7 +46,22 @@ parser.add_argument("--tf_base_link", metavar="TF_B", dest="tf_base_link", type=
                     help="TF camera frame (default: base_link)")
 
 parser.add_argument("--override", dest="override", action="store_true",
-                    help="Override existing images (default: False)")
+                    help="Override existing images and recreate the metadata file.\n"
+                         "Otherwise only messages that are not yet in the metadata file\n"
+                         "are extracted and appended (default: False)")
+
+parser.add_argument("--format", metavar="FMT", dest="format", type=str, choices=["jpg", "tfrecord"],
+                    default="jpg",
+                    help=" jpg:      One jpg file per image (default)\n"
+                         " tfrecord: Sharded TFRecord files in {output_dir}/TFRecord\n"
+                         "           (already encoded images are written as they are)")
+
+parser.add_argument("--images_per_shard", metavar="MAX", dest="images_per_shard", type=int,
+                    default=1000,
+                    help="Maximum number of images per TFRecord file (default: 1000)")
+
+parser.add_argument("--workers", metavar="W", dest="workers", type=int,
+                    help="Number of TFRecord shards written in parallel (default: Number of CPUs)")
 
 parser.add_argument("--label", metavar="L", dest="label", type=int,
                     default=0,
@@ -45,9 +74,11 @@ args = parser.parse_args()
 import os
 import sys
 import time
+import shutil
 from glob import glob
 import yaml
 from datetime import datetime
+from multiprocessing import Pool, cpu_count
 
 import h5py
 import rospy
@@ -62,6 +93,133 @@ from tqdm import tqdm
 
 from common import Visualize, utils, logger
 
+class ShardedTFRecordWriter(object):
+    """Collects encoded images and writes them to TFRecord shards with one writer per worker process"""
+
+    def __init__(self, output_dir, prefix, images_per_shard, workers=None):
+        """Create a new sharded writer
+
+        Args:
+            output_dir (str): Output directory
+            prefix (str): Prefix of the shard filenames
+            images_per_shard (int): Maximum number of images per shard
+            workers (int): Number of shards written in parallel (default: Number of CPUs)
+        """
+        self.output_dir = output_dir
+        self.prefix = prefix
+        self.images_per_shard = images_per_shard
+        self.workers = workers if workers is not None else cpu_count()
+        self.pool = Pool(processes=self.workers)
+        self.pending = list()
+        self.records = list()
+        self.count = 0
+
+        # Continue the numbering of shards written by previous runs
+        self.shard_number = len(glob(os.path.join(output_dir, "%s.*.tfrecord" % prefix)))
+
+    def add(self, time, encoded):
+        """Add an encoded image"""
+        self.records.append((time, encoded))
+        if len(self.records) >= self.images_per_shard:
+            self.flush()
+
+    def flush(self):
+        """Hand the current shard to a worker"""
+        if len(self.records) == 0:
+            return
+
+        # Limit the number of shards that are held in memory
+        while len(self.pending) >= self.workers:
+            self.count += self.pending.pop(0).get()[1]
+
+        output_file = os.path.join(self.output_dir, "%s.%.5d.tfrecord" % (self.prefix, self.shard_number))
+        self.pending.append(self.pool.apply_async(utils.write_tfrecord_shard, ((output_file, self.records, False),)))
+        self.shard_number += 1
+        self.records = list()
+
+    def close(self):
+        """Write the remaining images and wait for all workers to finish"""
+        self.flush()
+        for p in self.pending:
+            self.count += p.get()[1]
+        self.pending = list()
+        self.pool.close()
+        self.pool.join()
+        return self.count
+
+def encoded_image_from_message(msg, bridge):
+    """Get the JPEG encoded image of an image message. Compressed JPEG images
+    are used as they are, if they don't need to be cropped or scaled.
+    Args:
+        msg (sensor_msgs/Image or sensor_msgs/CompressedImage): Image message
+        bridge (CvBridge): Used to convert raw image messages
+
+    Returns:
+        bytes
+    """
+    if msg._type == "sensor_msgs/CompressedImage" and \
+       ("jpeg" in msg.format.lower() or "jpg" in msg.format.lower()) and \
+       args.image_crop is None and args.image_scale == 1.0:
+        return bytes(msg.data)
+    
+    _, encoded = cv2.imencode(".jpg", image_from_message(msg, bridge))
+    return encoded.tobytes()
+
+def image_from_message(msg, bridge):
+    """Convert an image message to an opencv image and apply cropping and scaling
+    Args:
+        msg (sensor_msgs/Image or sensor_msgs/CompressedImage): Image message
+        bridge (CvBridge): Used to convert raw image messages
+
+    Returns:
+        np.ndarray (BGR image)
+    """
+    # Get the image
+    if msg._type == "sensor_msgs/CompressedImage":
+        image_arr = np.fromstring(msg.data, np.uint8)
+        cv_image = cv2.imdecode(image_arr, cv2.IMREAD_COLOR)
+    elif msg._type == "sensor_msgs/Image":
+        cv_image = bridge.imgmsg_to_cv2(msg, "bgr8")
+    else:
+        raise ValueError("Image topic type must be either \"sensor_msgs/Image\" or \"sensor_msgs/CompressedImage\".")
+    
+    # Crop the image
+    if args.image_crop is not None:
+        cv_image = cv_image[args.image_crop[1]:args.image_crop[1] + args.image_crop[3], # y:y+h
+                            args.image_crop[0]:args.image_crop[0] + args.image_crop[2]] # x:x+w
+
+    # Scale the image
+    if args.image_scale != 1.0:
+        cv_image = cv2.resize(cv_image, (int(cv_image.shape[1] * args.image_scale),
+                                        int(cv_image.shape[0] * args.image_scale)), cv2.INTER_AREA)
+    return cv_image
+
+def message_count(bag, topics, start_time=None, end_time=None):
+    """Number of messages of the topics within the time window. The public rosbag API
+    only counts whole topics, so the count within a window is estimated from the
+    fraction of the bag's duration it covers.
+
+    Args:
+        bag (rosbag.Bag): Opened bag
+        topics (list): Topics to count
+        start_time (rospy.Time): Start of the window (default: Start of the bag)
+        end_time (rospy.Time): End of the window (default: End of the bag)
+
+    Returns:
+        Number of messages (int)
+    """
+    count = bag.get_message_count(topic_filters=topics)
+    if start_time is None and end_time is None:
+        return count
+
+    bag_start, bag_end = bag.get_start_time(), bag.get_end_time()
+    if bag_end <= bag_start:
+        return count
+
+    start = max(bag_start, start_time.to_sec() if start_time is not None else bag_start)
+    end = min(bag_end, end_time.to_sec() if end_time is not None else bag_end)
+    return int(round(count * max(end - start, 0) / (bag_end - bag_start)))
+
 def rosbag_to_images():
     ################
     #  Parameters  #
@@ -101,11 +259,68 @@ def rosbag_to_images():
         logger.error("label has to be between 0 and 2.")
         return
 
+    if args.stride < 1:
+        logger.error("stride has to be at least 1.")
+        return
+
+    if args.start is not None and args.end is not None and args.start >= args.end:
+        logger.error("start has to be before end.")
+        return
+
+    if args.format == "tfrecord":
+        if args.images_per_shard < 1:
+            logger.error("images_per_shard has to be at least 1.")
+            return
+
+        tfrecord_dir = os.path.join(output_dir, "TFRecord")
+        if not os.path.exists(tfrecord_dir):
+            os.makedirs(tfrecord_dir)
+
+    # Images already written to shards (eg. by an interrupted run) are not written again.
+    # Shards can't be overwritten, so this also applies with --override.
+    shard_times = set()
+    if args.format == "tfrecord":
+        for f in sorted(glob(os.path.join(tfrecord_dir, "*.tfrecord"))):
+            try:
+                shard_times |= set(utils.read_tfrecord_index(f)["times"].tolist())
+            except Exception as e:
+                logger.warning("Could not read %s, it may be incomplete and should be deleted (%s)" % (f, e))
+
+        if len(shard_times) > 0:
+            logger.info("%i images are already written to %s" % (len(shard_times), tfrecord_dir))
+
+    # Get the timestamps that are already extracted
+    meta_filename = os.path.join(output_dir, "metadata_cache.h5")
+
+    if args.override:
+        existing_metadata, existing_attrs = dict(), dict()
+    else:
+        existing_metadata, existing_attrs = utils.read_metadata(meta_filename)
+    
+    existing_times = set(existing_metadata["times"].tolist()) if "times" in existing_metadata else set()
+
+    # Positions of the extracted frames (for --min_pose_delta when appending)
+    existing_translations = dict()
+    if args.min_pose_delta > 0 and "camera_locations" in existing_metadata:
+        translations = existing_metadata["camera_locations"]["translation"]
+        for t_nsec, x, y, z in zip(existing_metadata["times"].tolist(), translations["x"], translations["y"], translations["z"]):
+            existing_translations[t_nsec] = np.array([x, y, z])
+
+    if len(existing_times) > 0:
+        logger.info("%i images are already extracted to %s" % (len(existing_times), output_dir))
+
+    # Duplicates removed by 01b_remove_duplicates.py --remove are not extracted again
+    removed_times = set(int(os.path.splitext(os.path.basename(f))[0]) for f in glob(os.path.join(output_dir, "Duplicates", "*.jpg")))
+    if len(removed_times) > 0 and not args.override:
+        logger.info("Skipping %i images that were removed as duplicates" % len(removed_times))
+        existing_times |= removed_times
+
     # Add progress bar if multiple files
     if len(bag_files) > 1:
         bag_files = tqdm(bag_files, desc="Bag files", file=sys.stderr)
 
     meta = list()
+    cancelled = False
 
     for bag_file in bag_files:
         # Check parameters
@@ -119,6 +334,9 @@ def rosbag_to_images():
 
         # Used to convert image message to opencv image
         bridge = CvBridge()
+
+        if args.format == "tfrecord":
+            writer = ShardedTFRecordWriter(tfrecord_dir, bag_file_name, args.images_per_shard, args.workers)
         
         ################
         #     MAIN     #
@@ -140,17 +358,47 @@ def rosbag_to_images():
                         tf_buffer.set_transform(msg_tf, "default_authority")
 
             ### Get images
-            expected_im_count = bag.get_message_count(image_topic)
+            # Time window relative to the start of the bag
+            start_time = None
+            end_time = None
+            if args.start is not None:
+                start_time = rospy.Time.from_sec(bag.get_start_time() + args.start)
+            if args.end is not None:
+                end_time = rospy.Time.from_sec(bag.get_start_time() + args.end)
+
+            expected_im_count = message_count(bag, image_topic, start_time, end_time)
 
             skipped_count = 0
+            existing_count = 0
+            filtered_count = 0
+
+            last_translation = None
 
             with tqdm(desc="Writing images", total=expected_im_count, file=sys.stderr) as pbar:
-                for topic, msg, t in bag.read_messages(topics=image_topic):
+                # Read the raw messages, so only the images we keep need to be deserialized
+                for i, (topic, raw_msg, t) in enumerate(bag.read_messages(topics=image_topic,
+                                                                          start_time=start_time,
+                                                                          end_time=end_time,
+                                                                          raw=True)):
                     output_file = os.path.join(output_dir, str(t.to_nsec()))
 
-                    # if not args.override and os.path.exists(output_file + ".jpg"):
-                    #     skipped_count += 1
-                    # else:
+                    # Skip messages that are already in the metadata file
+                    if t.to_nsec() in existing_times:
+                        # Their pose is the reference for the pose delta of the next new frame
+                        if t.to_nsec() in existing_translations:
+                            last_translation = existing_translations[t.to_nsec()]
+                        existing_count += 1
+                        pbar.set_postfix({"Skipped": skipped_count, "Existing": existing_count, "Filtered": filtered_count})
+                        pbar.update()
+                        continue
+
+                    # Only use every n-th frame
+                    if i % args.stride != 0:
+                        filtered_count += 1
+                        pbar.set_postfix({"Skipped": skipped_count, "Existing": existing_count, "Filtered": filtered_count})
+                        pbar.update()
+                        continue
+
                     try:
                         # Get translation and orientation
                         msg_tf = tf_buffer.lookup_transform(tf_map, tf_base_link, t)#, rospy.Duration.from_sec(0.001))
@@ -160,27 +408,39 @@ def rosbag_to_images():
                                                                             msg_tf.transform.rotation.z,
                                                                             msg_tf.transform.rotation.w])
 
-                        # Get the image
-                        if msg._type == "sensor_msgs/CompressedImage":
-                            image_arr = np.fromstring(msg.data, np.uint8)
-                            cv_image = cv2.imdecode(image_arr, cv2.IMREAD_COLOR)
-                        elif msg._type == "sensor_msgs/Image":
-                            cv_image = bridge.imgmsg_to_cv2(msg, "bgr8")
+                        # Drop frames while the robot is standing still
+                        if args.min_pose_delta > 0:
+                            current_translation = np.array([translation.x, translation.y, translation.z])
+                            if last_translation is None:
+                                # The first pose is the reference for all following frames
+                                last_translation = current_translation
+                            elif np.linalg.norm(current_translation - last_translation) < args.min_pose_delta:
+                                filtered_count += 1
+                                pbar.set_postfix({"Skipped": skipped_count, "Existing": existing_count, "Filtered": filtered_count})
+                                pbar.update()
+                                continue
+                            else:
+                                last_translation = current_translation
+
+                        # Images without metadata (eg. from an interrupted run) only need their metadata
+                        if args.format == "tfrecord":
+                            write_image = t.to_nsec() not in shard_times
                         else:
-                            raise ValueError("Image topic type must be either \"sensor_msgs/Image\" or \"sensor_msgs/CompressedImage\".")
-                        
-                        # Crop the image
-                        if args.image_crop is not None:
-                            cv_image = cv_image[args.image_crop[1]:args.image_crop[1] + args.image_crop[3], # y:y+h
-                                                args.image_crop[0]:args.image_crop[0] + args.image_crop[2]] # x:x+w
-
-                        # Scale the image
-                        if args.image_scale != 1.0:
-                            cv_image = cv2.resize(cv_image, (int(cv_image.shape[1] * args.image_scale),
-                                                            int(cv_image.shape[0] * args.image_scale)), cv2.INTER_AREA)
-                        
-                        # Save the image as jpg file
-                        cv2.imwrite(output_file + ".jpg", cv_image)
+                            write_image = args.override or not os.path.exists(output_file + ".jpg")
+
+                        if write_image:
+                            # Deserialize the message
+                            pytype = raw_msg[4]
+                            msg = pytype()
+                            msg.deserialize(raw_msg[1])
+
+                            if args.format == "tfrecord":
+                                writer.add(t.to_nsec(), encoded_image_from_message(msg, bridge))
+                            else:
+                                cv_image = image_from_message(msg, bridge)
+                                
+                                # Save the image as jpg file
+                                cv2.imwrite(output_file + ".jpg", cv_image)
                         
                         # Add accompanying metadata to the metadata list
                         meta.append((((translation.x, translation.y, translation.z), (euler[0], euler[1], euler[2])),   # Position and rotation
@@ -193,15 +453,28 @@ def rosbag_to_images():
 
                     except KeyboardInterrupt:
                         logger.info("Cancelled")
-                        return
+                        cancelled = True
+                        break
                     except:# tf2.LookupException, tf2.ExtrapolationException:
                         skipped_count += 1
                         
                     # Print progress
-                    pbar.set_postfix({"Skipped": skipped_count})
+                    pbar.set_postfix({"Skipped": skipped_count, "Existing": existing_count, "Filtered": filtered_count})
                     pbar.update()
 
-    logger.info("Writing metadata")
+        if args.format == "tfrecord":
+            logger.info("Waiting for TFRecord writers")
+            writer.close()
+
+        # Still write the metadata of everything extracted so far
+        if cancelled:
+            break
+
+    if len(meta) == 0:
+        logger.info("No new images extracted")
+        return
+
+    logger.info("Writing metadata (%i new images)" % len(meta))
   
     # Turn metadata into a numpy recarray. This also dictates the datatypes used in the HDF5 file.
     dt = h5py.string_dtype(encoding='ascii')
@@ -214,17 +487,21 @@ def rosbag_to_images():
                                             ('stop', 'i1'),
                                             ('bag_file', dt)])
 
-    # Save the metadata as HDF5 file
-    meta_filename = os.path.join(output_dir, "metadata_cache.h5")
-    with h5py.File(meta_filename, "w") as hf:
-        hf.attrs["Created"] = datetime.now().strftime("%d.%m.%Y, %H:%M:%S")
-        hf.create_dataset("camera_locations", data=metadata.camera_locations)
-        hf.create_dataset("times",            data=metadata.times)
-        hf.create_dataset("labels",           data=metadata.labels)
-        hf.create_dataset("directions",       data=metadata.directions)
-        hf.create_dataset("round_numbers",    data=metadata.round_numbers)
-        hf.create_dataset("stop",             data=metadata.stop)
-        hf.create_dataset("bag_file",         data=metadata.bag_file)
+    metadata = dict([(name, metadata[name]) for name in metadata.dtype.names])
+
+    if len(existing_metadata) > 0:
+        # Keep a backup (labels, directions and round numbers might have been set by hand)
+        shutil.copyfile(meta_filename, "%s_backup_%s" % (meta_filename, datetime.now().strftime("%d_%m_%Y_%H_%M_%S")))
+
+        # Append the new rows to the existing ones. Datasets that only one of them has
+        # (eg. added by later pipeline steps) are filled for the other rows.
+        metadata = utils.append_metadata(existing_metadata, metadata)
+        existing_attrs["Last changed"] = datetime.now().strftime("%d.%m.%Y, %H:%M:%S")
+    else:
+        existing_attrs["Created"] = datetime.now().strftime("%d.%m.%Y, %H:%M:%S")
+
+    # Save the metadata as HDF5 file (sorted by time)
+    utils.write_metadata(meta_filename, metadata, existing_attrs)
     
     cv2.destroyAllWindows()
 
@@ -4,26 +4,63 @@
 import consts
 import argparse
 
-parser = argparse.ArgumentParser(description="Remove duplicate images and their metadata files based on md5 checksum and size.",
+parser = argparse.ArgumentParser(description="Find duplicate images and mark (or remove) them in the metadata file.",
                                  formatter_class=argparse.RawTextHelpFormatter)
 
-parser.add_argument("images", metavar="F", type=str, default=consts.IMAGES_PATH,
+parser.add_argument("images", metavar="F", type=str, nargs="?", default=consts.IMAGES_PATH,
                     help="Path to images (default: %s)" % consts.IMAGES_PATH)
 
+parser.add_argument("--method", metavar="M", dest="method", type=str, choices=["md5", "phash"],
+                    default="md5",
+                    help=" md5:   Exact duplicates based on the md5 checksum (default)\n"
+                         " phash: Near duplicates based on a perceptual hash of a downscaled image\n"
+                         "        (catches frames of a frozen camera)")
+
+parser.add_argument("--threshold", metavar="T", dest="threshold", type=int,
+                    default=2,
+                    help="Maximum number of differing bits of the perceptual hash (of 64)\n"
+                         "for two frames to be considered duplicates (default: 2)")
+
+parser.add_argument("--jobs", metavar="J", dest="jobs", type=int,
+                    default=None,
+                    help="Number of processes used for hashing (default: Number of CPUs)")
+
+parser.add_argument("--remove", dest="remove", action="store_true",
+                    help="Remove the duplicates from the metadata file instead of marking them and move\n"
+                         "their images to {images}/Duplicates (default: False)")
+
 args = parser.parse_args()
 
 import os
 import sys
-import md5
-from glob import glob
+import shutil
+import hashlib
+from datetime import datetime
+
+import cv2
+import h5py
+import numpy as np
 from tqdm import tqdm
+from tqdm.contrib.concurrent import process_map
+
+from common import utils, logger
 
-from common import logger
+def get_md5(filename):
+    """Get the md5 checksum of a file"""
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
 
-def getmd5(filename):
-    m = md5.new()
-    m.update(file(filename, 'rb').read(-1))
-    return m.hexdigest()
+def get_phash(filename):
+    """Get a perceptual (difference) hash of an image as 64 bit integer.
+    The image is decoded at 1/8 of its size, which is much faster than a full decode."""
+    image = cv2.imread(filename, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        return None
+    image = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (image[:, 1:] > image[:, :-1]).ravel()
+    return int(sum(1 << i for i, b in enumerate(bits) if b))
 
 def remove_duplicates():
     # Check parameters
@@ -31,35 +68,84 @@ def remove_duplicates():
         logger.error("Specified path does not exist (%s)" % args.images)
         return
 
-    # Get all images
-    files = sorted(glob(os.path.join(args.images, "*.jpg")))
+    meta_filename = os.path.join(args.images, "metadata_cache.h5")
+    if not os.path.exists(meta_filename):
+        logger.error("No metadata file called \"metadata_cache.h5\" in %s" % args.images)
+        return
+
+    metadata, attrs = utils.read_metadata(meta_filename)
 
-    # Checksums
-    last_checksum = None
-    duplicates = list()
+    # Metadata is sorted by time
+    files = [os.path.join(args.images, "%i.jpg" % t) for t in metadata["times"]]
 
-    with tqdm(desc="Get MD5 checksums", total=len(files), file=sys.stderr) as pbar:
-        for f in files:
-            time = int(os.path.splitext(os.path.basename(f))[0])
-            check = getmd5(f)
-            if last_checksum == check:
-                duplicates.append(time)
+    # Get the hashes in parallel
+    hash_function = get_md5 if args.method == "md5" else get_phash
+    hashes = process_map(hash_function, files,
+                         max_workers=args.jobs,
+                         chunksize=max(1, len(files) // 1000),
+                         desc="Calculating hashes (%s)" % args.method,
+                         file=sys.stderr)
+
+    duplicates = np.zeros(len(files), dtype=np.int8)
+    missing = 0
+
+    if args.method == "md5":
+        # Exact duplicates of any previous frame
+        seen = set()
+        for i, h in enumerate(hashes):
+            if h is None:
+                missing += 1
+            elif h in seen:
+                duplicates[i] = 1
             else:
-                last_checksum = check
-            pbar.set_postfix({"Duplicates": len(duplicates)})
-            pbar.update()
+                seen.add(h)
+    else:
+        # Near duplicates of the last kept frame (eg. a frozen camera)
+        last_hash = None
+        for i, h in enumerate(hashes):
+            if h is None:
+                missing += 1
+            elif last_hash is not None and bin(h ^ last_hash).count("1") <= args.threshold:
+                duplicates[i] = 1
+            else:
+                last_hash = h
+
+    if missing > 0:
+        logger.warning("%i images listed in the metadata file do not exist" % missing)
+
+    logger.info("Found %i duplicates in %i images" % (np.count_nonzero(duplicates), len(files)))
+
+    # Always create a backup
+    shutil.copyfile(meta_filename, "%s_backup_%s" % (meta_filename, datetime.now().strftime("%d_%m_%Y_%H_%M_%S")))
+    attrs["Last changed"] = datetime.now().strftime("%d.%m.%Y, %H:%M:%S")
+    attrs["Duplicates method"] = args.method
+
+    # Frames that were marked before stay marked (or are removed as well)
+    if "duplicates" in metadata.keys():
+        duplicates = np.maximum(duplicates, metadata["duplicates"].astype(np.int8))
 
-    if len(duplicates) > 0:
-        output_dir = os.path.join(args.images, "Duplicates")
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+    if args.remove:
+        keep = duplicates == 0
+        for key in metadata.keys():
+            metadata[key] = metadata[key][keep]
+        if "duplicates" in metadata.keys():
+            del metadata["duplicates"]
 
-        for d in tqdm(duplicates, desc="Moving duplicates", file=sys.stderr):
-            os.rename(os.path.join(args.images, "%i.jpg" % d), os.path.join(output_dir, "%i.jpg" % d))
-            os.rename(os.path.join(args.images, "%i.yml" % d), os.path.join(output_dir, "%i.yml" % d))
+        # The extraction reads all images in the directory, so the removed ones have to go as well
+        # (moved instead of deleted, 01_rosbag_to_images.py doesn't extract them again)
+        duplicates_path = os.path.join(args.images, "Duplicates")
+        if not os.path.exists(duplicates_path):
+            os.makedirs(duplicates_path)
+        for i in np.flatnonzero(~keep):
+            if os.path.exists(files[i]):
+                os.rename(files[i], os.path.join(duplicates_path, os.path.basename(files[i])))
+        logger.info("Removing duplicates from %s (images moved to %s)" % (meta_filename, duplicates_path))
+    else:
+        metadata["duplicates"] = duplicates
+        logger.info("Marking duplicates in %s" % meta_filename)
 
-        
+    utils.write_metadata(meta_filename, metadata, attrs)
 
 if __name__ == "__main__":
     remove_duplicates()
-    pass
\ No newline at end of file
+    pass
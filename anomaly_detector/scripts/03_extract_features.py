@@ -16,6 +16,69 @@ parser.add_argument("--files", metavar="F", dest="files", type=str, nargs='*', d
 parser.add_argument("--extractor", metavar="EXT", dest="extractor", nargs='*', type=str,
                     help="Extractor name. Leave empty for all extractors (default: \"\")")
 
+parser.add_argument("--compile", dest="compile", action="store_true",
+                    help="Use a compiled model with a fixed input shape instead of eager execution (default: False)")
+
+parser.add_argument("--xla", dest="xla", action="store_true",
+                    help="Use XLA JIT compilation. Implies --compile (default: False)")
+
+parser.add_argument("--storage_dtype", metavar="DT", dest="storage_dtype", type=str, choices=["float32", "float16", "int8"],
+                    default="float32",
+                    help=" float32: Full precision (default)\n"
+                         " float16: Half the file size\n"
+                         " int8:    A quarter of the file size (per-channel quantization)")
+
+parser.add_argument("--quantization_samples", metavar="N", dest="quantization_samples", type=int, default=100,
+                    help="Number of frames (spread over the whole dataset) used to calibrate the int8 quantization (default: 100)")
+
+parser.add_argument("--reduction", metavar="R", dest="reduction", type=str, choices=["pca", "random"],
+                    help=" pca:    Reduce the feature channels with an incremental PCA\n"
+                         " random: Reduce the feature channels with a seeded random projection\n"
+                         " (default: No reduction)")
+
+parser.add_argument("--reduction_dims", metavar="D", dest="reduction_dims", type=int, default=64,
+                    help="Number of feature channels after the reduction (default: 64)")
+
+parser.add_argument("--shard", metavar=("K", "N"), dest="shard", nargs=2, type=int,
+                    help="Only extract shard K of N into its own file. Merge them with 03b_merge_shards.py (default: All)")
+
+parser.add_argument("--shard_mode", metavar="M", dest="shard_mode", type=str, choices=["strided", "contiguous"],
+                    default="strided",
+                    help=" strided:    Every N-th frame, starting at frame K (default)\n"
+                         " contiguous: The K-th of N contiguous blocks of frames")
+
+parser.add_argument("--roi", metavar="ROI", dest="roi", type=str,
+                    help="Region of interest: A crop box \"x0,y0,x1,y1\" in image coordinates or a mask image\n"
+                         "(white = inside). Patches outside are stored as zeros and skipped by the models (default: None)")
+
+parser.add_argument("--dedup", metavar="T", dest="dedup", type=float,
+                    help="Reuse the features of the last extracted frame if a frame differs by at most T gray levels\n"
+                         "(mean over a 16x16 thumbnail, eg. 2.0) (default: Extract every frame)")
+
+parser.add_argument("--swmr", dest="swmr", action="store_true",
+                    help="Write the features in single-writer/multiple-reader mode, so they can be\n"
+                         "read (eg. by 04x or the visualization) while extracting (default: False)")
+
+parser.add_argument("--tiles", metavar="N", dest="tiles", type=int,
+                    help="Run the network on N x N overlapping tiles to bound the memory per image\n"
+                         "(eg. for the large image extractors) (default: Full image)")
+
+parser.add_argument("--tile_margin", metavar="PX", dest="tile_margin", type=int,
+                    help="Context around each tile in pixels. Must keep the tiles smaller than the image\n"
+                         "(default: Half the receptive field, capped so the tiles are smaller than the image)")
+
+parser.add_argument("--tflite", dest="tflite", action="store_true",
+                    help="Run the extraction through the TFLite interpreter (CPU) (default: False)")
+
+parser.add_argument("--tflite_int8", dest="tflite_int8", action="store_true",
+                    help="Use post-training int8 quantization for TFLite. Implies --tflite (default: False)")
+
+parser.add_argument("--tflite_calibration", metavar="N", dest="tflite_calibration", type=int, default=100,
+                    help="Number of images (spread over all files) used to calibrate the int8 quantization (default: 100)")
+
+parser.add_argument("--threads", metavar="T", dest="threads", type=int,
+                    help="Number of threads used by the TFLite interpreter (default: Number of CPUs)")
+
 args = parser.parse_args()
 
 import os
@@ -96,11 +159,30 @@ def extract_features():
 
             logger.info("Instantiating %s" % extractor_name)
             extractor = getattr(module, extractor_name)()
+            if args.tflite or args.tflite_int8:
+                tflite_file = extractor.tflite_filename(args.tflite_int8)
+                if not os.path.exists(tflite_file):
+                    extractor.export_tflite(tflite_file, quantize=args.tflite_int8, dataset=dataset,
+                                            samples=args.tflite_calibration, total=total)
+                extractor.use_tflite(tflite_file, num_threads=args.threads)
+            elif args.tiles is not None and args.tiles > 1:
+                extractor.use_tiles(args.tiles, margin=args.tile_margin)
+            elif (args.compile or args.xla) and extractor.BATCH_SIZE > 0:
+                extractor.compile(xla=args.xla)
             # Get an instance
+            options = {"storage_dtype": args.storage_dtype,
+                       "quantization_samples": args.quantization_samples,
+                       "reduction": args.reduction,
+                       "reduction_dims": args.reduction_dims,
+                       "shard": tuple(args.shard) if args.shard is not None else None,
+                       "shard_mode": args.shard_mode,
+                       "roi": args.roi,
+                       "dedup_tolerance": args.dedup,
+                       "swmr": args.swmr}
             if bs > 1:
-                extractor.extract_dataset(dataset_3D, total)
+                extractor.extract_dataset(dataset_3D, total, **options)
             else:
-                extractor.extract_dataset(dataset, total)
+                extractor.extract_dataset(dataset, total, **options)
         except KeyboardInterrupt:
             logger.info("Terminated by CTRL-C")
             return
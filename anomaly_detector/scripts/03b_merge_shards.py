@@ -0,0 +1,35 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+
+parser = argparse.ArgumentParser(description="Merge feature files extracted in shards (03_extract_features.py --shard K N).",
+                                 formatter_class=argparse.RawTextHelpFormatter)
+
+parser.add_argument("files", metavar="F", type=str, nargs="+",
+                    help="The shard files. Supports \"path/to/*.shard*.h5\"")
+
+parser.add_argument("--output", metavar="OUT", dest="output", type=str, required=True,
+                    help="Merged feature file")
+
+parser.add_argument("--copy", dest="copy", action="store_true",
+                    help="Copy the features instead of creating virtual datasets that refer to\n"
+                         "the shards. The shards can be deleted afterwards (default: False)")
+
+args = parser.parse_args()
+
+import os
+
+from common import utils, logger
+
+def merge_shards():
+    if os.path.exists(args.output):
+        logger.error("Output file already exists (%s)" % args.output)
+        return
+
+    logger.info("Merging shards into %s" % args.output)
+    utils.merge_feature_shards(args.files, args.output, virtual=not args.copy)
+    logger.info("Done")
+
+if __name__ == "__main__":
+    merge_shards()
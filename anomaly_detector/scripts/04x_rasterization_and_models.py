@@ -7,9 +7,12 @@
 #   - rasterizations                                                                            #
 #   - models + mahalanobis distances.                                                           #
 # These calculations - especially rasterization and mahalanobis distances - are very slow       #
-# and only seem to use one core.                                                                #
-# You can call *04_rasterization_and_models_parallel.sh* instead to run multiple instances of   #
-# this script, which will then utilize more CPU cores. But beware heavy RAM use!                #
+# and only use one core each. The features file is loaded once and the calculations are then    #
+# run as parallel jobs that share its memory (see common.JobScheduler), limited by --workers    #
+# and --memory. *04_rasterization_and_models_parallel.sh* splits the files between multiple     #
+# instances of this script instead. But beware heavy RAM use!                                   #
+# Only the calculations whose inputs (features, metadata) or parameters changed since the last  #
+# run are run again (see common.Pipeline). Frames appended to a features file are only scored.  #
 #################################################################################################
 
 import consts
@@ -26,6 +29,19 @@ parser.add_argument("--index", metavar="I", dest="index", type=int, default=None
 parser.add_argument("--total", metavar="T", dest="total", type=int, default=None,
                     help="Used for parallelization (see 04_rasterization_and_models_parallel.sh)")
 
+parser.add_argument("--queue", metavar="DIR", dest="queue", type=str, default=None,
+                    help="Work queue directory on a file system shared by all workers (instead of --index and --total).\n"
+                         "Every worker claims the next feature file that is not done yet (see common.WorkQueue)")
+parser.add_argument("--stale", metavar="S", dest="stale", type=float, default=600,
+                    help="Take over feature files from workers that did not show a sign of life for S seconds (default: 600)")
+
+parser.add_argument("--force", dest="force", action="store_true",
+                    help="Calculate everything again, even if the inputs and parameters did not change")
+parser.add_argument("--workers", metavar="W", dest="workers", type=int, default=None,
+                    help="Maximum number of parallel jobs per feature file (default: number of CPU cores)")
+parser.add_argument("--memory", metavar="GB", dest="memory", type=float, default=None,
+                    help="Memory the parallel jobs may use in addition to the loaded features file (default: 80%% of the available memory)")
+
 args = parser.parse_args()
 
 import os
@@ -38,8 +54,52 @@ import h5py
 from tqdm import tqdm
 import numpy as np
 
-from common import utils, logger, PatchArray
-from anomaly_model import AnomalyModelSVG, AnomalyModelMVG, AnomalyModelBalancedDistribution, AnomalyModelBalancedDistributionSVG, AnomalyModelSpatialBinsBase
+from common import utils, logger, PatchArray, Pipeline, WorkQueue
+from anomaly_model import AnomalyModelBase, AnomalyModelSVG, AnomalyModelMVG, AnomalyModelBalancedDistribution, AnomalyModelBalancedDistributionSVG, AnomalyModelSpatialBinsBase
+
+def fit_model(patches, create_model):
+    """Fit an anomaly model (runs in a job process). The pipeline only runs this if the
+    inputs or parameters of the model changed, so an existing model is always replaced.
+    The Mahalanobis distances are calculated by score_models.
+
+    Args:
+        patches (PatchArray): Patches of the features file
+        create_model (callable): Returns the anomaly model. The model is created in the job,
+                                 because it might need the results of earlier jobs
+    """
+    m = create_model()
+    logger.info("Calculating %s" % m.NAME)
+    m.load_or_generate(patches, silent=False, force=True, mahalanobis_distances=False)
+
+def score_models(patches, create_models):
+    """Calculate the Mahalanobis distances of fitted models in one pass over the features (runs in a job process)
+
+    Args:
+        patches (PatchArray): Patches of the features file
+        create_models (list): Functions that return the anomaly models
+    """
+    models = list()
+    for create_model in create_models:
+        m = create_model()
+        if not m.load_from_file(patches.filename):
+            raise ValueError("%s is not calculated" % m.NAME)
+        m.patches = patches
+        models.append(m)
+
+    AnomalyModelBase.calculate_all_mahalanobis_distances(models, patches)
+
+def spatial_bins(patches, create_model, cell_size, fake):
+    """Create a spatial bin model (the locations are needed for the grid)"""
+    return lambda: AnomalyModelSpatialBinsBase(create_model, patches, cell_size=cell_size, fake=fake)
+
+def balanced_distribution(patches, svg_name, initial_normal_features):
+    """Create a BalancedDistribution model that uses the mean of the SVG model as learning threshold"""
+    def _create():
+        # Older files contain the model themselves
+        with patches.store.read(svg_name) if svg_name in patches.store else utils.open_feature_file(patches.filename) as hf:
+            threshold_learning = int(np.nanmean(hf[svg_name + "/mahalanobis_distances"]))
+        return AnomalyModelBalancedDistributionSVG(initial_normal_features=initial_normal_features, threshold_learning=threshold_learning, pruning_parameter=0.5)
+    return _create
 
 def calculate_locations():
     ################
@@ -66,41 +126,87 @@ def calculate_locations():
     if args.index is not None:
         files = files[args.index::args.total]
 
+    if args.queue is not None:
+        queue = WorkQueue(args.queue, stale_after=args.stale)
+        units = queue.units(files, "models")
+    else:
+        units = ((f, dict()) for f in files)
+
     with tqdm(total=len(files), file=sys.stderr) as pbar:
-        for features_file in files:
+        for features_file, record in units:
             pbar.set_description(os.path.basename(features_file))
             # Check parameters
             if features_file == "" or not os.path.exists(features_file) or not os.path.isfile(features_file):
                 logger.error("Specified feature file does not exist (%s)" % features_file)
+                record["Error"] = "Feature file does not exist"
                 continue
 
             try:
-                # Load the file
+                # Load the file once, the jobs share its memory
                 patches = PatchArray(features_file)
+                pipeline = Pipeline(patches, force=args.force, workers=args.workers, memory=int(args.memory * 1e9) if args.memory is not None else None)
+
+                # Memory the jobs need in addition to the shared patches (rough upper bounds)
+                features_size = patches.size * int(np.prod(patches.dtype["features"].shape))
+                patches_memory = patches.nbytes                      # Locations and bins are written to a copy of the patches
+                model_memory   = patches.nbytes + features_size * 8  # Training patches + features as float64
+
+                # Dependent jobs see the saved locations and rasterizations
+                refresh = patches.refresh_artifacts
+
+                # Locations depend on the features and the metadata
+                inputs = ["features", "metadata"]
+
+                # Models are only fitted on the training frames, so frames appended to the
+                # features file only need to be scored (the scores are appended as well)
+                model_inputs = ["training"]
+
+                # The models are only fitted by their stages, the Mahalanobis distances of all models
+                # are then calculated in one pass over the features (see calculate_all_mahalanobis_distances)
+                models = list()     # (stage, create model)
+                balanced = list()   # BalancedDistribution models need the Mahalanobis distances of the SVG models
 
-                models = [AnomalyModelSVG(), AnomalyModelMVG()]
+                # Only stages whose inputs or parameters changed are run (again)
+                models.append((pipeline.add("SVG", fit_model, (patches, AnomalyModelSVG),
+                                            inputs=model_inputs, memory=model_memory), AnomalyModelSVG))
+                models.append((pipeline.add("MVG", fit_model, (patches, AnomalyModelMVG),
+                                            inputs=model_inputs, memory=model_memory), AnomalyModelMVG))
+
+                # BalancedDistribution uses SVG mean as learning threshold
+                balanced.append(("BalancedDistributionSVG", balanced_distribution(patches, "SVG", 500), (500, 0.5)))
 
-                # Calculate and save the locations
                 for fake in [True, False]:
-                    patches.calculate_patch_locations(fake=fake)
+                    locations = pipeline.add("locations" if not fake else "fake_locations",
+                                             patches.calculate_patch_locations, kwargs={"fake": fake},
+                                             params=(fake,), inputs=inputs, memory=patches_memory, on_done=refresh)
                     for cell_size in [0.2, 0.5]:
                         key = "%.2f" % cell_size
                         if fake: key = "fake_" + key
 
-                        patches.calculate_rasterization(cell_size, fake=fake)
+                        rasterization = pipeline.add("rasterization_" + key, patches.calculate_rasterization, (cell_size, fake), {"force": True},
+                                                     params=(cell_size, fake), deps=[locations], memory=patches_memory, on_done=refresh)
 
-                        models.append(AnomalyModelSpatialBinsBase(AnomalyModelSVG, patches, cell_size=cell_size, fake=fake))
-                        models.append(AnomalyModelSpatialBinsBase(AnomalyModelMVG, patches, cell_size=cell_size, fake=fake))
+                        for model in [AnomalyModelSVG, AnomalyModelMVG]:
+                            create_model = spatial_bins(patches, model, cell_size, fake)
+                            models.append((pipeline.add("SpatialBin/%s/%s" % (model.__name__.replace("AnomalyModel", ""), key), fit_model, (patches, create_model),
+                                                        inputs=model_inputs, deps=[rasterization], memory=model_memory), create_model))
 
                         # BalancedDistribution uses SVG mean as learning threshold
-                        if patches.contains_mahalanobis_distances and "SpatialBin/SVG/%s" % key in patches.mahalanobis_distances.dtype.names:
-                            threshold_learning = int(np.mean(patches.mahalanobis_distances["SpatialBin/SVG/%s" % key]))
-                            models.append(AnomalyModelSpatialBinsBase(lambda: AnomalyModelBalancedDistributionSVG(initial_normal_features=10, threshold_learning=threshold_learning, pruning_parameter=0.5), patches, cell_size=cell_size, fake=fake))
+                        balanced.append(("SpatialBin/BalancedDistributionSVG/" + key,
+                                         spatial_bins(patches, balanced_distribution(patches, "SpatialBin/SVG/" + key, 10), cell_size, fake), (10, 0.5)))
 
-                # BalancedDistribution uses SVG mean as learning threshold
-                if patches.contains_mahalanobis_distances and "SVG" in patches.mahalanobis_distances.dtype.names:
-                    threshold_learning = int(np.mean(patches.mahalanobis_distances["SVG"]))
-                    models.append(AnomalyModelBalancedDistributionSVG(initial_normal_features=500, threshold_learning=threshold_learning, pruning_parameter=0.5))
+                # Scores take 8 bytes per patch (mean and single for spatial bins)
+                scores_memory = model_memory + len(models) * 2 * patches.size * 8
+
+                # Only the frames without scores are scored (see calculate_all_mahalanobis_distances)
+                mahalanobis_distances = pipeline.add("mahalanobis_distances", score_models, (patches, [c for _, c in models]),
+                                                     inputs=["features"], deps=[stage for stage, _ in models], memory=scores_memory)
+
+                balanced_stages = [pipeline.add(stage, fit_model, (patches, create_model), params=params, inputs=model_inputs,
+                                                deps=[mahalanobis_distances], memory=model_memory) for stage, create_model, params in balanced]
+
+                pipeline.add("mahalanobis_distances_balanced_distribution", score_models, (patches, [c for _, c, _ in balanced]),
+                             inputs=["features"], deps=balanced_stages, memory=scores_memory)
 
                 # # For BalancedDistributionTest
                 # if patches.contains_mahalanobis_distances and "SVG" in patches.mahalanobis_distances.dtype.names:
@@ -115,36 +221,23 @@ def calculate_locations():
                 #             for initial_normal_features in [10, 500, 1000]:
                 #                 models.append(AnomalyModelBalancedDistribution(initial_normal_features=initial_normal_features, threshold_learning=threshold_learning, pruning_parameter=pruning_parameter))
 
-                with tqdm(total=len(models), file=sys.stderr) as pbar2:
-                    for m in models:
-                        try:
-                            pbar2.set_description(m.NAME)
-                            logger.info("Calculating %s" % m.NAME)
-                            
-                            model, mdist = m.is_in_file(features_file)
-
-                            if not model:
-                                m.load_or_generate(patches, silent=False)
-                            elif not mdist:
-                                logger.info("Model already calculated")
-                                m.load_from_file(features_file)
-                                m.patches = patches
-                                m.calculate_mahalanobis_distances()
-                            else:
-                                logger.info("Model and mahalanobis distances already calculated")
-
-                        except (KeyboardInterrupt, SystemExit):
-                            raise
-                        except:
-                            logger.error("%s: %s" % (features_file, traceback.format_exc()))
-                        pbar2.update()
+                result = pipeline.run()
+                record["Stages"] = pipeline.scheduler.durations
+                failed = [name for name, success in result.items() if not success]
+                record["Failed"] = failed
+                if len(failed) > 0:
+                    logger.error("%s: %i of %i jobs failed or were skipped (%s)" % (features_file, len(failed), len(result), ", ".join(failed)))
 
             except (KeyboardInterrupt, SystemExit):
                 raise
             except:
-                logger.error("%s: %s" % (features_file, traceback.format_exc()))
+                record["Error"] = traceback.format_exc() # The unit is tried again (see WorkQueue.units)
+                logger.error("%s: %s" % (features_file, record["Error"]))
             pbar.update()
 
+    if args.queue is not None:
+        queue.report("models")
+
 if __name__ == "__main__":
     calculate_locations()
     pass
\ No newline at end of file
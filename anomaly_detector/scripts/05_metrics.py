@@ -13,11 +13,22 @@ parser.add_argument("--files", metavar="F", dest="files", type=str, nargs='*', d
 parser.add_argument("--output", metavar="OUT", dest="output", type=str,
                     help="Output file (default: \"\")")
 
+parser.add_argument("--queue", metavar="DIR", dest="queue", type=str, default=None,
+                    help="Work queue directory on a file system shared by all workers.\n"
+                         "Every worker claims the next feature file that is not done yet (see common.WorkQueue)")
+parser.add_argument("--stale", metavar="S", dest="stale", type=float, default=600,
+                    help="Take over feature files from workers that did not show a sign of life for S seconds (default: 600)")
+
+parser.add_argument("--force", dest="force", action="store_true",
+                    help="Calculate the patch labels and metrics again, even if the inputs did not change")
+
 args = parser.parse_args()
 
 import os
 import time
-from common import utils, logger, PatchArray, ImageLocationUtility
+import json
+import socket
+from common import utils, logger, PatchArray, ImageLocationUtility, Pipeline, WorkQueue
 import sys
 from datetime import datetime
 import inspect
@@ -29,6 +40,16 @@ import numpy as np
 import csv
 from tqdm import tqdm
 
+def save_metrics(patches):
+    """Calculate the metrics and save them to the artifact store (runs in a job process)"""
+    res = patches.calculate_metrics()
+
+    # Filters (tuples) are written to the CSV as they are printed
+    rows = [[str(v) if isinstance(v, tuple) else v.item() if isinstance(v, np.generic) else v for v in row] for row in res]
+
+    with patches.store.write("metrics") as hf:
+        hf.attrs["rows"] = json.dumps(rows)
+
 def metrics():
     ################
     #  Parameters  #
@@ -51,7 +72,10 @@ def metrics():
     # files = filter(lambda f: "EfficientNetB6" in f, files)
     # files = filter(lambda f: "EfficientNetB6_Level6" not in f, files)
 
-    if args.output is None:
+    if args.output is None and args.queue is not None:
+        # Every worker writes its own file (the metrics are cached, run again without --queue to collect them in one file)
+        filename = os.path.join(consts.METRICS_PATH, datetime.now().strftime("%Y_%m_%d_%H_%M_metrics") + "_%s_%i.csv" % (socket.gethostname(), os.getpid()))
+    elif args.output is None:
         filename = os.path.join(consts.METRICS_PATH, datetime.now().strftime("%Y_%m_%d_%H_%M_metrics.csv"))
     else:
         filename = args.output
@@ -82,21 +106,48 @@ def metrics():
         if write_header:
             writer.writeheader()
         
+        if args.queue is not None:
+            queue = WorkQueue(args.queue, stale_after=args.stale)
+            units = queue.units(files, "metrics")
+        else:
+            units = ((f, dict()) for f in files)
+
         with tqdm(total=len(files), file=sys.stderr, desc="Calculating metrics") as pbar:
-            for features_file in files:
+            for features_file, record in units:
 
                 pbar.set_description(os.path.basename(features_file))
                 # Check parameters
                 if features_file == "" or not os.path.exists(features_file) or not os.path.isfile(features_file):
                     logger.error("Specified feature file does not exist (%s)" % features_file)
+                    record["Error"] = "Feature file does not exist"
                     continue
 
                 # Load the file
                 patches = PatchArray(features_file)
-                
-                patches.calculate_patch_labels()
-                
-                res = patches.calculate_metrics()
+
+                # Patch labels and metrics are only calculated again if their inputs changed (see common.Pipeline)
+                pipeline = Pipeline(patches, force=args.force, workers=1)
+
+                patch_labels = pipeline.add("patch_labels", patches.calculate_patch_labels,
+                                            inputs=["features", "metadata", "labels"], on_done=patches.refresh_artifacts)
+
+                # The metrics depend on the Mahalanobis distances of all models
+                models = sorted((k, v) for k, v in patches.store.fingerprints().items() if k not in ["patch_labels", "metrics"])
+                pipeline.add("metrics", save_metrics, (patches,),
+                             params=(tuple(models), patches.mahalanobis_distances.dtype.names if patches.contains_mahalanobis_distances else ()),
+                             inputs=["metadata"], deps=[patch_labels])
+
+                result = pipeline.run()
+                record["Stages"] = pipeline.scheduler.durations
+
+                if not result["metrics"]:
+                    logger.error("Could not calculate the metrics for %s" % features_file)
+                    record["Failed"] = [name for name, success in result.items() if not success] # Tried again
+                    pbar.update()
+                    continue
+
+                with patches.store.read("metrics") as hf:
+                    res = json.loads(hf.attrs["rows"])
 
                 for extractor, measure, model, gauss_filter, other_filter, roc_auc, auc_pr, max_f1, fpr0, fpr1, fpr2, fpr3, fpr4, fpr5 in res:
                     writer.writerow({
@@ -118,5 +169,8 @@ def metrics():
 
                 pbar.update()
 
+    if args.queue is not None:
+        queue.report("metrics")
+
 if __name__ == "__main__":
     metrics()
\ No newline at end of file
@@ -28,6 +28,24 @@ parser.add_argument("--extract_single_repeat", metavar="B", dest="extract_single
 parser.add_argument("--extract_batch_repeat", metavar="B", dest="extract_batch_repeat", type=int, default=10,
                     help="Number of batch extraction repetitions. (default: 10)")
 
+parser.add_argument("--cpu", dest="cpu", action="store_true",
+                    help="Run the benchmark on the CPU only (default: False)")
+
+parser.add_argument("--xla", dest="xla", action="store_true",
+                    help="Use XLA JIT compilation for the compiled extraction (default: False)")
+
+parser.add_argument("--tflite", dest="tflite", action="store_true",
+                    help="Also benchmark the TFLite interpreter (default: False)")
+
+parser.add_argument("--tflite_int8", dest="tflite_int8", action="store_true",
+                    help="Use post-training int8 quantization for TFLite. Implies --tflite (default: False)")
+
+parser.add_argument("--tflite_calibration", metavar="N", dest="tflite_calibration", type=int, default=100,
+                    help="Number of images (spread over all files) used to calibrate the int8 quantization (default: 100)")
+
+parser.add_argument("--threads", metavar="T", dest="threads", type=int,
+                    help="Number of threads used by the TFLite interpreter (default: Number of CPUs)")
+
 args = parser.parse_args()
 
 import os
@@ -45,6 +63,10 @@ import tensorflow as tf
 from tqdm import tqdm
 import subprocess
 
+if args.cpu:
+    # Hide all GPUs before any of them is initialized
+    tf.config.experimental.set_visible_devices([], "GPU")
+
 import feature_extractor
 
 def feature_extractor_benchmark():
@@ -69,9 +91,12 @@ def feature_extractor_benchmark():
     write_header = not os.path.exists(filename)
 
     csvfile = open(filename, "a")
-    fieldnames = ["Extractor", "Initialization", "Single"]
+    fieldnames = ["Extractor", "Initialization", "Single", "Single (compiled)"]
     for b in args.batch_sizes:
         fieldnames.append("Batch (%i)" % b)
+        fieldnames.append("Batch (%i) (compiled)" % b)
+        fieldnames.append("Batch (%i) (TFLite)" % b)
+    fieldnames += ["Autotuned batch size", "Autotuned", "TFLite drift (max)", "TFLite drift (relative)"]
     
     writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
 
@@ -91,6 +116,17 @@ def feature_extractor_benchmark():
         csvfile.close()
         for extractor_name in tqdm(args.extractor, desc="Benchmarking extractors", file=sys.stderr):
             command = "/home/ldwg/anomaly_detector/.env/bin/python /home/ldwg/anomaly_detector/anomaly_detector/scripts/06_feature_extractor_benchmark.py --extractor %s --output %s" % (extractor_name, filename)
+            if args.cpu:
+                command += " --cpu"
+            if args.xla:
+                command += " --xla"
+            if args.tflite or args.tflite_int8:
+                command += " --tflite"
+            if args.tflite_int8:
+                command += " --tflite_int8"
+                command += " --tflite_calibration %i" % args.tflite_calibration
+            if args.threads is not None:
+                command += " --threads %i" % args.threads
             process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
             for line in process.stdout:
                 tqdm.write(line)
@@ -127,35 +163,94 @@ def feature_extractor_benchmark():
             # Load dataset
             if files[0].endswith(".tfrecord"):
                 dataset = utils.load_tfrecords(files)
+                total = sum(utils.read_tfrecord_index(f)["Count"] for f in files)
             elif files[0].endswith(".jpg"):
                 dataset = utils.load_jpgs(files)
+                total = len(files)
             else:
                 raise ValueError("Supported file types are *.tfrecord and *.jpg")
             
+            raw_dataset = dataset
             dataset = dataset.map(lambda image, time: (extractor.format_image(image), time),
                                 num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-            # Test single image extraction
+            # Test single image extraction (eager and compiled)
             try:
                 single = list(dataset.take(1).as_numpy_iterator())[0] # Get a single entry
+                extractor.__compiled__ = None
                 times = np.array(timeit.repeat(lambda: extractor.extract(single[0]), number=1, repeat=args.extract_single_repeat))
                 log("Single", times)
+                
+                extractor.compile(1, xla=args.xla)
+                extractor.extract(single[0]) # Trace the graph before timing
+                times = np.array(timeit.repeat(lambda: extractor.extract(single[0]), number=1, repeat=args.extract_single_repeat))
+                log("Single (compiled)", times)
             except (KeyboardInterrupt, SystemExit):
                 raise
             except:
                 logerr("Single", traceback.format_exc())
             
-            # Test batch extraction
+            # Test batch extraction (eager and compiled)
             for batch_size in args.batch_sizes:
                 try:
                     batch = list(dataset.batch(batch_size).take(1).as_numpy_iterator())[0]
+                    extractor.__compiled__ = None
                     times = np.array(timeit.repeat(lambda: extractor.extract_batch(batch[0]), number=1, repeat=args.extract_batch_repeat))
                     times = times / float(batch_size)
                     log("Batch (%i)" % batch_size, times)
+                    
+                    extractor.compile(batch_size, xla=args.xla)
+                    extractor.extract_batch(batch[0]) # Trace the graph before timing
+                    times = np.array(timeit.repeat(lambda: extractor.extract_batch(batch[0]), number=1, repeat=args.extract_batch_repeat))
+                    times = times / float(batch_size)
+                    log("Batch (%i) (compiled)" % batch_size, times)
                 except (KeyboardInterrupt, SystemExit):
                     raise
                 except:
                     logerr("Batch (%i)" % batch_size, traceback.format_exc())
+            
+            extractor.__compiled__ = None
+
+            # Test TFLite extraction and its deviation from the TensorFlow output
+            if args.tflite or args.tflite_int8:
+                try:
+                    extractor.use_tflite(extractor.export_tflite(quantize=args.tflite_int8, dataset=raw_dataset,
+                                                                  samples=args.tflite_calibration, total=total),
+                                         num_threads=args.threads)
+                    drift_max, drift_relative = 0.0, 0.0
+                    for batch_size in args.batch_sizes:
+                        batch = list(dataset.batch(batch_size).take(1).as_numpy_iterator())[0]
+                        times = np.array(timeit.repeat(lambda: extractor.extract_batch(batch[0]), number=1, repeat=args.extract_batch_repeat))
+                        times = times / float(batch_size)
+                        log("Batch (%i) (TFLite)" % batch_size, times)
+
+                        tflite_output = np.asarray(extractor.extract_batch(batch[0]))
+                        extractor.__tflite__ = None
+                        reference = np.asarray(extractor.extract_batch(batch[0]))
+                        extractor.use_tflite(extractor.tflite_filename(args.tflite_int8), num_threads=args.threads)
+
+                        drift_max = max(drift_max, float(np.max(np.abs(tflite_output - reference))))
+                        drift_relative = max(drift_relative, float(np.mean(np.abs(tflite_output - reference)) / max(np.mean(np.abs(reference)), 1e-12)))
+                    
+                    result["TFLite drift (max)"] = drift_max
+                    result["TFLite drift (relative)"] = drift_relative
+                    logger.info("%-40s (%s): %.5f (max), %.5f (relative)" % (extractor_name, "TFLite drift", drift_max, drift_relative))
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    logerr("TFLite drift (max)", traceback.format_exc())
+                extractor.__tflite__ = None
+
+            # Test batch size autotuning (without the cache)
+            try:
+                batch_size, throughput = extractor.autotune_batch_size(max_batch_size=max(args.batch_sizes))
+                result["Autotuned batch size"] = batch_size
+                logger.info("%-40s (%s): %i" % (extractor_name, "Autotuned batch size", batch_size))
+                log("Autotuned", [1.0 / throughput])
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except:
+                logerr("Autotuned batch size", traceback.format_exc())
         except KeyboardInterrupt:
             logger.info("Cancelled")
             raise
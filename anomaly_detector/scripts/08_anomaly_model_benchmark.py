@@ -13,6 +13,9 @@ parser.add_argument("--files", metavar="F", dest="files", type=str, nargs='*', d
 parser.add_argument("--output", metavar="OUT", dest="output", type=str,
                     help="Output file (default: \"\")")
 
+parser.add_argument("--import_budget", metavar="S", dest="import_budget", type=float, default=3.0,
+                    help="Warn if \"import common\" takes longer than S seconds (default: 3.0)")
+
 args = parser.parse_args()
 
 import os
@@ -56,6 +59,9 @@ def anomaly_model_benchmark():
     
     write_header = not os.path.exists(filename)
 
+    # The non-TensorFlow tools should start quickly
+    import_time = utils.check_import_time(args.import_budget)
+
     # Calculate SVG already so we know the balanced distribution parameters
     # with tqdm(total=len(files), file=sys.stderr, desc="Calculating SVG") as pbar:
     #     for features_file in files:
@@ -75,7 +81,8 @@ def anomaly_model_benchmark():
             for features_file in files:
                 extractor_name = os.path.basename(features_file).replace(".h5", "")
 
-                result = {"Extractor": extractor_name.replace("FeatureExtractor", "")}
+                result = {"Extractor": extractor_name.replace("FeatureExtractor", ""),
+                          "Import common": import_time}
 
                 def log(s, times):
                     """Log duration t with info string s"""
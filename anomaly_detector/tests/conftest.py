@@ -0,0 +1,22 @@
+import os
+import sys
+import types
+
+# The modules import each other as top level packages (eg. "from common import utils")
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# consts.py is created by every user (see README), the tests only use temporary paths
+try:
+    import consts
+except ImportError:
+    consts = types.ModuleType("consts")
+    consts.BASE_PATH      = "/tmp/anomaly_detector/"
+    consts.IMAGES_PATH    = consts.BASE_PATH + "Images/"
+    consts.EXTRACT_FILES  = consts.IMAGES_PATH + "*.jpg"
+    consts.FEATURES_PATH  = consts.BASE_PATH + "Features/"
+    consts.BENCHMARK_PATH = consts.BASE_PATH + "Benchmark/"
+    consts.FEATURES_FILE  = consts.FEATURES_PATH + "C3D.h5"
+    consts.FEATURES_FILES = consts.FEATURES_PATH + "*.h5"
+    consts.METRICS_PATH   = consts.FEATURES_PATH + "Metrics/"
+    consts.DEFAULT_BATCH_SIZE = 8
+    sys.modules["consts"] = consts
@@ -0,0 +1,95 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from common import utils
+from feature_extractor.featureExtractorBase import FeatureExtractorBase
+
+class FeatureExtractorTiny(FeatureExtractorBase):
+    """A single 5x5 convolution, so padding the image with zeros equals the padding of the layer"""
+    IMG_SIZE        = 32
+    OUTPUT_SHAPE    = (32, 32, 4)
+    RECEPTIVE_FIELD = {"stride": (1.0, 1.0), "size": (5, 5)}
+
+    def __init__(self):
+        inputs = tf.keras.Input(shape=(self.IMG_SIZE, self.IMG_SIZE, 3))
+        x = tf.keras.layers.Conv2D(4, 5, padding="same", activation="relu")(inputs)
+        self.model = tf.keras.Model(inputs, x)
+
+    def extract_batch(self, batch):
+        return self.__run_model__(batch)
+
+def test_tiled_equals_untiled():
+    extractor = FeatureExtractorTiny()
+    batch = tf.constant(np.random.RandomState(42).uniform(size=(3, 32, 32, 3)), dtype=tf.float32)
+
+    expected = extractor.extract_batch(batch).numpy()
+
+    tile_shape, tiles = extractor.use_tiles(tiles=2)
+    assert tile_shape[0] < extractor.IMG_SIZE and tile_shape[1] < extractor.IMG_SIZE
+    assert tiles == 4
+
+    tiled = extractor.extract_batch(batch).numpy()
+    assert tiled.shape == expected.shape
+    np.testing.assert_allclose(tiled, expected, rtol=1e-5, atol=1e-5)
+
+def test_tile_margin_is_capped():
+    extractor = FeatureExtractorTiny()
+    extractor.RECEPTIVE_FIELD = {"stride": (1.0, 1.0), "size": (100, 100)}
+
+    # Half the receptive field would make the tiles larger than the image
+    tile_shape, _ = extractor.use_tiles(tiles=2)
+    assert tile_shape[0] < extractor.IMG_SIZE and tile_shape[1] < extractor.IMG_SIZE
+
+    with pytest.raises(ValueError):
+        extractor.use_tiles(tiles=2, margin=50)
+
+def _dataset(frames=8):
+    images = np.random.RandomState(42).randint(0, 256, size=(frames, 32, 32, 3)).astype(np.uint8)
+    times = np.arange(frames, dtype=np.int64) * 100 + 1000
+    return tf.data.Dataset.from_tensor_slices((images, times)), frames
+
+def test_shards_share_the_projection(tmpdir):
+    pytest.importorskip("sklearn")
+    roi = "0,0,16,32" # Left half of the image
+    files = []
+    for k in range(2):
+        extractor = FeatureExtractorTiny()
+        dataset, total = _dataset()
+        files.append(str(tmpdir.join("Tiny.shard%i.h5" % k)))
+        assert extractor.extract_dataset(dataset, total, output_file=files[-1], batch_size=2,
+                                         reduction="pca", reduction_dims=2, reduction_samples=total,
+                                         shard=(k, 2), roi=roi)
+
+    # The projection was fitted once (on all frames) and is the same in both shards
+    assert os.path.exists(str(tmpdir.join("Tiny.calibration.h5")))
+    merged = str(tmpdir.join("Tiny.h5"))
+    utils.merge_feature_shards(files, merged)
+    with h5py.File(merged, "r") as hf:
+        assert hf["features"].shape == (8, 32, 32, 2)
+        mean = np.array(hf["projection/mean"])
+
+    # Only the patches inside the ROI are used to fit the PCA
+    dataset, total = _dataset()
+    images = np.stack([extractor.format_image(image).numpy() for image, _ in dataset])
+    features = extractor.extract_batch(images).numpy()
+    np.testing.assert_allclose(mean, features[:, :, :16].reshape(-1, 4).mean(axis=0), rtol=1e-4, atol=1e-5)
+
+def test_int8_shards_share_the_quantization(tmpdir):
+    files = []
+    for k in range(2):
+        extractor = FeatureExtractorTiny()
+        dataset, total = _dataset()
+        files.append(str(tmpdir.join("Tiny.shard%i.h5" % k)))
+        assert extractor.extract_dataset(dataset, total, output_file=files[-1], batch_size=2,
+                                         storage_dtype="int8", quantization_samples=total, shard=(k, 2))
+
+    # Calibrated once on all frames, so no values are clipped and the shards can be merged
+    for f in files:
+        with h5py.File(f, "r") as hf:
+            assert hf.attrs["Clipped values"] == 0
+    utils.merge_feature_shards(files, str(tmpdir.join("Tiny.h5")))
@@ -0,0 +1,68 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from common import PatchArray
+
+def _write_files(tmpdir, frames=10, duplicates=()):
+    """Write a metadata file and a features file (2 x 3 patches with 4 features per frame)
+
+    Returns:
+        Tuple (features file, images path, times, features)
+    """
+    images_path = os.path.join(str(tmpdir), "Images") + "/"
+    os.makedirs(images_path)
+
+    times = np.arange(frames, dtype=np.uint64) * 100 + 1000
+    marked = np.zeros(frames, dtype=np.uint8)
+    marked[list(duplicates)] = 1
+
+    with h5py.File(os.path.join(images_path, "metadata_cache.h5"), "w") as hf:
+        hf.create_dataset("times", data=times)
+        hf.create_dataset("labels", data=np.ones(frames, dtype=np.uint8))
+        hf.create_dataset("directions", data=np.ones(frames, dtype=np.uint8))
+        hf.create_dataset("duplicates", data=marked)
+
+    features = np.arange(frames * 2 * 3 * 4, dtype=np.float32).reshape((frames, 2, 3, 4))
+
+    filename = os.path.join(str(tmpdir), "Features.h5")
+    with h5py.File(filename, "w") as hf:
+        hf.create_dataset("times", data=times)
+        hf.create_dataset("features", data=features)
+
+    return filename, images_path, times, features
+
+def test_load_without_duplicates(tmpdir):
+    filename, images_path, times, features = _write_files(tmpdir)
+    PatchArray.root = None
+    patches = PatchArray(filename, images_path=images_path)
+
+    assert patches.shape == (10, 2, 3)
+    assert np.array_equal(patches[:, 0, 0].times, times)
+    assert np.array_equal(patches.features, features)
+
+def test_load_with_duplicates_marked(tmpdir):
+    # The frames were marked as duplicates after the extraction, so the features file still contains them
+    filename, images_path, times, features = _write_files(tmpdir, duplicates=(3, 7))
+    PatchArray.root = None
+    patches = PatchArray(filename, images_path=images_path)
+
+    keep = np.ones(10, dtype=np.bool_)
+    keep[[3, 7]] = False
+
+    assert patches.shape == (8, 2, 3)
+    assert np.array_equal(patches[:, 0, 0].times, times[keep])
+    assert np.array_equal(patches.features, features[keep])
+
+def test_ravel_roi_without_patches(tmpdir):
+    filename, images_path, times, features = _write_files(tmpdir)
+    with h5py.File(filename, "a") as hf:
+        hf.create_dataset("roi", data=np.zeros((2, 3), dtype=np.bool_))
+    PatchArray.root = None
+    patches = PatchArray(filename, images_path=images_path)
+
+    # Models fitted on no patches would only contain NaN
+    with pytest.raises(ValueError):
+        patches.ravel_roi()
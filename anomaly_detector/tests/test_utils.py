@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from common import utils
+
+def test_roi_patch_mask_crop_box():
+    mask = utils.roi_patch_mask("0,0,112,224", (224, 224), (7, 7))
+    assert mask.shape == (7, 7)
+    assert mask[:, :3].all() and not mask[:, 4:].any()
+
+def test_roi_patch_mask_without_patches():
+    # The box lies between the centers of the first patches (16 px)
+    with pytest.raises(ValueError):
+        utils.roi_patch_mask("0,0,10,10", (224, 224), (7, 7))
+
+    with pytest.raises(ValueError):
+        utils.roi_patch_mask(np.zeros((224, 224), dtype=np.uint8), (224, 224), (7, 7))
+
+def test_append_metadata_with_new_field(tmpdir):
+    filename = str(tmpdir.join("metadata_cache.h5"))
+    existing = {"times": np.array([100, 300], dtype=np.uint64),
+                "labels": np.array([1, 2], dtype=np.int8),
+                "duplicates": np.array([0, 1], dtype=np.uint8)}
+    new = {"times": np.array([200], dtype=np.uint64),
+           "labels": np.array([1], dtype=np.int8),
+           "stop": np.array([0], dtype=np.int8)}
+
+    utils.write_metadata(filename, utils.append_metadata(existing, new))
+    metadata, _ = utils.read_metadata(filename)
+
+    assert np.array_equal(metadata["times"], [100, 200, 300])
+    assert np.array_equal(metadata["labels"], [1, 1, 2])
+    assert np.array_equal(metadata["duplicates"], [0, 0, 1])
+    assert np.array_equal(metadata["stop"], [-1, 0, -1])
+
+def test_write_metadata_with_missing_rows(tmpdir):
+    metadata = {"times": np.array([100, 200], dtype=np.uint64),
+                "stop": np.array([0], dtype=np.int8)}
+    with pytest.raises(ValueError):
+        utils.write_metadata(str(tmpdir.join("metadata_cache.h5")), metadata)
+
+def _write_shards(tmpdir, shards=3, per_shard=5):
+    """Write TFRecord shards with small images, the shard names don't sort by time"""
+    import cv2
+    times = np.arange(shards * per_shard, dtype=np.int64) * 100 + 1000
+    files = []
+    for k in range(shards):
+        records = []
+        for t in times[k * per_shard:(k + 1) * per_shard]:
+            image = np.full((8, 8, 3), t % 256, dtype=np.uint8)
+            records.append((t, cv2.imencode(".jpg", image)[1].tobytes()))
+        filename = str(tmpdir.join("Shard.%i.tfrecord" % (shards - k)))
+        utils.write_tfrecord_shard((filename, records, False))
+        files.append(filename)
+    return files, times
+
+def test_tfrecord_index_random_access(tmpdir):
+    pytest.importorskip("tensorflow")
+    files, times = _write_shards(tmpdir)
+
+    index = utils.read_tfrecord_index(files[1])
+    assert index["Count"] == 5
+    assert np.array_equal(index["times"], times[5:10])
+
+    # The offsets written with the shard equal the ones found by reading the file
+    built_times, built_offsets = utils.build_tfrecord_index(files[1])
+    assert np.array_equal(index["offsets"], built_offsets)
+
+    image, time = utils.read_tfrecord_image(files[1], 3, index)
+    assert time == times[8]
+    assert image.shape == (8, 8, 3)
+
+def test_load_dataset_parallel_reads_in_time_order(tmpdir):
+    pytest.importorskip("tensorflow")
+    files, times = _write_shards(tmpdir)
+
+    dataset, total = utils.load_dataset(str(tmpdir.join("*.tfrecord")), num_parallel_reads=3)
+    assert total == len(times)
+    assert np.array_equal([t for _, t in dataset.as_numpy_iterator()], times)
@@ -0,0 +1,65 @@
+import os
+import json
+import multiprocessing
+
+from common import ArtifactStore, WorkQueue
+
+STAGES = 50
+
+def _worker(queue_path, features_file, task):
+    """Work on the unit of a task and save a fingerprint per stage (like Pipeline does)"""
+    queue = WorkQueue(queue_path, poll_interval=0.1)
+    for f, record in queue.units([features_file], task):
+        store = ArtifactStore(f)
+        for i in range(STAGES):
+            store.set_fingerprint("%s/%i" % (task, i), "%s-%i" % (task, i))
+
+def test_units_of_one_features_file_keep_all_fingerprints(tmpdir):
+    features_file = os.path.join(str(tmpdir), "Features.h5")
+    open(features_file, "w").close()
+    queue_path = os.path.join(str(tmpdir), "Queue")
+
+    workers = [multiprocessing.Process(target=_worker, args=(queue_path, features_file, task))
+               for task in ("models", "metrics")]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+        assert w.exitcode == 0
+
+    queue = WorkQueue(queue_path)
+    assert queue.is_done(features_file, "models")
+    assert queue.is_done(features_file, "metrics")
+
+    fingerprints = ArtifactStore(features_file).fingerprints()
+    for task in ("models", "metrics"):
+        for i in range(STAGES):
+            assert fingerprints["%s/%i" % (task, i)] == "%s-%i" % (task, i)
+
+def test_failed_units_are_tried_again(tmpdir):
+    queue = WorkQueue(str(tmpdir), poll_interval=0, max_attempts=3)
+    attempts = []
+    for features_file, record in queue.units(["a.h5", "b.h5"], "models"):
+        attempts.append(features_file)
+        if features_file == "a.h5" and attempts.count("a.h5") < 2:
+            record["Error"] = "Out of memory"
+        elif features_file == "b.h5":
+            record["Failed"] = ["SVG"]
+
+    # a.h5 succeeded on the second attempt, b.h5 is given up after three
+    assert attempts.count("a.h5") == 2 and attempts.count("b.h5") == 3
+    assert queue.is_done("a.h5", "models")
+    assert not queue.is_done("b.h5", "models")
+    assert len(queue.failures("b.h5", "models")) == 3
+    assert not os.path.exists(queue._filename("b.h5", "models", "lock"))
+
+def test_taken_over_lock_is_kept(tmpdir):
+    queue = WorkQueue(str(tmpdir))
+    for features_file, record in queue.units(["a.h5"], "models"):
+        # Another worker took the unit over meanwhile (see WorkQueue._claim)
+        lock = queue._filename(features_file, "models", "lock")
+        with open(lock, "w") as f:
+            json.dump({"Worker": "other:1", "Start": 0}, f)
+
+    assert os.path.exists(lock)
+    assert not queue.is_done("a.h5", "models")